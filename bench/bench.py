@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+'''
+Offline throughput benchmark for rs2ia and randos2ia.
+
+Spins up the local stand-ins in fakes.py, points the scripts at them and
+runs a batch through parse_resourcespace_csv (rs2ia) and/or
+process_drive_folders (randos2ia), then reports items/sec, bytes/sec
+and the per-stage span summary from metrics.py.
+
+	python3 bench/bench.py --items 200 --workers 8 --rs-latency 0.05
+
+Nothing here touches the real RS, Drive or archive.org.
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HERE))
+sys.path.insert(0,HERE)
+
+import fakes
+import fingerprints
+import metrics
+import profiling
+import ratelimit
+
+# every column Asset.get_core_metadata and post_to_ia look at
+METADATA_COLUMNS = [
+	'Directors / Filmmakers','Speaker/Interviewee','Creator','Title',
+	'Alternative Title','Event title','Event series','PFA film series',
+	'Release Date','Date of recording','Event year','Date',
+	'Subject(s): Film title(s)','Subject(s): Topics(s)','Subject(s): Names',
+	'Source canonical" name"','Access copy filename','Notes','Description',
+	'Resource type','Language','Location of recording',
+	'Original Material Condition','Medium of original','Frame rate',
+	'Video height','Video width','PFA full accession number',
+	'PFA item sound characteristics','Color characteristics'
+	]
+
+class BenchUser:
+	# stands in for rs2ia.User, which asks for these with input()
+	rsUserName = 'bench'
+	rsAPIkey = 'benchkey'
+
+class CopyScheduler:
+	'''
+	Stands in for squarify.TranscodeScheduler so only the network stages
+	are measured: "transcoding" is a plain file copy.
+	'''
+	jobs = 4
+	threadsPerJob = 1
+
+	def __init__(self):
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+
+	def submit(self,local_filepath,chunks=None,head=None):
+		import squarify
+		output = squarify.square_pixel_path(local_filepath)
+
+		def copy():
+			if chunks is not None:
+				with open(output,'wb') as f:
+					for chunk in chunks:
+						f.write(chunk)
+			else:
+				shutil.copyfile(local_filepath,output)
+			return output
+
+		return self._executor.submit(copy)
+
+	def transcode_segmented(self,local_filepath,segmentLength=None):
+		return self.submit(local_filepath).result()
+
+	def shutdown(self,wait=True):
+		self._executor.shutdown(wait=wait)
+
+def metadata_row(n):
+	row = {column:'' for column in METADATA_COLUMNS}
+	row['Title'] = "Bench item {}".format(n)
+	row['Source canonical" name"'] = "bench_item_{:05d}".format(n)
+	row['Description'] = "Benchmark item"
+	return row
+
+def write_csv(path,rows):
+	with open(path,'w') as f:
+		writer = csv.DictWriter(f,list(rows[0].keys()))
+		writer.writeheader()
+		for row in rows:
+			writer.writerow(row)
+
+def conditions(args,prefix):
+	return fakes.Conditions(
+		latency=getattr(args,prefix+'_latency'),
+		bandwidth=getattr(args,prefix+'_bandwidth')*1024*1024,
+		errorRate=getattr(args,prefix+'_error_rate')
+		)
+
+def configure_ia(workdir,archive):
+	'''
+	Send the internetarchive library's traffic to the fake: plain http,
+	proxied through the fake. Only its own sessions get the proxy; a
+	global HTTP_PROXY would also catch httplib2 (Drive), which refuses
+	proxies without PySocks.
+	'''
+	import internetarchive.session
+
+	iniPath = os.path.join(workdir,'ia.ini')
+	with open(iniPath,'w') as f:
+		f.write("[s3]\naccess = bench\nsecret = bench\n\n[general]\nsecure = false\nscreenname = bench\n")
+	os.environ['IA_CONFIG_FILE'] = iniPath
+	original = internetarchive.session.ArchiveSession.__init__
+
+	@functools.wraps(original)
+	def proxied(self,*args,**kwargs):
+		original(self,*args,**kwargs)
+		# some versions read secure = false back as the string 'False'
+		self.secure = False
+		self.protocol = 'http:'
+		self.proxies = {'http':archive.url}
+
+	internetarchive.session.ArchiveSession.__init__ = proxied
+
+def bench_rs2ia(args,workdir,archive):
+	import rs2ia
+
+	filestore = os.path.join(workdir,'filestore')
+	rs = fakes.FakeResourceSpace(
+		BenchUser.rsUserName,
+		BenchUser.rsAPIkey,
+		filestore,
+		conditions(args,'rs')
+		)
+	rows = []
+	for n in range(args.items):
+		ref = 1000+n
+		alternatives = {
+			"{}{:02d}".format(ref,a): 'jpg' for a in range(args.alternatives)
+			}
+		rs.add_resource(ref,'mp4',args.file_size,alternatives)
+		row = metadata_row(n)
+		row['Resource ID(s)'] = str(ref)
+		rows.append(row)
+	csvPath = os.path.join(workdir,'rs2ia_bench.csv')
+	write_csv(csvPath,rows)
+
+	rs2ia.ResourceSpaceAPI.scheme = 'http'
+	rs2ia.ResourceSpaceAPI.server = '127.0.0.1:{}'.format(rs.port)
+	rs2ia.ResourceSpaceAPI.cache = None
+	# what rs2ia.set_up() would do: a connection per worker
+	rs2ia.ResourceSpaceAPI.configure_session(poolSize=max(rs2ia.RS_POOL_SIZE,args.workers))
+	recorder = metrics.configure(job='rs2ia')
+	_preflight = None
+	if args.preflight:
+		import preflight
+		_preflight = preflight.Preflight(archive.url+"/metadata/{}")
+	_uploader = None
+	if args.multipart_threshold is not None:
+		import multipart
+		_uploader = multipart.MultipartUploader(
+			threshold=args.multipart_threshold*1024*1024,
+			partSize=args.part_size*1024*1024,
+			stateDir=os.path.join(workdir,'ia_multipart')
+			)
+
+	rs2ia.configure_limits(
+		args.workers,
+		partWorkers=1 if _uploader is None else _uploader.workers
+		)
+
+	bytesBefore = archive.bytesIn
+	requestsBefore = archive.requests
+	start = time.perf_counter()
+	with quiet(args):
+		rs2ia.parse_resourcespace_csv(
+			csvPath,
+			BenchUser(),
+			'mp4',
+			workers=args.workers,
+			filestore=filestore if args.filestore else None,
+			_preflight=_preflight,
+			_uploader=_uploader
+			)
+	elapsed = time.perf_counter()-start
+	failures = 0
+	# every failure is listed there, including ones not worth a redo
+	failuresPath = os.path.join(workdir,'rs2ia_bench_failures.csv')
+	if os.path.isfile(failuresPath):
+		with open(failuresPath) as f:
+			failures = len(list(csv.DictReader(f)))
+	rs.stop()
+
+	return {
+		'entry point':'rs2ia',
+		'items':args.items,
+		'failed':failures,
+		'seconds':elapsed,
+		'bytes uploaded':archive.bytesIn-bytesBefore,
+		'requests':{
+			'resourcespace':rs.requests,
+			'archive.org':archive.requests-requestsBefore
+			},
+		'stages':recorder,
+		'limits':ratelimit.summary()
+		}
+
+def bench_randos2ia(args,workdir,archive):
+	import google.auth.credentials
+	import randos2ia
+	import squarify
+
+	drive = fakes.FakeDrive(conditions(args,'drive'))
+	folder = 'benchfolder'
+	# items are spread over --folders subfolders of one top folder
+	subfolders = [folder]
+	if args.folders > 1:
+		subfolders = ["benchsub{}".format(n) for n in range(args.folders)]
+		for subfolder in subfolders:
+			drive.add_folder(subfolder,subfolder,folder)
+	rows = []
+
+	def add_item(n):
+		assetID = "{:05d}".format(n)
+		parent = subfolders[n % len(subfolders)]
+		drive.add_file(
+			"file{}".format(n),
+			"bench_{}_item.mp4".format(assetID),
+			args.file_size,
+			parent
+			)
+		for d in range(args.decoys):
+			# same ID, wrong type: should never be downloaded
+			drive.add_file(
+				"decoy{}_{}".format(n,d),
+				"bench_{}_item_{}.jpg".format(assetID,d),
+				args.file_size,
+				parent,
+				mimeType='image/jpeg'
+				)
+		if args.duplicates:
+			# the same name in the next folder along, with other content
+			drive.add_file(
+				"dup{}".format(n),
+				"bench_{}_item.mp4".format(assetID),
+				args.file_size,
+				subfolders[(n+1) % len(subfolders)]
+				)
+
+	for n in range(args.items+args.topup):
+		if n < args.items:
+			add_item(n)
+		row = {'item id':"{:05d}".format(n)}
+		row.update(metadata_row(n))
+		rows.append(row)
+	csvPath = os.path.join(workdir,'randos2ia_bench.csv')
+	write_csv(csvPath,rows)
+	metaDict = randos2ia.parse_metadata_csv(csvPath)
+
+	randos2ia._driveClient = randos2ia.DriveClient(
+		credentials=google.auth.credentials.AnonymousCredentials(),
+		apiEndpoint=drive.url
+		)
+	os.makedirs(os.path.join(workdir,'temp_vids'),exist_ok=True)
+	# the fake files aren't real video, so transcoding is always a copy
+	scheduler = CopyScheduler()
+	cliArgs = [
+		folder,
+		'--download-workers',str(args.workers),
+		'--upload-workers',str(args.workers),
+		'--transcode-workers',str(scheduler.jobs),
+		'--drive-cache',os.path.join(workdir,'drive_cache.json')
+		]
+	if args.stream:
+		cliArgs.append('--stream')
+	if args.staging_space:
+		# leave only that much room in temp_vids
+		reserve = shutil.disk_usage(workdir).free//(1024*1024)-args.staging_space
+		cliArgs += ['--disk-reserve',str(reserve)]
+	if args.multipart_threshold is None:
+		cliArgs.append('--no-multipart')
+	else:
+		cliArgs += [
+			'--multipart-threshold',str(args.multipart_threshold),
+			'--part-size',str(args.part_size)
+			]
+	if args.folders > 1:
+		cliArgs.append('--recursive')
+	scriptArgs = randos2ia.set_args(cliArgs)
+	randos2ia.configure_limits(scriptArgs)
+
+	def run(label,items):
+		recorder = metrics.configure(job='randos2ia')
+		bytesBefore = archive.bytesIn
+		requestsBefore = archive.requests
+		driveBefore = drive.requests
+		start = time.perf_counter()
+		with quiet(args):
+			failures = randos2ia.process_drive_folders(
+				[folder],
+				metaDict,
+				'mp4',
+				scriptArgs,
+				scheduler=scheduler
+				)
+		result = {
+			'entry point':label,
+			'items':items,
+			'failed':len(failures),
+			'seconds':time.perf_counter()-start,
+			'bytes uploaded':archive.bytesIn-bytesBefore,
+			'requests':{
+				'drive':drive.requests-driveBefore,
+				'archive.org':archive.requests-requestsBefore
+				},
+			'stages':recorder,
+			'limits':ratelimit.summary()
+			}
+		if args.duplicates:
+			result['mismatched'] = count_mismatched()
+		return result
+
+	def count_mismatched():
+		# what went up should be one of the same-named files whole,
+		# not a mix of the two
+		mismatched = 0
+		for twin in [x for x in drive.files if x.startswith('dup')]:
+			# what goes up is the (copy) transcode
+			name = os.path.basename(squarify.square_pixel_path(drive.files[twin]['name']))
+			expected = [drive.files[x]['md5Checksum'] for x in (twin,'file'+twin[3:])]
+			uploaded = [x[name]['md5'] for x in archive.items.values() if name in x]
+			if uploaded == [] or any(x not in expected for x in uploaded):
+				mismatched += 1
+		return mismatched
+
+	results = [run('randos2ia',args.items*(2 if args.duplicates else 1))]
+	if args.topup:
+		# a later run after a few files were added (and one trashed):
+		# should only touch those
+		for n in range(args.items,args.items+args.topup):
+			add_item(n)
+		drive.trash_file("file0")
+		results.append(run('randos2ia (top-up)',args.topup*(2 if args.duplicates else 1)))
+	scheduler.shutdown()
+	drive.stop()
+
+	return results
+
+@contextlib.contextmanager
+def quiet(args):
+	# the scripts print a lot; keep it out of the report unless asked
+	if args.verbose:
+		yield
+	else:
+		with contextlib.redirect_stdout(io.StringIO()):
+			yield
+
+def report(result):
+	seconds = result['seconds']
+	done = result['items']-result['failed']
+	print("\n== {} ==".format(result['entry point']))
+	print("  {} items ({} failed) in {:.2f}s".format(result['items'],result['failed'],seconds))
+	print("  {:.2f} items/sec".format(done/seconds if seconds else 0))
+	print("  {:.2f} MB/sec uploaded".format(
+		result['bytes uploaded']/1024/1024/seconds if seconds else 0
+		))
+	print("  requests: "+", ".join(
+		"{} {}".format(k,v) for k, v in result['requests'].items()
+		))
+	if 'mismatched' in result:
+		print("  {} uploads didn't match their Drive file".format(result['mismatched']))
+	if result['limits']:
+		print(result['limits'])
+	print(result['stages'].summary_table())
+
+def set_args():
+	parser = argparse.ArgumentParser(
+		description="Benchmark rs2ia and randos2ia against local fake services"
+		)
+	parser.add_argument('--entry',choices=['rs2ia','randos2ia','both'],default='both')
+	parser.add_argument('--items',type=int,default=50,help="items in the batch")
+	parser.add_argument('--alternatives',type=int,default=5,help="RS alternative files per item")
+	parser.add_argument('--file-size',type=int,default=1024*1024,help="bytes per media file")
+	parser.add_argument('--workers',type=int,default=4,help="--workers for rs2ia and per-stage workers for randos2ia")
+	parser.add_argument('--filestore',action='store_true',help="let rs2ia derive alternative paths from the filestore")
+	parser.add_argument('--preflight',action='store_true',help="run rs2ia's archive.org preflight check")
+	parser.add_argument('--folders',type=int,default=1,help="spread randos2ia's files over this many Drive subfolders")
+	parser.add_argument('--decoys',type=int,default=0,help="non-media Drive files per item, to check they're skipped")
+	parser.add_argument('--topup',type=int,default=0,help="run randos2ia again after adding this many files, to time a delta sync")
+	parser.add_argument('--duplicates',action='store_true',help="give each randos2ia file a same-named twin in another folder (needs --folders 2 or more)")
+	parser.add_argument('--stream',action='store_true',help="run randos2ia with --stream")
+	parser.add_argument('--staging-space',type=int,default=0,help="MB of temp_vids space randos2ia may use (default: all that's free)")
+	parser.add_argument('--multipart-threshold',type=int,default=None,help="MB at which files go up as multipart uploads (default: never)")
+	parser.add_argument('--part-size',type=int,default=5,help="MB per multipart part")
+	for service in ('rs','drive','ia'):
+		parser.add_argument('--{}-latency'.format(service),type=float,default=0.0,help="seconds per request")
+		parser.add_argument('--{}-bandwidth'.format(service),type=float,default=0,help="MB/sec per body, 0 for no cap")
+		parser.add_argument('--{}-error-rate'.format(service),type=float,default=0.0,help="fraction of requests that fail")
+	parser.add_argument('--profile',nargs='?',const='',default=None,metavar='PREFIX',help="cProfile the runs to PREFIX.prof")
+	parser.add_argument('--profile-memory',action='store_true',help="also track memory with tracemalloc")
+	parser.add_argument('-v','--verbose',action='store_true',help="show the scripts' own output")
+
+	args = parser.parse_args()
+	if args.duplicates and args.folders < 2:
+		parser.error("--duplicates needs --folders 2 or more")
+
+	return args
+
+def main():
+	args = set_args()
+	workdir = tempfile.mkdtemp(prefix='rs2ia_bench_')
+	startDir = os.getcwd()
+	archive = fakes.FakeArchive(conditions(args,'ia'))
+	configure_ia(workdir,archive)
+	fingerprints.configure(os.path.join(workdir,'fingerprints.sqlite'))
+	# the scripts write temp_vids/, caches, etc. relative to the cwd
+	os.chdir(workdir)
+	try:
+		if args.profile is not None or args.profile_memory:
+			# the prefix is relative to where we were started, not workdir
+			prefix = os.path.join(startDir,args.profile or profiling.default_prefix('bench'))
+			profiling.start(prefix,cpu=args.profile is not None,memory=args.profile_memory)
+		results = []
+		if args.entry in ('rs2ia','both'):
+			results.append(bench_rs2ia(args,workdir,archive))
+		if args.entry in ('randos2ia','both'):
+			results.extend(bench_randos2ia(args,workdir,archive))
+		for path in profiling.stop():
+			print("PROFILE WRITTEN TO "+path)
+		for result in results:
+			report(result)
+	finally:
+		os.chdir(startDir)
+		archive.stop()
+		shutil.rmtree(workdir,ignore_errors=True)
+
+if __name__ == "__main__":
+	main()
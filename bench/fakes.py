@@ -0,0 +1,412 @@
+'''
+Local stand-ins for the bits of ResourceSpace, Google Drive and
+archive.org that rs2ia and randos2ia use, so their throughput can be
+measured without touching the real services.
+
+Each fake is a threaded HTTP server on 127.0.0.1 with its own
+Conditions: per-request latency, a bandwidth cap for request/response
+bodies, and a rate of requests that fail.
+'''
+
+import base64
+import hashlib
+import http.server
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+BLOCK = 64*1024
+
+class Conditions:
+	def __init__(self,latency=0.0,bandwidth=0,errorRate=0.0):
+		'''
+		latency: seconds added to every request
+		bandwidth: bytes/second for each body sent or received (0 = no cap)
+		errorRate: fraction of requests answered with an error
+		'''
+		self.latency = latency
+		self.bandwidth = bandwidth
+		self.errorRate = errorRate
+
+	def delay(self):
+		if self.latency:
+			time.sleep(self.latency)
+
+	def should_fail(self):
+		return self.errorRate and random.random() < self.errorRate
+
+	def pace(self,count):
+		if self.bandwidth:
+			time.sleep(count/self.bandwidth)
+
+class FakeServer:
+	def __init__(self,conditions=None):
+		self.conditions = conditions or Conditions()
+		self.requests = 0
+		self.bytesIn = 0
+		self.bytesOut = 0
+		self._lock = threading.Lock()
+		fake = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			# headers and body go out in separate writes; don't let Nagle
+			# and delayed ACKs add 40ms to every keep-alive request
+			disable_nagle_algorithm = True
+
+			def do_GET(self):
+				fake._handle(self,'GET')
+
+			def do_POST(self):
+				fake._handle(self,'POST')
+
+			def do_PUT(self):
+				fake._handle(self,'PUT')
+
+			def do_DELETE(self):
+				fake._handle(self,'DELETE')
+
+			def log_message(self,*args):
+				pass
+
+		self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1',0),Handler)
+		self.httpd.daemon_threads = True
+		self.port = self.httpd.server_address[1]
+		self.url = "http://127.0.0.1:{}".format(self.port)
+		self._thread = threading.Thread(target=self.httpd.serve_forever,daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def _handle(self,request,method):
+		with self._lock:
+			self.requests += 1
+		self.conditions.delay()
+		body = self.read_body(request)
+		if self.conditions.should_fail():
+			self.send(request,503,b'SlowDown')
+			return
+		self.handle(request,method,body)
+
+	def handle(self,request,method,body):
+		raise NotImplementedError
+
+	def read_body(self,request):
+		length = int(request.headers.get('Content-Length') or 0)
+		chunks = []
+		while length > 0:
+			chunk = request.rfile.read(min(BLOCK,length))
+			if not chunk:
+				break
+			length -= len(chunk)
+			self.conditions.pace(len(chunk))
+			chunks.append(chunk)
+		body = b''.join(chunks)
+		with self._lock:
+			self.bytesIn += len(body)
+		return body
+
+	def send(self,request,status,body=b'',headers=None):
+		request.send_response(status)
+		for k, v in (headers or {}).items():
+			request.send_header(k,v)
+		request.send_header('Content-Length',str(len(body)))
+		request.end_headers()
+		for i in range(0,len(body),BLOCK):
+			request.wfile.write(body[i:i+BLOCK])
+			self.conditions.pace(len(body[i:i+BLOCK]))
+		with self._lock:
+			self.bytesOut += len(body)
+
+	def send_json(self,request,data,status=200):
+		self.send(
+			request,
+			status,
+			json.dumps(data,separators=(',',':')).encode(),
+			{'Content-Type':'application/json'}
+			)
+
+class FakeResourceSpace(FakeServer):
+	'''
+	The RS API's get_resource_path and get_alternative_files, with
+	signed queries checked the same way RS does. Files are laid out under
+	filestore like an unscrambled RS filestore.
+	'''
+	def __init__(self,user,apiKey,filestore,conditions=None):
+		self.user = user
+		self.apiKey = apiKey
+		self.filestore = filestore
+		# {ref: {'ext':'mp4', 'alternatives':{altRef: ext}}}
+		self.resources = {}
+		FakeServer.__init__(self,conditions)
+
+	def add_resource(self,ref,ext,size,alternatives=None,altSize=1024):
+		self.resources[str(ref)] = {'ext':ext,'alternatives':{}}
+		write_file(self.path_for(ref,ext),size)
+		for altRef, altExt in (alternatives or {}).items():
+			self.resources[str(ref)]['alternatives'][str(altRef)] = altExt
+			write_file(self.path_for(ref,altExt,altRef),altSize)
+
+	def path_for(self,ref,ext,alternative=None):
+		ref = str(ref)
+		altPart = "_alt_{}".format(alternative) if alternative else ""
+		return os.path.join(self.filestore,*list(ref),"{}{}.{}".format(ref,altPart,ext))
+
+	def handle(self,request,method,body):
+		queryString = urllib.parse.urlsplit(request.path).query
+		query, _, sign = queryString.rpartition('&sign=')
+		expected = hashlib.sha256(self.apiKey.encode()+query.encode()).hexdigest()
+		if sign != expected:
+			self.send(request,200,b'"Invalid signature"')
+			return
+		params = dict(urllib.parse.parse_qsl(query,keep_blank_values=True))
+		function = params.get('function')
+		if function == 'get_resource_path':
+			self.send_json(request,self.get_resource_path(params))
+		elif function == 'get_alternative_files':
+			resource = self.resources.get(params.get('param1'),{})
+			self.send_json(request,[
+				{'ref':int(altRef),'name':"alt {}".format(altRef),'file_extension':ext}
+				for altRef, ext in resource.get('alternatives',{}).items()
+				])
+		else:
+			self.send_json(request,"Invalid function",400)
+
+	def get_resource_path(self,params):
+		ref = params.get('param1')
+		ext = params.get('param5')
+		alternative = params.get('param8') or None
+		if ref.startswith('['):
+			return {str(x): self.path_for(x,ext) for x in json.loads(ref)}
+		return self.path_for(ref,ext,alternative)
+
+class FakeDrive(FakeServer):
+	'''
+	Drive v3 files.list (with paging, and the parents/mimeType/name
+	contains/trashed parts of q), files.get_media (with Range requests)
+	and the Changes API. File contents are generated from the file id, so
+	nothing needs to be kept in memory.
+	'''
+	pageSize = 100
+
+	def __init__(self,conditions=None):
+		# {id: {'name':..., 'size':..., 'parent':..., 'md5Checksum':...}}
+		self.files = {}
+		# file ids in the order they changed; a change token is an index
+		self.changes = []
+		FakeServer.__init__(self,conditions)
+
+	def add_file(self,file_id,name,size,parent,mimeType='video/mp4'):
+		data = content_for(file_id,size)
+		self.files[file_id] = {
+			'id':file_id,
+			'name':name,
+			'size':str(size),
+			'parent':parent,
+			'md5Checksum':hashlib.md5(data).hexdigest(),
+			'mimeType':mimeType,
+			'trashed':False
+			}
+		self.changes.append(file_id)
+
+	def add_folder(self,folder_id,name,parent):
+		self.files[folder_id] = {
+			'id':folder_id,
+			'name':name,
+			'parent':parent,
+			'mimeType':'application/vnd.google-apps.folder',
+			'trashed':False
+			}
+		self.changes.append(folder_id)
+
+	def trash_file(self,file_id):
+		self.files[file_id]['trashed'] = True
+		self.changes.append(file_id)
+
+	def handle(self,request,method,body):
+		url = urllib.parse.urlsplit(request.path)
+		params = dict(urllib.parse.parse_qsl(url.query))
+		match = re.match(r'/drive/v3/files/([^/]+)$',url.path)
+		if url.path == '/drive/v3/files':
+			self.list_files(request,params)
+		elif url.path == '/drive/v3/changes/startPageToken':
+			self.send_json(request,{'startPageToken':str(len(self.changes))})
+		elif url.path == '/drive/v3/changes':
+			self.list_changes(request,params)
+		elif match and params.get('alt') == 'media':
+			self.get_media(request,match.group(1))
+		else:
+			self.send_json(request,{'error':'not found'},404)
+
+	def list_files(self,request,params):
+		# not a real parser: good enough for the queries randos2ia sends
+		q = params.get('q','')
+		parents = re.findall(r"'([^']+)' in parents",q)
+		mimeTypes = re.findall(r"mimeType = '([^']+)'",q)
+		names = re.findall(r"name contains '([^']+)'",q)
+		matches = [
+			{k: v for k, v in x.items() if k not in ('parent','trashed')}
+			for x in self.files.values()
+			if (not parents or x['parent'] in parents)
+			and not (x['trashed'] and 'trashed = false' in q)
+			and (not mimeTypes or x['mimeType'] in mimeTypes)
+			and (x['mimeType'].endswith('folder') or all(n.lower() in x['name'].lower() for n in names))
+			]
+		pageSize = min(int(params.get('pageSize') or self.pageSize),self.pageSize)
+		start = int(params.get('pageToken') or 0)
+		page = {'files':matches[start:start+pageSize]}
+		if start+pageSize < len(matches):
+			page['nextPageToken'] = str(start+pageSize)
+		self.send_json(request,page)
+
+	def list_changes(self,request,params):
+		start = int(params.get('pageToken') or 0)
+		pageSize = min(int(params.get('pageSize') or self.pageSize),self.pageSize)
+		page = {'changes':[]}
+		for file_id in self.changes[start:start+pageSize]:
+			_file = {k: v for k, v in self.files[file_id].items() if k != 'parent'}
+			_file['parents'] = [self.files[file_id]['parent']]
+			page['changes'].append({'fileId':file_id,'removed':False,'file':_file})
+		if start+pageSize < len(self.changes):
+			page['nextPageToken'] = str(start+pageSize)
+		else:
+			page['newStartPageToken'] = str(len(self.changes))
+		self.send_json(request,page)
+
+	def get_media(self,request,file_id):
+		if file_id not in self.files:
+			self.send_json(request,{'error':'not found'},404)
+			return
+		size = int(self.files[file_id]['size'])
+		rangeHeader = request.headers.get('Range')
+		if rangeHeader:
+			start, _, end = rangeHeader.split('=',1)[1].partition('-')
+			start = int(start)
+			end = min(int(end) if end else size-1,size-1)
+			self.send(
+				request,
+				206,
+				content_for(file_id,end-start+1,start),
+				{'Content-Range':'bytes {}-{}/{}'.format(start,end,size)}
+				)
+		else:
+			self.send(request,200,content_for(file_id,size))
+
+class FakeArchive(FakeServer):
+	'''
+	archive.org's S3-style upload (PUT /<identifier>/<filename>), its
+	multipart upload (POST ?uploads, PUT ?partNumber=&uploadId=, POST
+	?uploadId=, DELETE ?uploadId=) and the metadata API (GET
+	/metadata/<identifier>). The internetarchive library always talks to
+	s3.us.archive.org and archive.org, so run it with secure = false in
+	its config and HTTP_PROXY pointed here; requests then arrive with the
+	full original URL as their path.
+	Multipart parts are kept in memory until they're put together, so
+	keep files to benchmark sizes.
+	'''
+	def __init__(self,conditions=None):
+		# {identifier: {filename: {'name':..., 'size':..., 'md5':...}}}
+		self.items = {}
+		# {uploadId: {'identifier':..., 'name':..., 'parts':{number: body}}}
+		self.uploads = {}
+		self.partsReceived = 0
+		self._nextUpload = 0
+		FakeServer.__init__(self,conditions)
+
+	def forget_uploads(self):
+		# as if every unfinished multipart upload had expired
+		with self._lock:
+			self.uploads.clear()
+
+	def handle(self,request,method,body):
+		url = urllib.parse.urlsplit(request.path)
+		params = dict(urllib.parse.parse_qsl(url.query,keep_blank_values=True))
+		parts = [urllib.parse.unquote(x) for x in url.path.strip('/').split('/')]
+		if method == 'GET' and parts[0] == 'metadata' and len(parts) == 2:
+			files = self.items.get(parts[1])
+			if files is None:
+				self.send_json(request,{})
+			else:
+				self.send_json(request,{'files':list(files.values())})
+		elif len(parts) >= 2 and ('uploads' in params or 'uploadId' in params):
+			self.multipart(request,method,params,parts[0],'/'.join(parts[1:]),body)
+		elif method == 'PUT' and len(parts) >= 2:
+			digest = hashlib.md5(body)
+			# the library sends Content-MD5 in hex, S3 clients in base64
+			if request.headers.get('Content-MD5') not in (None,digest.hexdigest(),base64.b64encode(digest.digest()).decode()):
+				self.send_xml(request,400,"<Error><Code>BadDigest</Code></Error>")
+				return
+			self.store(parts[0],'/'.join(parts[1:]),body)
+			self.send(request,200,headers={'ETag':'"{}"'.format(digest.hexdigest())})
+		else:
+			self.send(request,200)
+
+	def store(self,identifier,name,body):
+		with self._lock:
+			self.items.setdefault(identifier,{})[name] = {
+				'name':name,
+				'size':str(len(body)),
+				'md5':hashlib.md5(body).hexdigest()
+				}
+
+	def multipart(self,request,method,params,identifier,name,body):
+		if method == 'POST' and 'uploads' in params:
+			with self._lock:
+				self._nextUpload += 1
+				uploadId = "upload{}".format(self._nextUpload)
+				self.uploads[uploadId] = {'identifier':identifier,'name':name,'parts':{}}
+			self.send_xml(request,200,
+				"<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>"
+				"<UploadId>{}</UploadId></InitiateMultipartUploadResult>".format(identifier,name,uploadId)
+				)
+			return
+		upload = self.uploads.get(params['uploadId'])
+		if upload is None:
+			self.send_xml(request,404,"<Error><Code>NoSuchUpload</Code></Error>")
+		elif method == 'PUT':
+			digest = hashlib.md5(body)
+			if request.headers.get('Content-MD5') not in (None,base64.b64encode(digest.digest()).decode()):
+				self.send_xml(request,400,"<Error><Code>BadDigest</Code></Error>")
+				return
+			with self._lock:
+				upload['parts'][int(params['partNumber'])] = body
+				self.partsReceived += 1
+			self.send(request,200,headers={'ETag':'"{}"'.format(digest.hexdigest())})
+		elif method == 'POST':
+			listed = re.findall(r'<PartNumber>(\d+)</PartNumber><ETag>"?([0-9a-f]+)"?</ETag>',body.decode())
+			for number, etag in listed:
+				if hashlib.md5(upload['parts'].get(int(number),b'')).hexdigest() != etag:
+					self.send_xml(request,400,"<Error><Code>InvalidPart</Code></Error>")
+					return
+			self.store(identifier,name,b''.join(upload['parts'][int(x)] for x, _ in listed))
+			with self._lock:
+				self.uploads.pop(params['uploadId'],None)
+			self.send_xml(request,200,
+				"<CompleteMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>"
+				"</CompleteMultipartUploadResult>".format(identifier,name)
+				)
+		elif method == 'DELETE':
+			with self._lock:
+				self.uploads.pop(params['uploadId'],None)
+			self.send(request,204)
+
+	def send_xml(self,request,status,text):
+		self.send(request,status,text.encode(),{'Content-Type':'application/xml'})
+
+def content_for(seed,size,start=0):
+	# cheap, repeatable bytes for a fake file: a 64KB pattern over and over.
+	# start/size pick out just a range of it
+	block = hashlib.sha256(str(seed).encode()).digest()*2048
+	offset = start % len(block)
+	return (block*((offset+size)//len(block)+1))[offset:offset+size]
+
+def write_file(path,size):
+	os.makedirs(os.path.dirname(path),exist_ok=True)
+	with open(path,'wb') as f:
+		f.write(content_for(path,size))
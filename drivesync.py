@@ -0,0 +1,189 @@
+'''
+Remember what's in a set of Drive folders between randos2ia runs, so a
+top-up run only has to ask Drive what changed since last time (with the
+Changes API) instead of listing every folder again.
+
+drive_cache.json holds:
+	{"settings": {the folders, media type and filters that were listed},
+	 "startPageToken": "...",
+	 "folders": [the folders and subfolders being watched],
+	 "files": {file id: {"name":..., "size":..., "md5Checksum":...,
+		"folder":..., "uploaded": md5 it had when uploaded, or null,
+		"identifier": the archive.org item it went to}}}
+
+Files that are new, or whose md5 changed since they were uploaded, are
+what's left to do. If the settings change (different folders, media
+type...) the folders are listed from scratch again.
+'''
+
+import json
+import metrics
+import os
+import threading
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+CHANGE_FIELDS = (
+	'nextPageToken, newStartPageToken, '
+	'changes(fileId, removed, file(id, name, size, md5Checksum, mimeType, parents, trashed))'
+	)
+
+class DriveSync:
+	def __init__(self,path='drive_cache.json'):
+		self.path = path
+		self._lock = threading.Lock()
+		self.state = self.load()
+
+	def load(self):
+		if os.path.isfile(self.path):
+			try:
+				with open(self.path) as f:
+					return json.load(f)
+			except ValueError:
+				print("DRIVE CACHE {} IS DAMAGED, STARTING OVER".format(self.path))
+		return {'settings':None,'startPageToken':None,'folders':[],'files':{}}
+
+	def save(self):
+		with self._lock:
+			tempPath = self.path+".tmp"
+			with open(tempPath,'w') as f:
+				json.dump(self.state,f)
+			os.replace(tempPath,self.path)
+
+	def sync(self,drive,settings,lister,accepts,recursive=False,full=False):
+		'''
+		Bring the cached listing up to date and return the files that
+		still need uploading, as {file id: details}.
+		drive: a randos2ia.DriveClient
+		settings: anything JSON-able that describes what's being listed;
+			a different value from last time means a full listing
+		lister(folders, seen): full listing of folders (plus subfolders
+			if recursive), adding every folder it lists to the set seen
+		accepts(file): whether a file from the Changes API is one we want
+		'''
+		if full or self.state['settings'] != settings or not self.state['startPageToken']:
+			self.full_listing(drive,settings,lister)
+		else:
+			self.apply_changes(drive,lister,accepts,recursive)
+		self.save()
+
+		return self.pending()
+
+	def full_listing(self,drive,settings,lister):
+		print("LISTING DRIVE FOLDERS FROM SCRATCH")
+		# get the token first so nothing that changes mid-listing is missed
+		token = drive.execute(
+			drive.service.changes().getStartPageToken(supportsAllDrives=True)
+			)['startPageToken']
+		seen = set()
+		files = lister(settings['folders'],seen)
+		self._merge(files,replace=True)
+		self.state['settings'] = settings
+		self.state['folders'] = sorted(seen)
+		self.state['startPageToken'] = token
+
+	def apply_changes(self,drive,lister,accepts,recursive):
+		folders = set(self.state['folders'])
+		roots = set(self.state['settings']['folders'])
+		files = self.state['files']
+		newFolders = []
+		with metrics.span('drive_changes') as span:
+			count = 0
+			pageToken = self.state['startPageToken']
+			while True:
+				response = drive.execute(drive.service.changes().list(
+					pageToken=pageToken,
+					spaces='drive',
+					fields=CHANGE_FIELDS,
+					pageSize=1000,
+					includeRemoved=True,
+					includeItemsFromAllDrives=True,
+					supportsAllDrives=True
+					))
+				for change in response.get('changes',[]):
+					count += 1
+					fileID = change.get('fileId')
+					_file = change.get('file') or {}
+					inside = next((x for x in _file.get('parents',[]) if x in folders),None)
+					gone = change.get('removed') or _file.get('trashed')
+					if _file.get('mimeType') == FOLDER_MIME_TYPE or fileID in folders:
+						if (gone or inside is None) and fileID in folders and fileID not in roots:
+							# trashed or moved out: forget it and what was in it
+							folders.discard(fileID)
+							for x in [x for x, y in files.items() if y['folder'] == fileID]:
+								del files[x]
+						elif recursive and inside and not gone and fileID not in folders:
+							newFolders.append(fileID)
+						continue
+					if gone or inside is None or not accepts(_file):
+						files.pop(fileID,None)
+						continue
+					previous = files.get(fileID,{})
+					files[fileID] = {
+						'name':_file.get('name'),
+						'size':_file.get('size'),
+						'md5Checksum':_file.get('md5Checksum'),
+						'folder':inside,
+						'uploaded':previous.get('uploaded'),
+						'identifier':previous.get('identifier')
+						}
+				if 'newStartPageToken' in response:
+					self.state['startPageToken'] = response['newStartPageToken']
+					break
+				pageToken = response['nextPageToken']
+			span.labels['changes'] = count
+		print("{} CHANGES IN DRIVE SINCE THE LAST RUN".format(count))
+		if newFolders:
+			# a folder that turned up already full only shows up as one
+			# change, so list it
+			seen = set()
+			self._merge(lister(newFolders,seen))
+			folders |= seen
+		self.state['folders'] = sorted(folders)
+
+	def _merge(self,listed,replace=False):
+		# keep upload marks for files that are still the same
+		previous = self.state['files']
+		files = {} if replace else previous
+		for fileID, details in listed.items():
+			before = previous.get(fileID,{})
+			files[fileID] = {
+				'name':details.get('name'),
+				'size':details.get('size'),
+				'md5Checksum':details.get('md5Checksum'),
+				'folder':details.get('folder'),
+				'uploaded':before.get('uploaded'),
+				'identifier':before.get('identifier')
+				}
+		self.state['files'] = files
+
+	def pending(self):
+		with self._lock:
+			return {
+				fileID: dict(details)
+				for fileID, details in self.state['files'].items()
+				if not self._is_uploaded(details)
+				}
+
+	def uploaded(self):
+		'''
+		The files that are already up as they are now, as {file id:
+		details}; details['identifier'] is the item they went to (None
+		for files marked before that was kept).
+		'''
+		with self._lock:
+			return {
+				fileID: dict(details)
+				for fileID, details in self.state['files'].items()
+				if self._is_uploaded(details)
+				}
+
+	@staticmethod
+	def _is_uploaded(details):
+		return details['uploaded'] is not None and details['uploaded'] == (details['md5Checksum'] or True)
+
+	def mark_uploaded(self,fileID,identifier=None):
+		with self._lock:
+			details = self.state['files'].get(fileID)
+			if details is not None:
+				details['uploaded'] = details['md5Checksum'] or True
+				details['identifier'] = identifier
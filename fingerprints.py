@@ -0,0 +1,256 @@
+'''
+MD5 and SHA-1 of the files we move, worked out while the bytes are
+passing through anyway (a Drive download being written, an upload being
+read off disk) rather than in a pass of their own, and remembered in a
+small SQLite index so an unchanged file is never hashed twice.
+
+Index entries are keyed by path and only trusted while the file still
+has the same size, mtime and inode as when it was hashed; a file that
+has been rewritten or replaced gets hashed again the next time it's
+needed.
+
+	digest = fingerprints.Digest()
+	for block in ...:
+		digest.update(block)
+	fingerprints.remember(path,digest)
+	...
+	fingerprints.md5_of(path)   # from the index, or hashed (once) now
+
+Nothing is kept between runs unless configure() has been given an
+index file.
+'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+READ_BLOCK = 1024*1024
+
+class Digest:
+	'''
+	MD5 and SHA-1 of the same bytes, fed once.
+	'''
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self._md5 = hashlib.md5()
+		self._sha1 = hashlib.sha1()
+		self.size = 0
+
+	def update(self,block):
+		self._md5.update(block)
+		self._sha1.update(block)
+		self.size += len(block)
+
+	@property
+	def md5(self):
+		return self._md5.hexdigest()
+
+	@property
+	def sha1(self):
+		return self._sha1.hexdigest()
+
+class OrderedDigest(Digest):
+	'''
+	A Digest for a file that's written in pieces out of order (e.g. by
+	rangedownload): blocks at the front are hashed as they arrive, and
+	blocks further on are read back from the page cache (they were only
+	just written) once everything before them is in.
+	'''
+	def __init__(self,fd):
+		self.fd = fd
+		# {offset: end} of blocks written but not hashed yet
+		self._waiting = {}
+		self._lock = threading.Lock()
+		Digest.__init__(self)
+
+	def add(self,offset,block):
+		end = offset+len(block)
+		with self._lock:
+			if end <= self.size:
+				# a retried range going over bytes we already have
+				return
+			if offset > self.size:
+				self._waiting[offset] = max(end,self._waiting.get(offset,0))
+				return
+			self.update(block[self.size-offset:])
+			while self._waiting:
+				starts = [x for x in self._waiting if x <= self.size]
+				if not starts:
+					break
+				for start in starts:
+					waitingEnd = self._waiting.pop(start)
+					while self.size < waitingEnd:
+						self.update(os.pread(self.fd,min(READ_BLOCK,waitingEnd-self.size),self.size))
+
+class HashingFile:
+	'''
+	Wrap an open file so whatever is read from it or written to it is
+	hashed on the way through. If it's read (or written) from start to
+	end in order, digest holds the whole file's checksums; seeking back
+	to the start starts them over, as the internetarchive library does
+	before each attempt at an upload.
+	'''
+	def __init__(self,_file):
+		self._file = _file
+		self.name = getattr(_file,'name',None)
+		self.digest = Digest()
+
+	def read(self,size=-1):
+		position = self._file.tell()
+		block = self._file.read(size)
+		if position == self.digest.size:
+			self.digest.update(block)
+		return block
+
+	def write(self,block):
+		position = self._file.tell()
+		written = self._file.write(block)
+		if position == self.digest.size:
+			self.digest.update(block)
+		return written
+
+	def seek(self,offset,whence=os.SEEK_SET):
+		result = self._file.seek(offset,whence)
+		if self._file.tell() == 0:
+			self.digest.reset()
+		return result
+
+	def tell(self):
+		return self._file.tell()
+
+	def fileno(self):
+		return self._file.fileno()
+
+	def close(self):
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+	def __getattr__(self,name):
+		# anything else (mode, closed...) is the file's
+		return getattr(self._file,name)
+
+	def complete(self):
+		# did every byte of the file go through? (by name: the
+		# internetarchive library closes the file once it's sent)
+		return self.digest.size == os.path.getsize(self.name)
+
+class FingerprintIndex:
+	def __init__(self,path='fingerprints.sqlite'):
+		self.path = path
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		# one connection shared by all worker threads, guarded by _lock
+		self._db = sqlite3.connect(path,check_same_thread=False)
+		self._db.execute(
+			"CREATE TABLE IF NOT EXISTS fingerprints ("
+			"path TEXT PRIMARY KEY, "
+			"size INTEGER, "
+			"mtime INTEGER, "
+			"inode INTEGER, "
+			"md5 TEXT, "
+			"sha1 TEXT, "
+			"hashed REAL)"
+			)
+		self._db.commit()
+
+	def get(self,path):
+		'''
+		Return {'md5':..., 'sha1':...} for path if it hasn't changed since
+		it was hashed, or None.
+		'''
+		path = os.path.abspath(path)
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		with self._lock:
+			row = self._db.execute(
+				"SELECT md5, sha1 FROM fingerprints "
+				"WHERE path=? AND size=? AND mtime=? AND inode=?",
+				(path,stat.st_size,stat.st_mtime_ns,stat.st_ino)
+				).fetchone()
+			if row is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+
+		return {'md5':row[0],'sha1':row[1]}
+
+	def put(self,path,md5,sha1):
+		path = os.path.abspath(path)
+		stat = os.stat(path)
+		with self._lock:
+			self._db.execute(
+				"INSERT OR REPLACE INTO fingerprints VALUES (?,?,?,?,?,?,?)",
+				(path,stat.st_size,stat.st_mtime_ns,stat.st_ino,md5,sha1,time.time())
+				)
+			self._db.commit()
+
+	def forget(self,path):
+		with self._lock:
+			self._db.execute(
+				"DELETE FROM fingerprints WHERE path=?",
+				(os.path.abspath(path),)
+				)
+			self._db.commit()
+
+	def stats(self):
+		return "FINGERPRINTS: {} hits, {} misses".format(self.hits,self.misses)
+
+	def close(self):
+		with self._lock:
+			self._db.close()
+
+_index = None
+
+def configure(path='fingerprints.sqlite'):
+	global _index
+	_index = FingerprintIndex(path) if path else None
+	return _index
+
+def get_index():
+	return _index
+
+def remember(path,digest):
+	# no-op without an index
+	if _index is not None and digest.size == os.path.getsize(path):
+		_index.put(path,digest.md5,digest.sha1)
+
+def forget(path):
+	if _index is not None:
+		_index.forget(path)
+
+def lookup(path):
+	if _index is None:
+		return None
+	return _index.get(path)
+
+def hash_file(path):
+	digest = Digest()
+	with open(path,'rb') as f:
+		for block in iter(lambda: f.read(READ_BLOCK),b''):
+			digest.update(block)
+	remember(path,digest)
+
+	return digest
+
+def md5_of(path):
+	'''
+	The file's MD5, from the index if it's there and the file hasn't
+	changed, otherwise hashed now (and remembered).
+	'''
+	known = lookup(path)
+	if known is not None:
+		return known['md5']
+
+	return hash_file(path).md5
@@ -0,0 +1,85 @@
+'''
+Append-only record of how far each asset in a batch got, so that an
+interrupted run can pick up where it left off instead of starting over.
+
+Every event is written as one JSON line and fsync'd straight away:
+	{"time": ..., "id": "1234", "stage": "resolved", "paths": [...]}
+	{"time": ..., "id": "1234", "stage": "uploaded"}
+	{"time": ..., "id": "5678", "stage": "failed", "reason": "...",
+	 "failedStage": "rs_alternatives", "kind": "permanent"}
+The last line for an id is its current state.
+
+The file is always appended to, but earlier runs are only read back in
+when resuming; otherwise state starts out empty.
+'''
+
+import json
+import os
+import threading
+import time
+
+RESOLVED = 'resolved'
+UPLOADED = 'uploaded'
+FAILED = 'failed'
+
+class Journal:
+	def __init__(self,path,resume=False):
+		self.path = path
+		self._lock = threading.Lock()
+		if resume:
+			self.state = self.load()
+		else:
+			self.state = {}
+		self._file = open(path,'a')
+
+	def load(self):
+		'''
+		Read back the journal into {id: last record}. A half-written last
+		line (i.e. we crashed mid-write) is just skipped.
+		'''
+		state = {}
+		if not os.path.isfile(self.path):
+			return state
+		with open(self.path) as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue
+				if 'id' in record:
+					state[record['id']] = record
+
+		return state
+
+	def record(self,_id,stage,**details):
+		record = {'time':time.time(),'id':str(_id),'stage':stage}
+		record.update(details)
+		with self._lock:
+			self._file.write(json.dumps(record)+"\n")
+			self._file.flush()
+			os.fsync(self._file.fileno())
+			self.state[str(_id)] = record
+
+	def stage_of(self,_id):
+		record = self.state.get(str(_id))
+		if record:
+			return record['stage']
+		else:
+			return None
+
+	def is_done(self,_id):
+		return self.stage_of(_id) == UPLOADED
+
+	def resolved_paths(self,_id):
+		'''
+		Paths from a previous run, if the asset got resolved but not uploaded.
+		'''
+		record = self.state.get(str(_id))
+		if record and record['stage'] == RESOLVED:
+			return record.get('paths')
+		else:
+			return None
+
+	def close(self):
+		with self._lock:
+			self._file.close()
@@ -0,0 +1,307 @@
+'''
+Time each stage of a run (RS queries, path resolution, Drive listing and
+downloads, transcodes, IA uploads, cleanup) as a "span": how long it
+took, how many bytes it moved and how it came out.
+
+	with metrics.span('ia_upload',item=identifier) as s:
+		...
+		s.bytes = size
+		if not uploaded:
+			s.outcome = metrics.FAILED
+
+A span's outcome is 'ok' unless it's set otherwise, or 'error' if the
+block raises. Every finished span is written as one JSON line to the
+spans file (if there is one):
+	{"time": ..., "stage": "ia_upload", "seconds": 4.2, "bytes": 1048576, "outcome": "ok", "item": "..."}
+and the totals per stage go to a Prometheus textfile (for the node
+exporter's textfile collector) every so often and at the end of the run,
+along with a summary table for the terminal. Anything else that has a
+current value worth watching (e.g. ratelimit's concurrency limits) can
+put it in the textfile with set_gauge().
+
+Counts, sums and bytes are exact, but the quantiles come from a fixed
+size sample of each stage's durations, so a process that runs for weeks
+(--daemon) doesn't keep every duration it ever saw. A long-lived process
+can also call new_batch() to get a summary table of one batch at a time;
+the textfile always has the totals since it started.
+'''
+
+import json
+import os
+import random
+import threading
+import time
+
+OK = 'ok'
+FAILED = 'failed'
+ERROR = 'error'
+CACHED = 'cached'
+SKIPPED = 'skipped'
+
+QUANTILES = (0.5,0.9,0.99)
+# durations kept per stage for the quantiles
+RESERVOIR_SIZE = 1024
+
+class Span:
+	def __init__(self,recorder,stage,labels):
+		self.recorder = recorder
+		self.stage = stage
+		self.labels = labels
+		self.bytes = 0
+		self.outcome = OK
+		self.seconds = None
+
+	def __enter__(self):
+		self.time = time.time()
+		self._start = time.perf_counter()
+		return self
+
+	def __exit__(self,excType,excValue,traceback):
+		self.seconds = time.perf_counter()-self._start
+		if excType is not None:
+			self.outcome = ERROR
+			self.labels.setdefault('error',str(excValue))
+		self.recorder.add(self)
+		# don't swallow the exception
+		return False
+
+class StageTotals:
+	def __init__(self,size=RESERVOIR_SIZE):
+		self.size = size
+		self.count = 0
+		self.seconds = 0.0
+		self.max = 0.0
+		self.bytes = 0
+		self.outcomes = {}
+		# a uniform sample of the durations (reservoir sampling)
+		self.sample = []
+
+	def add(self,seconds,_bytes,outcome):
+		self.count += 1
+		self.seconds += seconds
+		self.max = max(self.max,seconds)
+		self.bytes += _bytes or 0
+		self.outcomes[outcome] = self.outcomes.get(outcome,0)+1
+		if len(self.sample) < self.size:
+			self.sample.append(seconds)
+		else:
+			n = random.randrange(self.count)
+			if n < self.size:
+				self.sample[n] = seconds
+
+class Recorder:
+	def __init__(self,spansPath=None,prometheusPath=None,job='rs2ia',flushEvery=30):
+		'''
+		spansPath: JSON lines file to append every span to
+		prometheusPath: Prometheus textfile to (re)write with per-stage totals
+		job: label to tell rs2ia and randos2ia apart in Prometheus
+		flushEvery: seconds between textfile rewrites during a run
+		'''
+		self.spansPath = spansPath
+		self.prometheusPath = prometheusPath
+		self.job = job
+		self.flushEvery = flushEvery
+		self.started = time.time()
+		# {stage: StageTotals} since the start, and since new_batch()
+		self.stages = {}
+		self.batch = {}
+		self.batchStarted = self.started
+		# {name: {'help':..., 'values':{((label, value), ...): value}}}
+		self.gauges = {}
+		self._lock = threading.Lock()
+		self._lastFlush = time.monotonic()
+		self._file = None
+		if spansPath is not None:
+			self._file = open(spansPath,'a')
+
+	def span(self,stage,**labels):
+		return Span(self,stage,labels)
+
+	def add(self,span):
+		record = {
+			'time':span.time,
+			'job':self.job,
+			'stage':span.stage,
+			'seconds':round(span.seconds,6),
+			'bytes':span.bytes,
+			'outcome':span.outcome
+			}
+		record.update(span.labels)
+		with self._lock:
+			for stages in (self.stages,self.batch):
+				stages.setdefault(span.stage,StageTotals()).add(span.seconds,span.bytes,span.outcome)
+			if self._file is not None:
+				self._file.write(json.dumps(record,default=str)+"\n")
+				self._file.flush()
+			flush = (
+				self.prometheusPath is not None
+				and time.monotonic()-self._lastFlush > self.flushEvery
+				)
+			if flush:
+				self._lastFlush = time.monotonic()
+		if flush:
+			self.write_prometheus()
+
+	def set_gauge(self,name,labels,value,help=''):
+		with self._lock:
+			gauge = self.gauges.setdefault(name,{'help':help,'values':{}})
+			gauge['values'][tuple(sorted(labels.items()))] = value
+
+	def new_batch(self):
+		'''
+		Start counting afresh for summary(batch=True), e.g. at the start of
+		each batch in a long-lived process.
+		'''
+		with self._lock:
+			self.batch = {}
+			self.batchStarted = time.time()
+
+	def summary(self,batch=False):
+		'''
+		[{'stage':..., 'count':..., 'failed':..., 'seconds':..., 'p50':...,
+		'p90':..., 'p99':..., 'max':..., 'bytes':...}, ...] in the order the
+		stages first showed up, since the start or (batch=True) since
+		new_batch().
+		'''
+		rows = []
+		with self._lock:
+			for stage, totals in (self.batch if batch else self.stages).items():
+				durations = sorted(totals.sample)
+				outcomes = totals.outcomes
+				rows.append({
+					'stage':stage,
+					'count':totals.count,
+					'outcomes':dict(outcomes),
+					'failed':outcomes.get(FAILED,0)+outcomes.get(ERROR,0),
+					'seconds':totals.seconds,
+					'p50':percentile(durations,0.5),
+					'p90':percentile(durations,0.9),
+					'p99':percentile(durations,0.99),
+					'max':totals.max,
+					'bytes':totals.bytes
+					})
+
+		return rows
+
+	def summary_table(self,batch=False):
+		lines = [
+			"{:<18}{:>7}{:>8}{:>11}{:>9}{:>9}{:>9}{:>9}{:>11}".format(
+				'STAGE','COUNT','FAILED','TOTAL S','P50 S','P90 S','P99 S','MAX S','MB'
+				)
+			]
+		for row in self.summary(batch):
+			lines.append("{:<18}{:>7}{:>8}{:>11.2f}{:>9.3f}{:>9.3f}{:>9.3f}{:>9.3f}{:>11.1f}".format(
+				row['stage'],
+				row['count'],
+				row['failed'],
+				row['seconds'],
+				row['p50'],
+				row['p90'],
+				row['p99'],
+				row['max'],
+				row['bytes']/1024/1024
+				))
+		lines.append("WALL CLOCK {:.1f}s".format(time.time()-(self.batchStarted if batch else self.started)))
+
+		return "\n".join(lines)
+
+	def write_prometheus(self,path=None):
+		'''
+		Write the per-stage totals in the Prometheus text format. The file
+		is written next to its destination and renamed into place so the
+		collector never reads half of it.
+		'''
+		path = path or self.prometheusPath
+		if path is None:
+			return
+		job = escape(self.job)
+		lines = [
+			"# HELP rs2ia_stage_duration_seconds Time spent in each stage.",
+			"# TYPE rs2ia_stage_duration_seconds summary"
+			]
+		rows = self.summary()
+		for row in rows:
+			labels = 'job="{}",stage="{}"'.format(job,escape(row['stage']))
+			for q in QUANTILES:
+				lines.append('rs2ia_stage_duration_seconds{{{},quantile="{}"}} {}'.format(
+					labels,
+					q,
+					row['p{}'.format(int(q*100))]
+					))
+			lines.append("rs2ia_stage_duration_seconds_sum{{{}}} {}".format(labels,row['seconds']))
+			lines.append("rs2ia_stage_duration_seconds_count{{{}}} {}".format(labels,row['count']))
+		lines += [
+			"# HELP rs2ia_stage_spans_total Finished spans per stage and outcome.",
+			"# TYPE rs2ia_stage_spans_total counter"
+			]
+		for row in rows:
+			for outcome, count in row['outcomes'].items():
+				lines.append('rs2ia_stage_spans_total{{job="{}",stage="{}",outcome="{}"}} {}'.format(
+					job,
+					escape(row['stage']),
+					escape(outcome),
+					count
+					))
+		lines += [
+			"# HELP rs2ia_stage_bytes_total Bytes moved by each stage.",
+			"# TYPE rs2ia_stage_bytes_total counter"
+			]
+		for row in rows:
+			lines.append('rs2ia_stage_bytes_total{{job="{}",stage="{}"}} {}'.format(
+				job,
+				escape(row['stage']),
+				row['bytes']
+				))
+		lines += [
+			"# HELP rs2ia_run_start_timestamp_seconds When this run started.",
+			"# TYPE rs2ia_run_start_timestamp_seconds gauge",
+			'rs2ia_run_start_timestamp_seconds{{job="{}"}} {}'.format(job,self.started)
+			]
+		with self._lock:
+			gauges = [(name,gauge['help'],dict(gauge['values'])) for name, gauge in self.gauges.items()]
+		for name, help, values in gauges:
+			lines += [
+				"# HELP {} {}".format(name,help),
+				"# TYPE {} gauge".format(name)
+				]
+			for labels, value in values.items():
+				lines.append('{}{{job="{}",{}}} {}'.format(
+					name,
+					job,
+					",".join('{}="{}"'.format(k,escape(v)) for k, v in labels),
+					value
+					))
+		tempPath = path+".tmp"
+		with open(tempPath,'w') as f:
+			f.write("\n".join(lines)+"\n")
+		os.replace(tempPath,path)
+
+	def close(self):
+		self.write_prometheus()
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+def percentile(ordered,q):
+	if not ordered:
+		return 0.0
+	return ordered[min(int(round(q*(len(ordered)-1))),len(ordered)-1)]
+
+def escape(value):
+	return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+# spans go here unless configure() sets up a recorder with somewhere to
+# write them; it still keeps the totals for the summary
+_recorder = Recorder()
+
+def configure(spansPath=None,prometheusPath=None,job='rs2ia'):
+	global _recorder
+	_recorder = Recorder(spansPath,prometheusPath,job)
+	return _recorder
+
+def get_recorder():
+	return _recorder
+
+def span(stage,**labels):
+	return _recorder.span(stage,**labels)
@@ -0,0 +1,435 @@
+'''
+Send big files to archive.org with IA-S3's multipart upload, so a failed
+upload of a multi-GB file only has to resend the part that failed
+instead of starting again from byte zero.
+
+	1. POST /<identifier>/<filename>?uploads, with the item metadata as
+	   the usual x-archive-meta headers, starts an upload and gets back
+	   an UploadId
+	2. PUT ?partNumber=N&uploadId=... for each partSize slice of the
+	   file, several at once; a part that fails is retried on its own
+	3. POST ?uploadId=... with the list of part ETags puts the file
+	   together on IA's end
+
+Which parts are done is saved to a small JSON file in stateDir after
+every part:
+	{"identifier": ..., "key": ..., "size": ..., "mtime": ...,
+	 "partSize": ..., "uploadId": ..., "parts": {"1": "<etag>", ...}}
+so when a run dies, or a part runs out of retries, the next attempt at
+the same file picks up the same upload and only sends the parts that
+are missing. If the file has changed since (size or mtime), the old
+upload is abandoned and it starts over.
+
+Each part's ETag is checked against the MD5 it was sent with. The
+whole file's checksums are worked out from the same reads that hash the
+parts and go in the fingerprint index, unless the upload was resumed
+(some parts were never read this time).
+
+Files under threshold still go through internetarchive.upload() in one
+PUT each, by way of put_files() so they're checked the same way.
+
+Every request, parts and single PUTs alike, goes through the 'ia'
+adaptive limit (see ratelimit.py) and backs off with jitter when IA
+says to slow down.
+'''
+
+import base64
+import concurrent.futures
+import fingerprints
+import hashlib
+import json
+import metrics
+import os
+import ratelimit
+import rangedownload
+import re
+import requests
+import threading
+import urllib.parse
+
+from internetarchive import get_session, upload
+from internetarchive.auth import S3Auth
+from internetarchive.iarequest import S3Request
+
+S3_HOST = 's3.us.archive.org'
+DEFAULT_THRESHOLD = 256*1024*1024
+DEFAULT_PART_SIZE = 64*1024*1024
+DEFAULT_WORKERS = 4
+# S3's limits
+MIN_PART_SIZE = 5*1024*1024
+MAX_PARTS = 10000
+# how much of a part to read from disk at a time while sending it
+READ_BLOCK = 1024*1024
+
+class MultipartError(Exception):
+	def __init__(self,message,transient=False):
+		'''
+		transient: trying the upload again later might work (see
+		stageretry.py)
+		'''
+		Exception.__init__(self,message)
+		self.transient = transient
+
+class UploadGone(MultipartError):
+	# IA doesn't know the UploadId any more (it expired or was aborted)
+	def __init__(self,message):
+		MultipartError.__init__(self,message,transient=True)
+
+class MultipartUploader:
+	def __init__(
+		self,
+		threshold=DEFAULT_THRESHOLD,
+		partSize=DEFAULT_PART_SIZE,
+		workers=DEFAULT_WORKERS,
+		retries=5,
+		stateDir='.ia_multipart',
+		session=None,
+		timeout=(10,300)
+		):
+		'''
+		threshold: files this big (bytes) or bigger go up in parts
+		partSize: bytes per part; raised if a file would need more than
+			MAX_PARTS of them
+		workers: parts of one file to send at once
+		retries: attempts per request before giving up on a part
+		stateDir: where to keep the progress of unfinished uploads
+		session: an internetarchive ArchiveSession (default: a new one
+			from the usual ia config)
+		'''
+		self.threshold = threshold
+		self.partSize = max(partSize,MIN_PART_SIZE)
+		self.workers = workers
+		self.retries = retries
+		self.stateDir = stateDir
+		self.timeout = timeout
+		self._session = session
+		self._lock = threading.Lock()
+
+	@property
+	def session(self):
+		with self._lock:
+			if self._session is None:
+				self._session = get_session()
+			if not getattr(self._session,'_multipartReady',False):
+				# the library closes every connection after one request;
+				# keep them open between parts
+				self._session.headers['Connection'] = 'keep-alive'
+				adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.workers*4)
+				self._session.mount("{}//{}".format(self._session.protocol,S3_HOST),adapter)
+				self._session._multipartReady = True
+			return self._session
+
+	def is_large(self,path):
+		return bool(path) and os.path.isfile(path) and os.path.getsize(path) >= self.threshold
+
+	def part_size_for(self,size):
+		return max(self.partSize,-(-size//MAX_PARTS))
+
+	def upload(self,identifier,path,metadata=None,queueDerive=True):
+		'''
+		Upload path to the item identifier in parts, resuming an earlier
+		attempt if there is one. Returns the number of bytes sent this
+		time; raises MultipartError (or a requests exception) if it
+		doesn't make it, leaving the state behind for the next try.
+		'''
+		key = os.path.basename(path)
+		url = "{}//{}/{}/{}".format(
+			self.session.protocol,
+			S3_HOST,
+			urllib.parse.quote(identifier),
+			urllib.parse.quote(key)
+			)
+		statePath = self.state_path(identifier,key)
+		with metrics.span('ia_multipart',item=identifier,file=key) as span:
+			for attempt in range(2):
+				state = self.start(url,identifier,path,statePath,metadata,queueDerive)
+				span.labels['parts'] = -(-state['size']//state['partSize'])
+				span.labels['resumed'] = len(state['parts'])
+				try:
+					span.bytes += self.send_parts(url,path,state,statePath)
+					self.complete(url,state)
+					break
+				except UploadGone:
+					if attempt:
+						raise
+					print("ARCHIVE.ORG HAS FORGOTTEN THE UPLOAD OF {}, STARTING IT AGAIN".format(key))
+					os.remove(statePath)
+			os.remove(statePath)
+
+		return span.bytes
+
+	def start(self,url,identifier,path,statePath,metadata,queueDerive):
+		size = os.path.getsize(path)
+		mtime = os.path.getmtime(path)
+		partSize = self.part_size_for(size)
+		state = self.load_state(statePath)
+		if state is not None:
+			if (state['size'],state['mtime'],state['partSize']) == (size,mtime,partSize):
+				print("RESUMING UPLOAD OF {}: {} OF {} PARTS ALREADY SENT".format(
+					os.path.basename(path),
+					len(state['parts']),
+					-(-size//partSize)
+					))
+				return state
+			print("{} CHANGED SINCE ITS LAST UPLOAD ATTEMPT, STARTING OVER".format(path))
+			self.abort(url,state['uploadId'])
+		state = {
+			'identifier':identifier,
+			'key':os.path.basename(path),
+			'path':os.path.abspath(path),
+			'size':size,
+			'mtime':mtime,
+			'partSize':partSize,
+			'uploadId':self.initiate(url,size,metadata,queueDerive),
+			'parts':{}
+			}
+		self.save_state(statePath,state)
+
+		return state
+
+	def initiate(self,url,size,metadata,queueDerive):
+		# let the library turn the metadata into x-archive-meta headers
+		# the same way upload() does
+		headers = S3Request(
+			method='POST',
+			url=url+"?uploads",
+			headers={'x-archive-size-hint':str(size)},
+			metadata=metadata,
+			queue_derive=queueDerive,
+			access_key=self.session.access_key,
+			secret_key=self.session.secret_key
+			).prepare().headers
+		response = self.request('POST',url+"?uploads",headers=dict(headers))
+		match = re.search(r'<UploadId>([^<]+)</UploadId>',response.text)
+		if not match:
+			raise MultipartError("no UploadId in response to {}?uploads: {}".format(url,response.text[:200]))
+
+		return match.group(1)
+
+	def send_parts(self,url,path,state,statePath):
+		'''
+		Send every part that isn't in state['parts'] yet and return how
+		many bytes that was.
+		'''
+		size = state['size']
+		partSize = state['partSize']
+		missing = [
+			number for number in range(1,-(-size//partSize)+1)
+			if str(number) not in state['parts']
+			]
+		progress = rangedownload.Progress(
+			path,
+			size,
+			done=sum(min(partSize,size-(int(x)-1)*partSize) for x in state['parts']),
+			verb="Upload"
+			)
+		resumed = bool(state['parts'])
+		fd = os.open(path,os.O_RDONLY)
+		digest = fingerprints.OrderedDigest(fd)
+		try:
+			def send_part(number):
+				offset = (number-1)*partSize
+				length = min(partSize,size-offset)
+				with metrics.span('ia_part',item=state['identifier'],part=number) as span:
+					md5 = hashlib.md5()
+					for start in range(offset,offset+length,READ_BLOCK):
+						block = os.pread(fd,min(READ_BLOCK,offset+length-start),start)
+						md5.update(block)
+						digest.add(start,block)
+					response = self.request(
+						'PUT',
+						url,
+						params={'partNumber':number,'uploadId':state['uploadId']},
+						headers={
+							'Content-MD5':base64.b64encode(md5.digest()).decode(),
+							'Content-Length':str(length)
+							},
+						body=lambda: _PartReader(fd,offset,length)
+						)
+					if not etag_matches(response,md5.hexdigest()):
+						raise MultipartError("part {} of {} reached archive.org with a different md5".format(number,path),transient=True)
+					span.bytes = length
+				with self._lock:
+					state['parts'][str(number)] = response.headers.get('ETag',md5.hexdigest())
+					self._write_state(statePath,state)
+				progress.add(length)
+				return length
+
+			with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+				futures = [executor.submit(send_part,x) for x in missing]
+				sent = 0
+				errors = []
+				# let the other parts finish (and get saved) even if one fails
+				for future in concurrent.futures.as_completed(futures):
+					try:
+						sent += future.result()
+					except Exception as e:
+						errors.append(e)
+			if not errors and not resumed:
+				fingerprints.remember(path,digest)
+		finally:
+			os.close(fd)
+		if errors:
+			gone = [x for x in errors if isinstance(x,UploadGone)]
+			raise (gone or errors)[0]
+
+		return sent
+
+	def complete(self,url,state):
+		parts = "".join(
+			"<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>".format(number,state['parts'][str(number)])
+			for number in sorted(int(x) for x in state['parts'])
+			)
+		response = self.request(
+			'POST',
+			url,
+			params={'uploadId':state['uploadId']},
+			headers={'Content-Type':'application/xml'},
+			body=lambda: "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format(parts).encode()
+			)
+		# S3 can answer 200 and still put an error in the body
+		if '<Error>' in response.text:
+			if 'NoSuchUpload' in response.text:
+				raise UploadGone(response.text[:200])
+			raise MultipartError("completing {} failed: {}".format(url,response.text[:200]))
+
+	def abort(self,url,uploadId):
+		try:
+			self.request('DELETE',url,params={'uploadId':uploadId})
+		except Exception as e:
+			# it'll expire on its own eventually
+			print("COULDN'T ABORT THE OLD UPLOAD OF {}: {}".format(url,e))
+
+	def request(self,method,url,params=None,headers=None,body=None):
+		'''
+		One S3 request, retried with backoff on connection errors and on
+		5xx/429 (IA's "slow down"). body is a function that makes a fresh
+		request body for each attempt.
+		'''
+		size = int((headers or {}).get('Content-Length',0)) or None
+		for attempt in range(self.retries):
+			try:
+				with ratelimit.slot('ia',size,method) as slot:
+					response = self.session.request(
+						method,
+						url,
+						params=params,
+						headers=headers,
+						data=body() if body is not None else None,
+						auth=S3Auth(self.session.access_key,self.session.secret_key),
+						timeout=self.timeout
+						)
+					if ratelimit.is_throttle(response.status_code,response.text):
+						slot.throttled()
+				if response.status_code < 300:
+					return response
+				if response.status_code == 404 and 'NoSuchUpload' in response.text:
+					raise UploadGone(response.text[:200])
+				if response.status_code < 500 and response.status_code != 429:
+					raise MultipartError("{} {} returned HTTP {}: {}".format(
+						method,
+						url,
+						response.status_code,
+						response.text[:200]
+						))
+				error = "HTTP {}".format(response.status_code)
+			except requests.exceptions.RequestException as e:
+				error = e
+			if attempt+1 == self.retries:
+				raise MultipartError("{} {} failed after {} tries: {}".format(method,url,self.retries,error),transient=True)
+			print("RETRYING {} {}: {}".format(method,_describe(url,params),error))
+			ratelimit.backoff('ia',attempt,cap=30)
+
+	def state_path(self,identifier,key):
+		return os.path.join(
+			self.stateDir,
+			urllib.parse.quote("{}/{}".format(identifier,key),safe='')+".json"
+			)
+
+	def load_state(self,statePath):
+		if not os.path.isfile(statePath):
+			return None
+		try:
+			with open(statePath) as f:
+				return json.load(f)
+		except ValueError:
+			print("UPLOAD STATE {} IS DAMAGED, STARTING OVER".format(statePath))
+			return None
+
+	def save_state(self,statePath,state):
+		with self._lock:
+			self._write_state(statePath,state)
+
+	def _write_state(self,statePath,state):
+		os.makedirs(self.stateDir,exist_ok=True)
+		tempPath = statePath+".tmp"
+		with open(tempPath,'w') as f:
+			json.dump(state,f)
+		os.replace(tempPath,statePath)
+
+class _PartReader:
+	'''
+	File-like view of one part of the file, so requests can stream it
+	without the whole part being read into memory first.
+	'''
+	def __init__(self,fd,offset,length):
+		self.fd = fd
+		self.offset = offset
+		self.end = offset+length
+
+	def __len__(self):
+		return self.end-self.offset
+
+	def read(self,size=-1):
+		if size is None or size < 0:
+			size = self.end-self.offset
+		data = os.pread(self.fd,min(size,self.end-self.offset),self.offset)
+		self.offset += len(data)
+		return data
+
+def put_files(identifier,paths,metadata,headers=None,retries=4):
+	'''
+	Upload paths to identifier with internetarchive.upload(), hashing
+	each file as it's read, one file at a time through the 'ia' limit.
+	A file IA throttles is backed off and sent again on its own, up to
+	retries times; anything else is raised as it comes. Returns
+	[(path, fingerprints.HashingFile, response), ...].
+	'''
+	results = []
+	for path in paths:
+		for attempt in range(retries):
+			# upload() closes what it's sent, so a fresh one each time
+			body = fingerprints.HashingFile(open(path,'rb'))
+			try:
+				with ratelimit.slot('ia',os.path.getsize(path),'upload') as slot:
+					try:
+						[response] = upload(identifier,files=[body],metadata=metadata,headers=headers or {})
+						break
+					except Exception as e:
+						if attempt+1 == retries or not ratelimit.is_throttle_error(e):
+							raise
+						slot.throttled()
+						error = e
+			finally:
+				body.close()
+			print("RETRYING UPLOAD OF {}: {}".format(path,error))
+			ratelimit.backoff('ia',attempt)
+		results.append((path,body,response))
+
+	return results
+
+def etag_matches(response,md5):
+	'''
+	IA-S3 answers a PUT with the MD5 of what it got as the ETag, so an
+	upload can be checked without reading the file again. A missing or
+	non-MD5 ETag can't be checked and counts as a match.
+	'''
+	etag = response.headers.get('ETag','').strip('"')
+	if not re.fullmatch(r'[0-9a-f]{32}',etag):
+		return True
+	return etag == md5
+
+def _describe(url,params):
+	if params and 'partNumber' in params:
+		return "{} PART {}".format(url,params['partNumber'])
+	return url
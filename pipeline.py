@@ -0,0 +1,93 @@
+'''
+A small staged producer/consumer pipeline: each stage has its own pool
+of worker threads, and stages are joined by bounded queues so a fast
+stage can only get `queueSize` items ahead of the one after it.
+
+e.g. download -> transcode -> upload, where file N+1 downloads while
+file N transcodes and file N-1 uploads.
+'''
+
+import queue
+import threading
+
+# marks the end of the input for one worker
+_DONE = object()
+
+class Stage:
+	def __init__(self,name,function,workers=1):
+		'''
+		function takes an item and returns the item to hand to the next
+		stage, or None to drop it (e.g. it failed or needs no more work).
+		'''
+		self.name = name
+		self.function = function
+		self.workers = workers
+
+class Pipeline:
+	def __init__(self,stages,queueSize=2,onError=None):
+		'''
+		onError(stageName, item, exception) is called when a stage raises;
+		the item is dropped from the pipeline either way.
+		'''
+		self.stages = stages
+		self.queueSize = queueSize
+		self.onError = onError
+
+	def run(self,items):
+		'''
+		Push every item through every stage and return what comes out the
+		end, in whatever order the items finish.
+		'''
+		queues = [queue.Queue(maxsize=self.queueSize) for stage in self.stages]
+		results = queue.Queue()
+		threads = []
+		for index, stage in enumerate(self.stages):
+			inbox = queues[index]
+			if index+1 < len(self.stages):
+				outbox = queues[index+1]
+				nextWorkers = self.stages[index+1].workers
+			else:
+				outbox = results
+				nextWorkers = 0
+			# the last worker of a stage to finish tells the next stage to stop
+			remaining = [stage.workers]
+			lock = threading.Lock()
+			for n in range(stage.workers):
+				thread = threading.Thread(
+					target=self._work,
+					args=(stage,inbox,outbox,remaining,lock,nextWorkers),
+					name="{}-{}".format(stage.name,n),
+					daemon=True
+					)
+				thread.start()
+				threads.append(thread)
+
+		for item in items:
+			queues[0].put(item)
+		for n in range(self.stages[0].workers):
+			queues[0].put(_DONE)
+		for thread in threads:
+			thread.join()
+
+		return list(results.queue)
+
+	def _work(self,stage,inbox,outbox,remaining,lock,nextWorkers):
+		while True:
+			item = inbox.get()
+			if item is _DONE:
+				break
+			try:
+				result = stage.function(item)
+			except Exception as e:
+				print("{} FAILED: {}".format(stage.name.upper(),e))
+				if self.onError is not None:
+					self.onError(stage.name,item,e)
+				continue
+			if result is not None:
+				outbox.put(result)
+		with lock:
+			remaining[0] -= 1
+			last = remaining[0] == 0
+		if last:
+			for n in range(nextWorkers):
+				outbox.put(_DONE)
@@ -0,0 +1,93 @@
+'''
+Check what's already on archive.org before uploading, so re-runs over
+overlapping collections only send files that are missing or changed.
+
+All the identifiers for a batch are looked up up front (concurrently)
+against the IA metadata API, https://archive.org/metadata/<identifier>,
+which lists every file in an item with its size and md5. Point
+metadataURL somewhere else to check against a local stand-in.
+
+Local md5s come from the fingerprint index where it has them, so a file
+that was hashed on an earlier run (or on its way down from Drive) isn't
+read again.
+'''
+
+import concurrent.futures
+import fingerprints
+import os
+import requests
+
+IA_METADATA_URL = "https://archive.org/metadata/{}"
+
+class Preflight:
+	def __init__(self,metadataURL=IA_METADATA_URL,workers=8,timeout=(5,60)):
+		self.metadataURL = metadataURL
+		self.workers = workers
+		self.timeout = timeout
+		# {identifier: {filename: {'size':..., 'md5':...}}}, or None for
+		# items we couldn't check
+		self.remoteFiles = {}
+		self.session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+		self.session.mount("https://",adapter)
+		self.session.mount("http://",adapter)
+
+	def check(self,identifiers):
+		'''
+		Fetch the file listing of every identifier in one go.
+		'''
+		identifiers = [x for x in set(identifiers) if x not in (None,'')]
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+			listings = executor.map(self.fetch_item_files,identifiers)
+			for identifier, files in zip(identifiers,listings):
+				self.remoteFiles[identifier] = files
+		existing = [x for x in identifiers if self.remoteFiles.get(x)]
+		print("PREFLIGHT: {} OF {} ITEMS ALREADY EXIST ON ARCHIVE.ORG".format(
+			len(existing),
+			len(identifiers)
+			))
+
+	def fetch_item_files(self,identifier):
+		try:
+			response = self.session.get(
+				self.metadataURL.format(identifier),
+				timeout=self.timeout
+				)
+			response.raise_for_status()
+			item = response.json()
+		except (requests.exceptions.RequestException,ValueError) as e:
+			print("PREFLIGHT CHECK FAILED FOR {}: {}".format(identifier,e))
+			return None
+		# an item that doesn't exist comes back as {}
+		files = {}
+		for _file in item.get('files',[]):
+			files[_file.get('name')] = {
+				'size':_file.get('size'),
+				'md5':_file.get('md5')
+				}
+
+		return files
+
+	def files_to_send(self,identifier,paths):
+		'''
+		Return the subset of local paths that are missing from the item or
+		differ from what's there. Sizes are compared first so we only hash
+		files that might be identical.
+		'''
+		remote = self.remoteFiles.get(identifier)
+		if not remote:
+			# new item, or we couldn't tell: send everything
+			return list(paths)
+		toSend = []
+		for path in paths:
+			if path is None:
+				continue
+			remoteFile = remote.get(os.path.basename(path))
+			if remoteFile is None:
+				toSend.append(path)
+			elif str(remoteFile['size']) != str(os.path.getsize(path)):
+				toSend.append(path)
+			elif remoteFile['md5'] != fingerprints.md5_of(path):
+				toSend.append(path)
+
+		return toSend
@@ -0,0 +1,174 @@
+'''
+Optional CPU and memory profiling for a run.
+
+CPU: cProfile, in the main thread and in every thread started while it's
+on (the worker pools, pipeline stages, etc.), merged into one pstats dump
+at <prefix>.prof. That's what snakeviz, flameprof, gprof2dot and the
+like read, e.g.
+	flameprof rs2ia_20240101-120000.prof > flame.svg
+A text summary of the top functions goes to <prefix>_cpu.txt.
+
+Memory: tracemalloc, with a snapshot at the start and one at the end
+dumped to <prefix>_start.tracemalloc and <prefix>_end.tracemalloc
+(compare them with tracemalloc.Snapshot.load()), and a checkpoint after
+each asset appended to <prefix>_memory.jsonl:
+	{"label": "1234", "current": ..., "peak": ..., "growth": [...]}
+Memory that keeps climbing from one asset to the next is a leak. growth
+is the biggest differences from the start snapshot, by line; snapshots
+are slow with a lot in memory, so it's only filled in every
+snapshotEvery checkpoints (and at the end).
+'''
+
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+
+class Profiler:
+	def __init__(self,prefix,cpu=True,memory=False,frames=1,top=10,snapshotEvery=25):
+		'''
+		frames: how much of the stack tracemalloc keeps for each allocation
+		top: how many lines to report in each memory checkpoint
+		snapshotEvery: how many checkpoints between growth reports
+		'''
+		self.prefix = prefix
+		self.cpu = cpu
+		self.memory = memory
+		self.frames = frames
+		self.top = top
+		self.snapshotEvery = snapshotEvery
+		self._checkpoints = 0
+		self._profiles = []
+		self._lock = threading.Lock()
+		self._startSnapshot = None
+		self._memoryLog = None
+
+	def start(self):
+		if self.cpu:
+			# a thread's profile has to be switched on from inside it, so
+			# catch each new thread as it starts
+			threading.setprofile(self._profile_thread)
+			self._profile_thread()
+		if self.memory:
+			tracemalloc.start(self.frames)
+			self._startSnapshot = self._snapshot()
+			self._startSnapshot.dump(self.prefix+"_start.tracemalloc")
+			self._memoryLog = open(self.prefix+"_memory.jsonl",'a')
+			self.checkpoint('start')
+
+	def _profile_thread(self,*args):
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:
+			# from 3.12 one profile already sees every thread
+			return
+		with self._lock:
+			self._profiles.append(profile)
+
+	def checkpoint(self,label,growth=False):
+		'''
+		Note how much memory is in use now, e.g. after each asset.
+		'''
+		if not self.memory or self._memoryLog is None:
+			return
+		with self._lock:
+			self._checkpoints += 1
+			growth = growth or self._checkpoints % self.snapshotEvery == 0
+		current, peak = tracemalloc.get_traced_memory()
+		if growth:
+			growth = self._snapshot().compare_to(self._startSnapshot,'lineno')[:self.top]
+		else:
+			growth = []
+		record = {
+			'time':time.time(),
+			'label':str(label),
+			'current':current,
+			'peak':peak,
+			'growth':[
+				{'where':str(stat.traceback[0]),'size_diff':stat.size_diff,'count_diff':stat.count_diff}
+				for stat in growth
+				]
+			}
+		with self._lock:
+			self._memoryLog.write(json.dumps(record)+"\n")
+			self._memoryLog.flush()
+
+	def stop(self):
+		'''
+		Write everything out and return the list of files written.
+		'''
+		written = []
+		if self.cpu:
+			threading.setprofile(None)
+			with self._lock:
+				profiles = list(self._profiles)
+			for profile in profiles:
+				profile.disable()
+			stats = None
+			for profile in profiles:
+				try:
+					if stats is None:
+						stats = pstats.Stats(profile)
+					else:
+						stats.add(profile)
+				except TypeError:
+					# a thread that started but never ran any Python
+					continue
+			if stats is not None:
+				stats.dump_stats(self.prefix+".prof")
+				summary = io.StringIO()
+				stats.stream = summary
+				stats.sort_stats('cumulative').print_stats(40)
+				stats.sort_stats('tottime').print_stats(40)
+				with open(self.prefix+"_cpu.txt",'w') as f:
+					f.write(summary.getvalue())
+				written += [self.prefix+".prof",self.prefix+"_cpu.txt"]
+		if self.memory and self._memoryLog is not None:
+			self.checkpoint('end',growth=True)
+			self._snapshot().dump(self.prefix+"_end.tracemalloc")
+			tracemalloc.stop()
+			with self._lock:
+				self._memoryLog.close()
+				self._memoryLog = None
+			written += [
+				self.prefix+"_start.tracemalloc",
+				self.prefix+"_end.tracemalloc",
+				self.prefix+"_memory.jsonl"
+				]
+
+		return written
+
+	def _snapshot(self):
+		# leave out tracemalloc's own bookkeeping
+		return tracemalloc.take_snapshot().filter_traces([
+			tracemalloc.Filter(False,tracemalloc.__file__),
+			tracemalloc.Filter(False,"<frozen importlib._bootstrap>")
+			])
+
+_profiler = None
+
+def start(prefix,cpu=True,memory=False):
+	global _profiler
+	_profiler = Profiler(prefix,cpu=cpu,memory=memory)
+	_profiler.start()
+	return _profiler
+
+def checkpoint(label):
+	# no-op unless a profiler with memory tracking is running
+	if _profiler is not None:
+		_profiler.checkpoint(label)
+
+def stop():
+	global _profiler
+	if _profiler is None:
+		return []
+	written = _profiler.stop()
+	_profiler = None
+	return written
+
+def default_prefix(name):
+	return "{}_{}".format(name,time.strftime("%Y%m%d-%H%M%S"))
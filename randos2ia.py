@@ -3,24 +3,40 @@
 This script (or maybe scripts eventually?) will be used to transfer
 assets and metadata from our local ResourceSpace to Internet Archive.
 """
+import argparse
 import ast
+import concurrent.futures
 import csv
+import datetime
+import drivesync
+import fingerprints
 from google_drive_downloader import GoogleDriveDownloader # from https://github.com/ndrplz/google-drive-downloader/blob/master/google_drive_downloader/google_drive_downloader.py
 import hashlib
-from internetarchive import upload
 import io
+import metrics
+import multipart
 import os
 import pickle
+import pipeline
+import profiling
+import rangedownload
+import ratelimit
 import re
 import requests
+import spool
 import squarify
+import stageretry
+import staging
 import subprocess
 import sys
+import threading
 import time
 
 from googleapiclient.discovery import build
+import google_auth_httplib2
+import httplib2
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from googleapiclient.http import MediaIoBaseDownload
 
 
@@ -48,6 +64,7 @@ class Asset:
 		localFilepath = None,
 		mediaType = None,
 		assetMetadata = {},
+		uploader = None
 		):
 		self.localFilepath = localFilepath
 		self.squarePixelFilepath = None
@@ -62,6 +79,8 @@ class Asset:
 		self.notes = None
 		self.collection = ['stream_only','pacificfilmarchive'] # collection can be an array
 		#self.license = 'https://creativecommons.org/licenses/by-nc-nd/4.0/'
+		# a multipart.MultipartUploader for files too big for one PUT
+		self.uploader = uploader
 
 	def post_to_ia(self):
 		'''
@@ -72,6 +91,7 @@ class Asset:
 			ResourceSpace search.
 		For more info: archive.org Python Library: https://archive.org/services/docs/api/internetarchive/quickstart.html#metadata
 			and archive.org metadata schema: https://archive.org/services/docs/api/metadata-schema/index.html
+		Returns True, or raises stageretry.StageError if it didn't make it.
 		'''
 		if self.mediaType == 'mp4':
 			ia_mediatype = 'movies'
@@ -130,18 +150,52 @@ class Asset:
 		# from the ia package documentation:
 		# 	r = upload('<identifier>', files=['foo.txt', 'bar.mov'], metadata=md)
 		# archive.org Python Library, 'uploading': https://archive.org/services/docs/api/internetarchive/quickstart.html#uploading
-		result = False
-		uploaded = "Didn't get to upload"
-		try:
-			r = upload(self.identifier, files=self.squarePixelFilepath, metadata=md)
-			if r[0].status_code == 200:
-				uploaded = "Uploaded"
-				result = True
-		except Exception as e:
-			print(e)
-			uploaded = "Upload failed"
-		print(uploaded)
-		return result
+		with metrics.span('ia_upload',item=self.identifier) as span:
+			if self.squarePixelFilepath and os.path.isfile(self.squarePixelFilepath):
+				span.bytes = os.path.getsize(self.squarePixelFilepath)
+			try:
+				if self.uploader is not None and self.uploader.is_large(self.squarePixelFilepath):
+					# sent in parts that are retried and resumed on their own
+					print("UPLOADING {} IN PARTS".format(self.squarePixelFilepath))
+					self.uploader.upload(self.identifier,self.squarePixelFilepath,metadata=md)
+				else:
+					headers = {}
+					known = fingerprints.lookup(self.squarePixelFilepath)
+					if known is not None:
+						# e.g. a file that didn't need transcoding, hashed
+						# on its way down from Drive: IA checks it on arrival
+						headers['Content-MD5'] = known['md5']
+					[(path,body,response)] = multipart.put_files(
+						self.identifier,
+						[self.squarePixelFilepath],
+						md,
+						headers=headers
+						)
+					if response.status_code != 200:
+						raise stageretry.StageError(
+							'ia_upload',
+							"archive.org returned HTTP {}".format(response.status_code),
+							response.status_code >= 500
+							)
+					if body.complete() and not multipart.etag_matches(response,body.digest.md5):
+						# it got mangled on the way; sending it again should do
+						raise stageretry.StageError(
+							'ia_upload',
+							"archive.org got a different md5 for {}".format(path),
+							transient=True
+							)
+			except Exception as e:
+				print(e)
+				print("Upload failed")
+				span.outcome = metrics.FAILED
+				span.labels['error'] = stageretry.describe(e)
+				raise stageretry.StageError(
+					'ia_upload',
+					stageretry.describe(e),
+					stageretry.is_transient(e)
+					) from e
+			print("Uploaded")
+			return True
 
 	def get_core_metadata(self):
 		'''
@@ -210,6 +264,9 @@ class Asset:
 ###### THIS SECTION DEALS WITH THE ACTUAL FILES FROM DRIVE
 ######
 
+DRIVE_API_ENDPOINT = "https://www.googleapis.com"
+DRIVE_MEDIA_URL = "{}/drive/v3/files/{}?alt=media&supportsAllDrives=true"
+
 SCOPES = [
 	'https://www.googleapis.com/auth/documents',
 	'https://www.googleapis.com/auth/drive',
@@ -218,37 +275,198 @@ SCOPES = [
 	]
 
 
-def login():
-	# Do some login stuff
-	# Return live services for Docs and Drive APIs
-	creds = None
+class DriveClient:
+	'''
+	One authenticated Drive v3 client for the whole run, shared by every
+	listing and download (and every pipeline thread).
+	- Credentials are loaded from secrets/token.pickle (or the browser
+		login flow) and the service is built the first time it's needed.
+	- The service object is shared, but httplib2 isn't thread-safe, so each
+		thread gets its own AuthorizedHttp to execute requests with.
+	- A background thread refreshes the token before it expires, so
+		workers don't stall (or race each other) refreshing it mid-batch.
+	'''
+	# refresh this long before the token actually expires
+	refreshMargin = 5*60
+	# False when nobody's there to log in in a browser (--daemon); then
+	# there has to be a token that's valid or can be refreshed
+	interactive = True
 
-	if os.path.exists('secrets/token.pickle'):
-		with open('secrets/token.pickle', 'rb') as token:
-			creds = pickle.load(token)
-	# If there are no (valid) credentials available, let the user log in.
-	if not creds or not creds.valid:
-		if creds and creds.expired and creds.refresh_token:
-			creds.refresh(Request())
-		else:
-			flow = InstalledAppFlow.from_client_secrets_file(
-				'secrets/credentials.json', SCOPES)
-			creds = flow.run_local_server(port=0)
-		# Save the credentials for the next run
-		with open('secrets/token.pickle', 'wb') as token:
+	def __init__(
+		self,
+		tokenPath='secrets/token.pickle',
+		secretsPath='secrets/credentials.json',
+		credentials=None,
+		apiEndpoint=DRIVE_API_ENDPOINT
+		):
+		'''
+		Pass credentials to use those instead of the token file, and
+		apiEndpoint to talk to something other than www.googleapis.com
+		(e.g. a local stand-in).
+		'''
+		self.tokenPath = tokenPath
+		self.secretsPath = secretsPath
+		self.apiEndpoint = apiEndpoint
+		self.creds = credentials
+		self._service = None
+		self._lock = threading.RLock()
+		self._local = threading.local()
+		self._refresher = None
+		self._stop = threading.Event()
+
+	def load_credentials(self):
+		creds = None
+
+		if os.path.exists(self.tokenPath):
+			with open(self.tokenPath, 'rb') as token:
+				creds = pickle.load(token)
+		# If there are no (valid) credentials available, let the user log in.
+		if not creds or not creds.valid:
+			if creds and creds.expired and creds.refresh_token:
+				creds.refresh(Request())
+			elif not self.interactive:
+				raise RuntimeError("no usable Google token in {}; run randos2ia "
+					"once by hand to log in and save one".format(self.tokenPath))
+			else:
+				flow = InstalledAppFlow.from_client_secrets_file(
+					self.secretsPath, SCOPES)
+				creds = flow.run_local_server(port=0)
+			# Save the credentials for the next run
+			self.save_credentials(creds)
+
+		return creds
+
+	def save_credentials(self,creds):
+		with open(self.tokenPath, 'wb') as token:
 			pickle.dump(creds, token)
 
-	g_docs = build('docs', 'v1', credentials=creds)
-	g_drive = build('drive','v3',credentials=creds)
+	@property
+	def service(self):
+		with self._lock:
+			if self._service is None:
+				if self.creds is None:
+					self.creds = self.load_credentials()
+				# only Drive is used, so don't build the Docs service
+				self._service = build(
+					'drive',
+					'v3',
+					credentials=self.creds,
+					cache_discovery=False,
+					client_options={'api_endpoint':self.apiEndpoint+'/drive/v3/'}
+					)
+				self._start_refresher()
+		return self._service
 
-	return g_docs, g_drive
+	def files(self):
+		return self.service.files()
 
-def get_drive_file_info(folder_id,*fields):
-	# *fields should be a list of fields required for whatever you're doing
-	g_docs, g_drive = login()
-	page_token = None
+	def http(self):
+		'''
+		This thread's own authorized http object.
+		'''
+		self.service
+		if getattr(self._local,'http',None) is None:
+			self._local.http = google_auth_httplib2.AuthorizedHttp(
+				self.creds,
+				http=httplib2.Http()
+				)
+		return self._local.http
 
-	print(fields)
+	def execute(self,request,retries=4):
+		'''
+		Run a googleapiclient request with this thread's http, through
+		the 'drive' limit, backing off and trying again while Drive is
+		rate limiting us.
+		'''
+		for attempt in range(retries):
+			try:
+				with ratelimit.slot('drive',operation=getattr(request,'methodId',None)):
+					return request.execute(http=self.http())
+			except Exception as e:
+				if attempt+1 == retries or not ratelimit.is_throttle_error(e):
+					raise
+				print("DRIVE THROTTLED A REQUEST, BACKING OFF: {}".format(e))
+			ratelimit.backoff('drive',attempt)
+
+	def media_url(self,file_id):
+		return DRIVE_MEDIA_URL.format(self.apiEndpoint,file_id)
+
+	def session(self):
+		'''
+		A requests session carrying our credentials, for talking to the
+		Drive REST API directly (e.g. ranged media downloads).
+		'''
+		self.service
+		with self._lock:
+			if getattr(self,'_session',None) is None:
+				self._session = AuthorizedSession(self.creds)
+				adapter = requests.adapters.HTTPAdapter(pool_maxsize=32)
+				self._session.mount("https://",adapter)
+		return self._session
+
+	def _start_refresher(self):
+		if self._refresher is None and getattr(self.creds,'refresh_token',None):
+			self._refresher = threading.Thread(
+				target=self._refresh_loop,
+				name='drive-token-refresh',
+				daemon=True
+				)
+			self._refresher.start()
+
+	def _refresh_loop(self):
+		while not self._stop.is_set():
+			wait = self.refreshMargin
+			expiry = self.creds.expiry
+			if expiry is not None:
+				# creds.expiry is a naive UTC datetime
+				untilExpiry = (expiry - datetime.datetime.utcnow()).total_seconds()
+				wait = max(untilExpiry - self.refreshMargin,0)
+			if self._stop.wait(wait):
+				break
+			try:
+				with self._lock:
+					self.creds.refresh(Request())
+					self.save_credentials(self.creds)
+			except Exception as e:
+				print("COULDN'T REFRESH GOOGLE CREDENTIALS: {}".format(e))
+				self._stop.wait(60)
+
+	def close(self):
+		self._stop.set()
+
+_driveClient = None
+_driveClientLock = threading.Lock()
+
+def get_drive_client():
+	# the one DriveClient every listing and download shares
+	global _driveClient
+	with _driveClientLock:
+		if _driveClient is None:
+			_driveClient = DriveClient()
+	return _driveClient
+
+FOLDER_MIME_TYPE = drivesync.FOLDER_MIME_TYPE
+# what Drive usually calls each media type we upload; files are picked
+# by extension, this just helps Drive find them
+MEDIA_MIME_TYPES = {
+	'mp4':['video/mp4'],
+	'mp3':['audio/mpeg','audio/mp3']
+	}
+
+def drive_query_string(text):
+	# quote a value for a Drive q= query
+	return "'{}'".format(text.replace('\\','\\\\').replace("'","\\'"))
+
+def get_drive_file_info(folder_id,*fields,query=None,pageSize=1000):
+	'''
+	List the files in a Drive folder as {file id: {'name':..., field:...}}.
+	*fields are the extra file fields to ask for (e.g. 'size'); only
+	those, the id and the name come back. query is an extra Drive search
+	clause (e.g. "mimeType = 'video/mp4'") so the filtering happens on
+	Drive's end instead of ours.
+	'''
+	g_drive = get_drive_client()
+	page_token = None
 
 	print(folder_id)
 	print("* "*50)
@@ -260,49 +478,239 @@ def get_drive_file_info(folder_id,*fields):
 		queryFields = 'nextPageToken, files(id, name, {})'.format(', '.join(fields))
 	else:
 		queryFields = 'nextPageToken, files(*)'
-	while True:
-		query = "'{}' in parents".format(folder_id)
-		print(query)
-		response = g_drive.files().list(q=query,
-			spaces='drive',
-			fields=queryFields,
-			pageToken=page_token,
-			supportsAllDrives='true',
-			includeItemsFromAllDrives='true').execute()
-		# print(response)
-
-		for _file in response.get('files', []):
-			file_id = _file.get('id')
-			name = _file.get('name')
-			response_dict[file_id] = {}
-			response_dict[file_id]['name'] = name
-			for field in fields:
-				response_dict[file_id][field] = _file.get(field)
-			
-
-		page_token = response.get('nextPageToken', None)
-		if page_token is None:
-			break
+	q = "{} in parents and trashed = false".format(drive_query_string(folder_id))
+	if query:
+		q += " and ({})".format(query)
+	with metrics.span('drive_list',folder=folder_id) as span:
+		while True:
+			request = g_drive.files().list(q=q,
+				spaces='drive',
+				fields=queryFields,
+				pageSize=pageSize,
+				pageToken=page_token,
+				supportsAllDrives='true',
+				includeItemsFromAllDrives='true')
+			response = g_drive.execute(request)
+
+			for _file in response.get('files', []):
+				file_id = _file.get('id')
+				name = _file.get('name')
+				response_dict[file_id] = {}
+				response_dict[file_id]['name'] = name
+				for field in fields:
+					response_dict[file_id][field] = _file.get(field)
+
+			page_token = response.get('nextPageToken', None)
+			if page_token is None:
+				break
+		span.labels['files'] = len(response_dict)
 
 	return response_dict
 
-def get_file_from_drive(file_id,name):
-	_, g_drive = login()
-	temp_path = os.path.join('temp_vids',name)
+def has_extension(name,mediaType):
+	return name.lower().endswith(mediaType.lower())
 
-	request = g_drive.files().get_media(fileId=file_id,supportsAllDrives=True)
-	fh = io.FileIO(temp_path, mode='wb')
-	downloader = MediaIoBaseDownload(fh, request)
-	done = False
+def media_filter(mediaType,nameContains=None):
+	'''
+	The same test list_drive_media asks Drive to do, as a function of a
+	file's details, for files we hear about some other way.
+	'''
+	def accepts(_file):
+		name = _file.get('name') or ''
+		if nameContains and nameContains.lower() not in name.lower():
+			return False
+		return has_extension(name,mediaType)
 
-	while done is False:
-		status, done = downloader.next_chunk()
-		print("Download %d%%." % int(status.progress() * 100))
+	return accepts
 
-	if os.path.isfile(temp_path):
-		return temp_path
-	else:
-		return False
+def list_drive_media(
+	folders,
+	mediaType,
+	nameContains=None,
+	recursive=False,
+	workers=4,
+	seen=None
+	):
+	'''
+	List the mediaType files in several Drive folders at once (and, if
+	recursive, in every folder under them), asking Drive for only those
+	files and only the fields we use. Returns {file id: {'name', 'size',
+	'md5Checksum', 'mimeType', 'folder'}}. Every folder listed is added
+	to the set seen, if one is given.
+	'''
+	# by name as well as mime type: Drive labels some .mp4s
+	# application/octet-stream or video/quicktime
+	clauses = [" or ".join(
+		["mimeType = {}".format(drive_query_string(x)) for x in MEDIA_MIME_TYPES.get(mediaType,[])]
+		+ ["name contains {}".format(drive_query_string("."+mediaType))]
+		)]
+	if nameContains:
+		clauses.append("name contains {}".format(drive_query_string(nameContains)))
+	query = " and ".join("({})".format(x) for x in clauses if x)
+	if recursive:
+		# folders have to come back too so we can walk into them
+		query = "({}) or mimeType = {}".format(
+			query or "trashed = false",
+			drive_query_string(FOLDER_MIME_TYPE)
+			)
+
+	files = {}
+	if seen is None:
+		seen = set()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		pending = {}
+		for folder in folders:
+			if folder not in seen:
+				seen.add(folder)
+				pending[executor.submit(
+					get_drive_file_info,
+					folder,
+					'size','md5Checksum','mimeType',
+					query=query
+					)] = folder
+		while pending:
+			done, _ = concurrent.futures.wait(
+				pending,
+				return_when=concurrent.futures.FIRST_COMPLETED
+				)
+			for future in done:
+				folder = pending.pop(future)
+				for file_id, details in future.result().items():
+					if details.get('mimeType') == FOLDER_MIME_TYPE:
+						if recursive and file_id not in seen:
+							seen.add(file_id)
+							pending[executor.submit(
+								get_drive_file_info,
+								file_id,
+								'size','md5Checksum','mimeType',
+								query=query
+								)] = file_id
+						continue
+					# Drive's filter is loose (prefix matching on names);
+					# the extension is what counts
+					if not has_extension(details['name'],mediaType):
+						continue
+					details['folder'] = folder
+					files[file_id] = details
+
+	return files
+
+def get_file_from_drive(
+	file_id,
+	name,
+	size=None,
+	md5Checksum=None,
+	chunkSize=rangedownload.DEFAULT_CHUNK_SIZE,
+	connections=rangedownload.DEFAULT_CONNECTIONS
+	):
+	'''
+	Download a Drive file to temp_vids. If we know its size (from the
+	listing), it's fetched as several byte ranges in parallel and checked
+	against Drive's md5Checksum; otherwise (e.g. Google Docs, which have
+	no size) it falls back to a single-stream MediaIoBaseDownload.
+	Either way the file's checksums are worked out as it's written and
+	go in the fingerprint index.
+	'''
+	g_drive = get_drive_client()
+	temp_path = staged_path(file_id,name)
+	os.makedirs(os.path.dirname(temp_path),exist_ok=True)
+
+	with metrics.span('drive_download',item=name) as span:
+		if size not in (None,''):
+			rangedownload.fetch(
+				g_drive.session(),
+				g_drive.media_url(file_id),
+				temp_path,
+				int(size),
+				chunkSize=chunkSize,
+				connections=connections,
+				expectedMD5=md5Checksum
+				)
+		else:
+			request = g_drive.files().get_media(fileId=file_id,supportsAllDrives=True)
+			# MediaIoBaseDownload sends its chunk requests with request.http
+			request.http = g_drive.http()
+			with fingerprints.HashingFile(io.FileIO(temp_path, mode='wb')) as fh:
+				downloader = MediaIoBaseDownload(fh, request, chunksize=chunkSize)
+				done = False
+				lastReported = 0
+
+				while done is False:
+					status, done = downloader.next_chunk()
+					# every 10%, not every chunk
+					percent = int(status.progress() * 100)
+					if percent >= lastReported+10 or done:
+						lastReported = percent - percent % 10
+						print("Download %d%%." % percent)
+			fingerprints.remember(temp_path,fh.digest)
+
+		if os.path.isfile(temp_path):
+			span.bytes = os.path.getsize(temp_path)
+			return temp_path
+		else:
+			span.outcome = metrics.FAILED
+			return False
+
+def staged_path(file_id,name):
+	# each file gets its own directory, since Drive lets two folders
+	# hold files with the same name; the name itself is kept as-is
+	# because it's what goes to IA (and what the identifier comes from)
+	return os.path.join('temp_vids',file_id,name)
+
+def already_downloaded(path,md5Checksum):
+	# a complete copy from an earlier run, going by the fingerprint index
+	known = fingerprints.lookup(path)
+	return known is not None and md5Checksum not in (None,'') and known['md5'] == md5Checksum
+
+def describe_failure(path,error):
+	# for the list of files that didn't make it
+	return "{} AT {} ({}): {}".format(path,error.stage,error.kind,error.reason)
+
+def remove_staged(path):
+	if not path:
+		return
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+	fingerprints.forget(path)
+	try:
+		# the file's own directory, once it's empty
+		os.rmdir(os.path.dirname(path))
+	except OSError:
+		pass
+
+def get_drive_file_head(file_id,length=64*1024):
+	# just the first `length` bytes of a file
+	g_drive = get_drive_client()
+	with ratelimit.slot('drive',operation='media head') as slot:
+		response = g_drive.session().get(
+			g_drive.media_url(file_id),
+			headers={'Range':'bytes=0-{}'.format(length-1)},
+			timeout=(10,120)
+			)
+		if response.status_code >= 400 and ratelimit.is_throttle(response.status_code,response.text):
+			slot.throttled()
+	response.raise_for_status()
+
+	return response.content
+
+def stream_from_drive(file_id,chunkSize=1024*1024):
+	# yield a file's bytes as they come in, without saving them anywhere
+	g_drive = get_drive_client()
+	# the slot covers getting the response started, not the whole stream
+	with ratelimit.slot('drive',operation='media stream') as slot:
+		response = g_drive.session().get(
+			g_drive.media_url(file_id),
+			stream=True,
+			timeout=(10,120)
+			)
+		if response.status_code >= 400 and ratelimit.is_throttle(response.status_code,response.text):
+			slot.throttled()
+	with response:
+		response.raise_for_status()
+		for chunk in response.iter_content(chunkSize):
+			yield chunk
 
 ######
 ###### END SECTION FOR ACTUAL FILES FROM DRIVE
@@ -327,6 +735,79 @@ def parse_metadata_csv(csvPath):
 
 	return metaDict
 
+# default for pulling the asset ID out of a Drive file name,
+# e.g. TVTV_01234_some_tape.mp4 -> 01234
+ASSET_ID_PATTERN = r'(.+_)(?P<id>\d{5})(_.+)'
+
+class AssetIndex:
+	'''
+	Match Drive file names to rows of the metadata CSV. The ID is pulled
+	out of each name with the first of `patterns` that matches (each one
+	needs a group named "id"), then looked up in a dict built once from
+	metaDict. IDs are compared without leading zeros, since spreadsheets
+	like to drop them.
+	'''
+	def __init__(self,metaDict,patterns=None):
+		self.patterns = []
+		for pattern in patterns or [ASSET_ID_PATTERN]:
+			compiled = re.compile(pattern)
+			if 'id' not in compiled.groupindex:
+				raise ValueError("ID pattern {} has no (?P<id>...) group".format(pattern))
+			self.patterns.append(compiled)
+		self.index = {}
+		for _id in metaDict:
+			key = self.normalize(_id)
+			if key in self.index:
+				print("ITEM IDS {} AND {} IN THE CSV LOOK LIKE THE SAME ID, USING {}".format(
+					self.index[key],
+					_id,
+					_id
+					))
+			self.index[key] = _id
+
+	@staticmethod
+	def normalize(_id):
+		return str(_id).strip().lstrip('0') or '0'
+
+	def id_in_name(self,name):
+		for pattern in self.patterns:
+			match = pattern.match(name)
+			if match:
+				return match.group('id')
+		return None
+
+	def lookup(self,name):
+		'''
+		Return (metaDict key, None) for a file name, or (None, reason)
+		if it doesn't belong to any row.
+		'''
+		nameID = self.id_in_name(name)
+		if nameID is None:
+			return None, "no asset ID in name"
+		key = self.index.get(self.normalize(nameID))
+		if key is None:
+			return None, "no CSV row for ID {}".format(nameID)
+		return key, None
+
+def report_unmatched(unmatched,path='unmatched.csv',show=20):
+	'''
+	Say which Drive files got left out (all at once, not one at a time)
+	and write the full list to path.
+	'''
+	if unmatched == []:
+		return
+	print("{} FILES IN DRIVE DIDN'T MATCH A ROW IN THE CSV AND WILL BE SKIPPED:".format(len(unmatched)))
+	for row in unmatched[:show]:
+		print("  {name} ({reason})".format(**row))
+	if len(unmatched) > show:
+		print("  ...and {} more".format(len(unmatched)-show))
+	with open(path,'w') as f:
+		writer = csv.DictWriter(f,fieldnames=['folder','file_id','name','reason'])
+		writer.writeheader()
+		for row in unmatched:
+			writer.writerow(row)
+	print("FULL LIST IN "+path)
+
 def parse_drive_url(url):
 	try:
 		file_google_id = re.match(
@@ -363,8 +844,382 @@ def declare_metadata_csv():
 
 	return csvPath
 
+def configure_limits(args):
+	'''
+	Adaptive limits (see ratelimit.py) on requests in flight to Drive and
+	archive.org, starting from (and never going over) what the worker
+	counts allow.
+	'''
+	ratelimit.configure('drive',args.list_workers+args.download_workers*args.download_connections)
+	ratelimit.configure('ia',args.upload_workers*(1 if args.no_multipart else args.part_workers))
+
+def set_args(argv=None):
+	parser = argparse.ArgumentParser(
+		description="Transcode files from Google Drive folders and publish them to archive.org"
+		)
+	parser.add_argument(
+		'folders',
+		nargs='*',
+		help="Google Drive folder ID(s) to pull files from"
+		)
+	parser.add_argument(
+		'--daemon',
+		default=None,
+		metavar='CONFIG',
+		help="don't ask for anything: keep processing metadata CSVs dropped "
+			"into the spool directory given in CONFIG's [randos2ia] section, "
+			"pulling from its folders (or a batch's own), with the rest of "
+			"the options from there too; see spool.py"
+		)
+	parser.add_argument(
+		'--download-workers',
+		type=int,
+		default=1,
+		help="number of files to download from Drive at once (default: 1)"
+		)
+	parser.add_argument(
+		'--transcode-workers',
+		type=int,
+		default=None,
+		help="number of files in the transcode stage at once (default: as "
+			"many as the --cores budget allows)"
+		)
+	parser.add_argument(
+		'--cores',
+		type=int,
+		default=None,
+		help="total CPU cores ffmpeg jobs may use between them "
+			"(default: all of them)"
+		)
+	parser.add_argument(
+		'--ffmpeg-threads',
+		type=int,
+		default=4,
+		help="threads for each ffmpeg job; --cores/--ffmpeg-threads jobs "
+			"run at once (default: 4)"
+		)
+	parser.add_argument(
+		'--upload-workers',
+		type=int,
+		default=1,
+		help="number of uploads to archive.org to run at once (default: 1)"
+		)
+	parser.add_argument(
+		'--download-connections',
+		type=int,
+		default=rangedownload.DEFAULT_CONNECTIONS,
+		help="number of byte ranges of one file to download at once "
+			"(default: {})".format(rangedownload.DEFAULT_CONNECTIONS)
+		)
+	parser.add_argument(
+		'--chunk-size',
+		type=int,
+		default=rangedownload.DEFAULT_CHUNK_SIZE//(1024*1024),
+		help="size in MB of each downloaded byte range "
+			"(default: {})".format(rangedownload.DEFAULT_CHUNK_SIZE//(1024*1024))
+		)
+	parser.add_argument(
+		'--preset',
+		default=squarify.PRESET,
+		help="x264 preset for video re-encodes (default: {})".format(squarify.PRESET)
+		)
+	parser.add_argument(
+		'--crf',
+		type=int,
+		default=squarify.CRF,
+		help="x264 CRF for video re-encodes (default: {})".format(squarify.CRF)
+		)
+	parser.add_argument(
+		'--segment',
+		action='store_true',
+		help="split long files into pieces at keyframes and transcode the "
+			"pieces in parallel"
+		)
+	parser.add_argument(
+		'--segment-threshold',
+		type=int,
+		default=squarify.SEGMENT_THRESHOLD//60,
+		help="with --segment, only split files longer than this many minutes "
+			"(default: {})".format(squarify.SEGMENT_THRESHOLD//60)
+		)
+	parser.add_argument(
+		'--segment-length',
+		type=int,
+		default=squarify.SEGMENT_LENGTH//60,
+		help="with --segment, length of each piece in minutes "
+			"(default: {})".format(squarify.SEGMENT_LENGTH//60)
+		)
+	parser.add_argument(
+		'--stream',
+		action='store_true',
+		help="pipe files from Drive straight into ffmpeg instead of saving "
+			"them to temp_vids first (files that need seeking, like mp4s "
+			"with the moov atom at the end, still get saved first)"
+		)
+	parser.add_argument(
+		'--queue-size',
+		type=int,
+		default=None,
+		help="how many files a stage can get ahead of the next one (default: "
+			"as many as there's disk space for, or 2 with --no-disk-budget)"
+		)
+	parser.add_argument(
+		'--disk-reserve',
+		type=int,
+		default=staging.DEFAULT_RESERVE//(1024*1024),
+		help="MB to always leave free on the temp_vids disk "
+			"(default: {})".format(staging.DEFAULT_RESERVE//(1024*1024))
+		)
+	parser.add_argument(
+		'--output-ratio',
+		type=float,
+		default=staging.DEFAULT_OUTPUT_RATIO,
+		help="expected size of a transcode next to its source, used to "
+			"work out how much staging space a file needs "
+			"(default: {})".format(staging.DEFAULT_OUTPUT_RATIO)
+		)
+	parser.add_argument(
+		'--no-disk-budget',
+		action='store_true',
+		help="don't hold files back to fit the free space in temp_vids, "
+			"and don't clear out files earlier runs left there"
+		)
+	parser.add_argument(
+		'--fingerprints',
+		default='fingerprints.sqlite',
+		help="SQLite file to keep the md5/sha1 of files in, so files that "
+			"haven't changed are never hashed twice (default: fingerprints.sqlite)"
+		)
+	parser.add_argument(
+		'--no-fingerprints',
+		dest='fingerprints',
+		action='store_const',
+		const=None,
+		help="don't keep checksums between runs"
+		)
+	parser.add_argument(
+		'--multipart-threshold',
+		type=int,
+		default=multipart.DEFAULT_THRESHOLD//(1024*1024),
+		help="send files at least this many MB to archive.org in parts, "
+			"which are retried on their own and resumed after an interrupted "
+			"run (default: {})".format(multipart.DEFAULT_THRESHOLD//(1024*1024))
+		)
+	parser.add_argument(
+		'--part-size',
+		type=int,
+		default=multipart.DEFAULT_PART_SIZE//(1024*1024),
+		help="size in MB of each part of a multipart upload "
+			"(default: {})".format(multipart.DEFAULT_PART_SIZE//(1024*1024))
+		)
+	parser.add_argument(
+		'--part-workers',
+		type=int,
+		default=multipart.DEFAULT_WORKERS,
+		help="number of parts of one file to upload at once "
+			"(default: {})".format(multipart.DEFAULT_WORKERS)
+		)
+	parser.add_argument(
+		'--no-multipart',
+		action='store_true',
+		help="upload every file in a single request, however big"
+		)
+	parser.add_argument(
+		'--no-adaptive-limits',
+		action='store_true',
+		help="don't back off when Drive or archive.org throttle us, just "
+			"keep up as many requests as the worker counts allow"
+		)
+	parser.add_argument(
+		'--stage-retries',
+		type=int,
+		default=stageretry.DEFAULT_ATTEMPTS,
+		help="how many times to try a stage of an item (a download, an upload) that "
+			"fails in a way that might clear up, before giving up on the "
+			"item (default: {})".format(stageretry.DEFAULT_ATTEMPTS)
+		)
+	parser.add_argument(
+		'--recursive',
+		action='store_true',
+		help="also look for files in every folder under the given folders"
+		)
+	parser.add_argument(
+		'--name-contains',
+		default=None,
+		help="only list files whose name contains this (Drive matches it "
+			"against the start of words in the name)"
+		)
+	parser.add_argument(
+		'--drive-cache',
+		default='drive_cache.json',
+		help="where to keep the folder listing and Drive change token "
+			"between runs, so later runs only pick up new or changed files "
+			"(default: drive_cache.json)"
+		)
+	parser.add_argument(
+		'--no-drive-cache',
+		dest='drive_cache',
+		action='store_const',
+		const=None,
+		help="list the folders from scratch and process every file in them"
+		)
+	parser.add_argument(
+		'--full-sync',
+		action='store_true',
+		help="list the folders from scratch this time, but still skip files "
+			"that were uploaded before and haven't changed"
+		)
+	parser.add_argument(
+		'--list-workers',
+		type=int,
+		default=4,
+		help="number of Drive folders to list at once (default: 4)"
+		)
+	parser.add_argument(
+		'--id-pattern',
+		action='append',
+		default=None,
+		help="regex for pulling the asset ID out of a Drive file name, with "
+			"the ID in a group named id; give it more than once to try "
+			"several in order (default: {})".format(ASSET_ID_PATTERN.replace('%','%%'))
+		)
+	parser.add_argument(
+		'--spans',
+		default=None,
+		help="JSON lines file to log the timing of every stage to "
+			"(e.g. randos2ia_spans.jsonl)"
+		)
+	parser.add_argument(
+		'--prometheus',
+		default=None,
+		help="Prometheus textfile to write per-stage totals to, e.g. in the "
+			"node exporter's textfile collector directory"
+		)
+	parser.add_argument(
+		'--profile',
+		nargs='?',
+		const='',
+		default=None,
+		metavar='PREFIX',
+		help="profile the run with cProfile and save it to PREFIX.prof "
+			"(default PREFIX: randos2ia_<date>-<time>)"
+		)
+	parser.add_argument(
+		'--profile-memory',
+		action='store_true',
+		help="also track memory with tracemalloc, with a checkpoint after "
+			"each file in PREFIX_memory.jsonl"
+		)
+
+	return parser.parse_args(argv)
+
+def write_uploaded(metaDict,path='uploaded.csv'):
+	with open(path,'w+') as f:
+		fieldnames = ['item id','ia_url','description']
+		writer = csv.DictWriter(f,fieldnames=fieldnames)
+		writer.writeheader()
+		for k,v in metaDict.items():
+			row = {"item id":k,"ia_url":v['ia_url'],"description":v['Description']}
+			writer.writerow(row)
+
+def set_up(args):
+	metrics.configure(args.spans,args.prometheus,job='randos2ia')
+	fingerprints.configure(args.fingerprints)
+	stageretry.configure(args.stage_retries)
+	if not args.no_adaptive_limits:
+		configure_limits(args)
+
+def tear_down():
+	fingerprintIndex = fingerprints.get_index()
+	if fingerprintIndex is not None:
+		print(fingerprintIndex.stats())
+		fingerprintIndex.close()
+	if ratelimit.summary():
+		print(ratelimit.summary())
+	recorder = metrics.get_recorder()
+	print(recorder.summary_table())
+	recorder.close()
+
+def run_daemon(args):
+	'''
+	Process metadata CSVs from the spool one after another (see
+	spool.py), with the same Drive client, transcode scheduler, limits
+	and fingerprint index throughout. Each batch's uploaded.csv,
+	failures.csv, unmatched.csv and probe_cache.json are left in its
+	directory.
+	'''
+	config = spool.load_config(args.daemon)
+	args = set_args(spool.config_args(config,'randos2ia')+sys.argv[1:])
+	section = config['randos2ia'] if config.has_section('randos2ia') else {}
+	if 'spool' not in section:
+		print("{} NEEDS A spool = <directory> IN ITS [randos2ia] SECTION".format(args.daemon))
+		sys.exit(1)
+	set_up(args)
+	recorder = metrics.get_recorder()
+	# log in now, so a missing token stops us before any batch is taken
+	DriveClient.interactive = False
+	get_drive_client().service
+	scheduler = squarify.TranscodeScheduler(
+		coreBudget=args.cores,
+		threadsPerJob=args.ffmpeg_threads,
+		preset=args.preset,
+		crf=args.crf
+		)
+
+	def process(batch):
+		recorder.new_batch()
+		mediaType = spool.media_type(batch.option('media-type',section.get('media-type')))
+		folders = batch.option('folders',args.folders or section.get('folders','').split())
+		if isinstance(folders,str):
+			folders = folders.split()
+		if not folders:
+			raise ValueError("no Drive folders for {}: give some in the config or the batch's options".format(batch.name))
+		metaDict = parse_metadata_csv(batch.csvPath)
+		squarify.configure_probe_cache(os.path.join(batch.directory,'probe_cache.json'))
+		try:
+			failures = process_drive_folders(
+				folders,
+				metaDict,
+				mediaType,
+				args,
+				scheduler=scheduler,
+				unmatchedPath=os.path.join(batch.directory,'unmatched.csv')
+				)
+		finally:
+			write_uploaded(metaDict,os.path.join(batch.directory,'uploaded.csv'))
+			recorder.write_prometheus()
+		if failures != []:
+			with open(os.path.join(batch.directory,'failures.csv'),'w') as f:
+				writer = csv.writer(f)
+				writer.writerow(['failure'])
+				for x in failures:
+					print(x)
+					writer.writerow([x])
+		print(recorder.summary_table(batch=True))
+
+		return failures == []
+
+	try:
+		spool.serve(
+			spool.Spool(section['spool'],float(section.get('settle',spool.DEFAULT_SETTLE))),
+			process,
+			poll=float(section.get('poll',spool.DEFAULT_POLL))
+			)
+	finally:
+		scheduler.shutdown()
+		get_drive_client().close()
+	tear_down()
+
 def main():
-	folders = sys.argv[1:]
+	args = set_args()
+	if args.daemon:
+		run_daemon(args)
+		return
+	if not args.folders:
+		print("GIMME AT LEAST ONE DRIVE FOLDER ID")
+		sys.exit(1)
+	set_up(args)
+	folders = args.folders
 	# four_more_years_folder = "1ieh8vZz03D-4RooY3AdJTYpMNZIrwYv6"
 	# gerald_ford_folder="1KApPObPVoCa7WSZ7HbHjj1FlhLuc0jYu"
 	# tv_studio_folder="1U25W5MLbx9ZkTQ5jnmilrfjQGyZj6cm8"
@@ -387,61 +1242,328 @@ def main():
 		sys.exit()
 	print(mediaType)
 
+	profilePrefix = None
+	if args.profile is not None or args.profile_memory:
+		profilePrefix = args.profile or profiling.default_prefix('randos2ia')
+		profiling.start(
+			profilePrefix,
+			cpu=args.profile is not None,
+			memory=args.profile_memory
+			)
+
 	### PARSE METADATA INTO A DICT ###
 	metaDict = parse_metadata_csv(csvPath)
+	failures = process_drive_folders(folders,metaDict,mediaType,args)
+	if profilePrefix is not None:
+		for path in profiling.stop():
+			print("PROFILE WRITTEN TO "+path)
+
+	if failures != []:
+		print("*** THE FOLLOWING FILES DIDN'T MAKE IT TO IA FOR SOME RESON ***\n")
+		for x in failures:
+			print(x)
+	write_uploaded(metaDict)
+	tear_down()
+
+def process_drive_folders(
+	folders,
+	metaDict,
+	mediaType,
+	args,
+	scheduler=None,
+	unmatchedPath='unmatched.csv'
+	):
+	'''
+	Find the files in the Drive folders that match a record in metaDict
+	and run each one through download -> transcode -> upload. Fills in
+	metaDict[id]['ia_url'] for the ones that make it, and returns a list
+	of the ones that didn't, with the stage and the reason. args are the
+	parsed command line options; a squarify.TranscodeScheduler can be
+	passed in to reuse one. Files that don't match any record are listed
+	in unmatchedPath.
+
+	Downloads and uploads that fail in a transient way (see
+	stageretry.py) are tried again on their own, without going back
+	over the stages before them.
+	'''
 	failures = []
-	
-	for folder in folders:
-		print(folder)
-		print("* "*50)
-		files = get_drive_file_info(folder,'id','name')
-		for file_id, details in files.items():
-			currentAssetID = re.match('(.+_)(\d{5})(_.+)',details['name']).group(2)
-			if not currentAssetID in metaDict:
-				continue
-			localFilepath = get_file_from_drive(file_id,files[file_id]['name'])
-			print(localFilepath)
-			if not localFilepath.endswith(mediaType):
-				os.remove(localFilepath)
-				continue
-			for k,v in metaDict.items():
-				if k == currentAssetID:
-					assetMetadata = v
-					v['ia_url'] = ''
-
-			currentAsset = Asset(localFilepath,mediaType,assetMetadata)
-			currentAsset.get_core_metadata()
-			squarePixelFilepath = squarify.main(currentAsset.localFilepath)
-			if os.path.isfile(squarePixelFilepath):
+
+	index = AssetIndex(metaDict,args.id_pattern)
+	jobs = []
+	unmatched = []
+
+	def lister(toList,seen=None):
+		return list_drive_media(
+			toList,
+			mediaType,
+			nameContains=args.name_contains,
+			recursive=args.recursive,
+			workers=args.list_workers,
+			seen=seen
+			)
+
+	sync = None
+	if args.drive_cache is None:
+		files = lister(folders)
+	else:
+		# only what's new or changed since the last run
+		sync = drivesync.DriveSync(args.drive_cache)
+		files = sync.sync(
+			get_drive_client(),
+			{
+				'folders':sorted(folders),
+				'mediaType':mediaType,
+				'nameContains':args.name_contains,
+				'recursive':args.recursive
+			},
+			lister,
+			media_filter(mediaType,args.name_contains),
+			recursive=args.recursive,
+			full=args.full_sync
+			)
+		# files skipped as already uploaded still belong in uploaded.csv
+		for details in sync.uploaded().values():
+			currentAssetID = index.lookup(details['name'])[0]
+			if currentAssetID is not None and details.get('identifier'):
+				metaDict[currentAssetID]['ia_url'] = "https://archive.org/embed/{}".format(details['identifier'])
+	for file_id, details in files.items():
+		currentAssetID, reason = index.lookup(details['name'])
+		if currentAssetID is None:
+			unmatched.append({
+				'folder':details['folder'],
+				'file_id':file_id,
+				'name':details['name'],
+				'reason':reason
+				})
+			continue
+		jobs.append({
+			'file_id':file_id,
+			'name':details['name'],
+			'size':details['size'],
+			'md5Checksum':details['md5Checksum'],
+			'assetID':currentAssetID
+			})
+	print("{} {} FILES TO PROCESS".format(len(jobs),mediaType.upper()))
+	report_unmatched(unmatched,unmatchedPath)
+
+	budget = None
+	queueSize = args.queue_size
+	if not args.no_disk_budget:
+		budget = staging.StagingBudget(
+			'temp_vids',
+			reserve=args.disk_reserve*1024*1024,
+			outputRatio=args.output_ratio
+			)
+		# keep finished downloads of files we're about to process
+		# anyway, as long as they're what Drive has
+		wanted = {
+			staged_path(job['file_id'],job['name']): job['md5Checksum']
+			for job in jobs
+			}
+		budget.reclaim(lambda path: already_downloaded(path,wanted.get(path)))
+		budget.start()
+		if queueSize is None:
+			# the budget decides how far ahead downloads can get
+			queueSize = 0
+	elif queueSize is None:
+		queueSize = 2
+
+	uploader = None
+	if not args.no_multipart:
+		uploader = multipart.MultipartUploader(
+			threshold=args.multipart_threshold*1024*1024,
+			partSize=args.part_size*1024*1024,
+			workers=args.part_workers
+			)
+
+	### EACH FILE GOES DOWNLOAD -> TRANSCODE -> UPLOAD, ###
+	### WITH THE STAGES RUNNING ON DIFFERENT FILES AT ONCE ###
+	def download(job):
+		localFilepath = staged_path(job['file_id'],job['name'])
+		stream = False
+		if args.stream:
+			# peek at the start of the file to see if ffmpeg can take it
+			# straight from Drive; if not, stage it to disk as usual
+			head = stageretry.retry(
+				'drive_head',
+				lambda: get_drive_file_head(job['file_id']),
+				destination='drive'
+				)
+			stream = squarify.is_streamable(job['name'],head)
+			if not stream:
+				print("{} NEEDS SEEKING, DOWNLOADING IT FIRST".format(job['name']))
+		downloaded = not stream and already_downloaded(localFilepath,job['md5Checksum'])
+		if budget is not None:
+			budget.admit(job['file_id'],budget.estimate(
+				job['size'],
+				downloaded=downloaded,
+				stream=stream,
+				segment=args.segment
+				))
+		if stream:
+			# ffmpeg writes the transcode there
+			os.makedirs(os.path.dirname(localFilepath),exist_ok=True)
+			job['localFilepath'] = localFilepath
+			job['stream'] = True
+			job['head'] = head
+			return job
+		if downloaded:
+			print("{} WAS ALREADY DOWNLOADED".format(job['name']))
+			job['localFilepath'] = localFilepath
+			return job
+		localFilepath = stageretry.retry(
+			'drive_download',
+			lambda: get_file_from_drive(
+				job['file_id'],
+				job['name'],
+				job['size'],
+				job['md5Checksum'],
+				chunkSize=args.chunk_size*1024*1024,
+				connections=args.download_connections
+				),
+			destination='drive'
+			)
+		if not localFilepath:
+			raise stageretry.StageError('drive_download',"nothing was saved for {}".format(job['name']))
+		print(localFilepath)
+		job['localFilepath'] = localFilepath
+		return job
+
+	def transcode(job):
+		assetMetadata = metaDict[job['assetID']]
+		assetMetadata['ia_url'] = ''
+		currentAsset = Asset(job['localFilepath'],mediaType,assetMetadata,uploader)
+		currentAsset.get_core_metadata()
+		# includes waiting for a slot in the core budget
+		with metrics.span('transcode',item=job['name']) as span:
+			if job.get('stream'):
+				span.labels['mode'] = 'stream'
+				head = job.pop('head')
+				# a stream that drops partway through starts over from
+				# the top, like a failed download
+				squarePixelFilepath = stageretry.retry(
+					'drive_stream',
+					lambda: scheduler.submit(
+						currentAsset.localFilepath,
+						chunks=stream_from_drive(job['file_id']),
+						head=head
+						).result(),
+					destination='drive'
+					)
+			elif args.segment and is_long(currentAsset.localFilepath):
+				span.labels['mode'] = 'segmented'
+				# runs here in the stage's own thread and farms the
+				# pieces out to the scheduler
+				squarePixelFilepath = scheduler.transcode_segmented(
+					currentAsset.localFilepath,
+					args.segment_length*60
+					)
+			else:
+				span.labels['mode'] = 'file'
+				squarePixelFilepath = scheduler.submit(currentAsset.localFilepath).result()
+			if squarePixelFilepath and os.path.isfile(squarePixelFilepath):
 				currentAsset.squarePixelFilepath = squarePixelFilepath
-			result = currentAsset.post_to_ia()
+				span.bytes = os.path.getsize(squarePixelFilepath)
+			else:
+				span.outcome = metrics.FAILED
+				# ffmpeg won't do any better the second time
+				raise stageretry.StageError('transcode',"ffmpeg couldn't transcode {}".format(job['name']))
+		job['asset'] = currentAsset
+		return job
+
+	def is_long(localFilepath):
+		duration = squarify.duration_of(squarify.get_probe_cache().get(localFilepath))
+		return duration is not None and duration > args.segment_threshold*60
+
+	def upload_to_ia(job):
+		currentAsset = job.pop('asset')
+		try:
+			result = stageretry.retry('ia_upload',currentAsset.post_to_ia,destination='ia')
+		except stageretry.StageError as e:
+			result = False
+			error = e
+		# squarify hands back the original file if it didn't need transcoding
+		transcoded = currentAsset.squarePixelFilepath != job['localFilepath']
+		with metrics.span('cleanup',item=job['name']):
 			if result != False:
-				os.remove(localFilepath)
-				os.remove(currentAsset.squarePixelFilepath)
-				iaEmbed = "https://archive.org/embed/{}".format(currentAsset.identifier)
-				metaDict[currentAssetID]['ia_url'] = iaEmbed
+				if transcoded:
+					os.remove(currentAsset.squarePixelFilepath)
+					fingerprints.forget(currentAsset.squarePixelFilepath)
+				if not job.get('stream'):
+					os.remove(job['localFilepath'])
+					fingerprints.forget(job['localFilepath'])
 			else:
-				try:
-					os.remove(squarePixelFilepath)
-				except:
-					pass
-				failures.append(localFilepath)
+				# the original too, or failed files pile up in temp_vids
+				if transcoded:
+					remove_staged(currentAsset.squarePixelFilepath)
+				if not job.get('stream'):
+					remove_staged(job['localFilepath'])
+			try:
+				os.rmdir(os.path.dirname(job['localFilepath']))
+			except OSError:
+				pass
+		if budget is not None:
+			budget.release(job['file_id'])
+		if result != False:
+			iaEmbed = "https://archive.org/embed/{}".format(currentAsset.identifier)
+			metaDict[job['assetID']]['ia_url'] = iaEmbed
+			if sync is not None:
+				sync.mark_uploaded(job['file_id'],currentAsset.identifier)
+		else:
+			failures.append(describe_failure(job['localFilepath'],error))
 
-			del currentAsset
+		del currentAsset
+		profiling.checkpoint(job['name'])
+		return job
 
-	if failures != []:
-		print("*** THE FOLLOWING FILES DIDN'T MAKE IT TO IA FOR SOME RESON ***\n")
-		for x in failures:
-			print(x)
-	with open('uploaded.csv','w+') as f:
-		fieldnames = ['item id','ia_url','description']
-		writer = csv.DictWriter(f,fieldnames=fieldnames)
-		writer.writeheader()
-		for k,v in metaDict.items():
-			row = {"item id":k,"ia_url":v['ia_url'],"description":v['Description']}
-			writer.writerow(row)
+	def on_error(stageName,job,error):
+		if not isinstance(error,stageretry.StageError):
+			error = stageretry.StageError(
+				stageName,
+				stageretry.describe(error),
+				stageretry.is_transient(error)
+				)
+		failures.append(describe_failure(job.get('localFilepath',job['name']),error))
+		# including a half-finished download
+		localFilepath = staged_path(job['file_id'],job['name'])
+		remove_staged(squarify.square_pixel_path(localFilepath))
+		if not job.get('stream'):
+			remove_staged(localFilepath)
+		if budget is not None:
+			budget.release(job['file_id'])
 
+	ownScheduler = scheduler is None
+	if ownScheduler:
+		scheduler = squarify.TranscodeScheduler(
+			coreBudget=args.cores,
+			threadsPerJob=args.ffmpeg_threads,
+			preset=args.preset,
+			crf=args.crf
+			)
+	print("TRANSCODING UP TO {} FILES AT ONCE WITH {} THREADS EACH".format(
+		scheduler.jobs,
+		scheduler.threadsPerJob
+		))
+	stages = pipeline.Pipeline(
+		[
+			pipeline.Stage('download',download,args.download_workers),
+			pipeline.Stage('transcode',transcode,args.transcode_workers or scheduler.jobs),
+			pipeline.Stage('upload',upload_to_ia,args.upload_workers)
+		],
+		queueSize=queueSize,
+		onError=on_error
+		)
+	try:
+		stages.run(jobs)
+	finally:
+		if sync is not None:
+			sync.save()
+	if budget is not None:
+		print("AT MOST {:.1f} MB WAS SET ASIDE FOR STAGING".format(budget.peak/1024/1024))
+	if ownScheduler:
+		scheduler.shutdown()
 
+	return failures
 
 if __name__ == "__main__":
 	main()
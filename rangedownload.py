@@ -0,0 +1,147 @@
+'''
+Download one big file over several connections at once.
+
+The file is preallocated at its full size, split into chunkSize byte
+ranges, and each range is fetched with an HTTP Range request and
+written straight into place with os.pwrite(), so the pieces can arrive
+in any order and nothing has to be stitched together afterwards.
+A range that fails is retried on its own.
+
+Every range request goes through the 'drive' adaptive limit (see
+ratelimit.py), and a range that fails waits a jittered backoff before
+it's tried again.
+
+The file's MD5 and SHA-1 are worked out as the ranges come in (see
+fingerprints.OrderedDigest), so checking it against the expected MD5
+doesn't mean reading the whole file back afterwards.
+'''
+
+import concurrent.futures
+import fingerprints
+import os
+import ratelimit
+import threading
+
+DEFAULT_CHUNK_SIZE = 32*1024*1024
+DEFAULT_CONNECTIONS = 4
+# how much of a response to hold in memory before writing it out
+WRITE_BLOCK = 1024*1024
+
+class ChecksumMismatch(Exception):
+	# a fresh download will probably come out right
+	transient = True
+
+def fetch(
+	session,
+	url,
+	path,
+	size,
+	chunkSize=DEFAULT_CHUNK_SIZE,
+	connections=DEFAULT_CONNECTIONS,
+	expectedMD5=None,
+	retries=3,
+	timeout=(10,120)
+	):
+	'''
+	Download url (size bytes) to path using a requests-style session.
+	If expectedMD5 is given the finished file is checked against it and
+	ChecksumMismatch is raised if it doesn't match. The checksums go in
+	the fingerprint index (if there is one).
+	'''
+	ranges = [
+		(start,min(start+chunkSize,size)-1)
+		for start in range(0,size,chunkSize)
+		]
+	progress = Progress(path,size)
+	# read as well as write: ranges that finish ahead of the ones before
+	# them are read back for the checksum
+	fd = os.open(path,os.O_RDWR|os.O_CREAT|os.O_TRUNC,0o644)
+	digest = fingerprints.OrderedDigest(fd)
+	try:
+		os.ftruncate(fd,size)
+
+		def fetch_range(byteRange):
+			for attempt in range(retries):
+				try:
+					_fetch_range(session,url,fd,byteRange,progress,digest,timeout)
+					return
+				except Exception as e:
+					if attempt+1 == retries:
+						raise
+					print("RETRYING BYTES {}-{} OF {}: {}".format(
+						byteRange[0],
+						byteRange[1],
+						os.path.basename(path),
+						e
+						))
+					ratelimit.backoff('drive',attempt)
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+			# list() so the first failed range raises here
+			list(executor.map(fetch_range,ranges))
+	finally:
+		os.close(fd)
+
+	if expectedMD5 is not None and digest.md5 != expectedMD5:
+		raise ChecksumMismatch("{}: expected md5 {}, got {}".format(
+			path,
+			expectedMD5,
+			digest.md5
+			))
+	fingerprints.remember(path,digest)
+
+	return path
+
+def _fetch_range(session,url,fd,byteRange,progress,digest,timeout):
+	start, end = byteRange
+	with ratelimit.slot('drive',size=end+1-start,operation='media range') as slot:
+		response = session.get(
+			url,
+			headers={'Range':'bytes={}-{}'.format(start,end)},
+			stream=True,
+			timeout=timeout
+			)
+		try:
+			if response.status_code != 206:
+				if response.status_code >= 400 and ratelimit.is_throttle(response.status_code,response.text):
+					slot.throttled()
+				# an HTTPError, so stageretry can tell a 503 from a 404
+				response.raise_for_status()
+				raise IOError("expected a partial response, got HTTP {}".format(response.status_code))
+			offset = start
+			try:
+				for block in response.iter_content(WRITE_BLOCK):
+					os.pwrite(fd,block,offset)
+					digest.add(offset,block)
+					offset += len(block)
+					progress.add(len(block))
+				if offset != end+1:
+					raise IOError("range ended early at byte {}".format(offset))
+			except Exception:
+				# this range gets fetched again from the start
+				progress.add(start-offset)
+				raise
+		finally:
+			response.close()
+
+class Progress:
+	'''
+	Print a line each time another 10% of the file has come in (or gone
+	out, for multipart.py's uploads), rather than one for every block.
+	done is how much was already there, for a resumed transfer.
+	'''
+	def __init__(self,path,size,done=0,verb="Download"):
+		self.name = os.path.basename(path)
+		self.size = size
+		self.done = done
+		self.verb = verb
+		self.lastReported = int(done*100/size) if size else 100
+		self._lock = threading.Lock()
+
+	def add(self,count):
+		with self._lock:
+			self.done += count
+			percent = int(self.done*100/self.size) if self.size else 100
+			if percent >= self.lastReported+10:
+				self.lastReported = percent - percent % 10
+				print("{} {} {}%.".format(self.verb,self.name,self.lastReported))
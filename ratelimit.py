@@ -0,0 +1,267 @@
+'''
+Adaptive concurrency limits, one per service we talk to (RS, Drive,
+IA-S3), so the scripts can be run with lots of workers and still back
+off when a service starts pushing back.
+
+Each limit works like TCP congestion control (AIMD): every request that
+goes through fine raises the limit by 1/limit (so about one more request
+in flight per round of `limit` requests), and a request that's throttled
+(HTTP 429/503, IA's SlowDown, Drive's rateLimitExceeded) or that takes far longer than usual halves
+it, at most once per cooldown so one bad burst only counts once. Workers
+over the limit wait for a slot. A limit starts at its maximum (the
+worker counts asked for) and only comes down once the service pushes
+back.
+
+	with ratelimit.slot('ia',size=len(body),operation='PUT') as s:
+		response = session.put(...)
+		if ratelimit.is_throttle(response.status_code):
+			s.throttled()
+	if ...throttled:
+		ratelimit.backoff('ia',attempt)   # sleeps, with jitter
+
+"Usual" is a moving average of recent times for the same operation
+(an RS function, a Drive API method, an S3 verb...), per MB when a size
+is given, so big and small uploads can share a limit; requests without
+a size are averaged separately. Slow requests count towards the average
+too, up to latencyFactor times it, so a lasting slowdown becomes the new
+usual instead of keeping the limit at its minimum. A service with no
+limit configured isn't held back at all.
+
+The current limits go to the metrics Prometheus textfile as
+rs2ia_destination_concurrency_limit, alongside requests in flight and
+throttles so far.
+'''
+
+import metrics
+import random
+import re
+import requests
+import threading
+import time
+
+THROTTLE_STATUSES = (429,503)
+# what IA (503 SlowDown) and Drive (403 rateLimitExceeded or
+# userRateLimitExceeded) put in the body when they throttle
+THROTTLE_REASONS = ('SlowDown','rateLimitExceeded','RateLimitExceeded')
+
+class AdaptiveLimit:
+	def __init__(
+		self,
+		name,
+		maximum,
+		initial=None,
+		minimum=1,
+		decrease=0.5,
+		latencyFactor=4.0,
+		cooldown=2.0
+		):
+		'''
+		maximum: the most requests ever allowed in flight at once
+		initial: where to start (default: maximum)
+		decrease: what the limit is multiplied by when backing off
+		latencyFactor: how many times slower than usual counts as a spike
+		cooldown: seconds after backing off before it can happen again
+		'''
+		self.name = name
+		self.maximum = max(maximum,minimum)
+		self.minimum = minimum
+		self.limit = float(initial or self.maximum)
+		self.decrease = decrease
+		self.latencyFactor = latencyFactor
+		self.cooldown = cooldown
+		self.inFlight = 0
+		self.throttles = 0
+		self.spikes = 0
+		# moving averages of seconds for requests that went fine:
+		# {(operation, True): per MB for sized requests,
+		#  (operation, False): for the rest}
+		self.usual = {}
+		self._samples = {}
+		self._lastDecrease = 0.0
+		self._condition = threading.Condition()
+		self._publish()
+
+	def slot(self,size=None,operation=None):
+		return _Slot(self,size,operation)
+
+	def acquire(self):
+		with self._condition:
+			while self.inFlight >= int(self.limit):
+				self._condition.wait()
+			self.inFlight += 1
+			self._publish()
+
+	def release(self,seconds,size=None,throttled=False,failed=False,operation=None):
+		'''
+		failed: it went wrong in a way that says nothing about load (a
+		bad request, say), so leave the limit alone
+		operation: what kind of request it was, to compare its time with
+		'''
+		with self._condition:
+			self.inFlight -= 1
+			if failed:
+				pass
+			elif throttled:
+				self.throttles += 1
+				self._back_off("THROTTLED")
+			else:
+				key = (operation,bool(size))
+				latency = seconds/max(size/1024/1024,1) if size else seconds
+				usual = self.usual.get(key)
+				if self._samples.get(key,0) >= 10 and latency > usual*self.latencyFactor:
+					self.spikes += 1
+					self._back_off("SLOW")
+				else:
+					self.limit = min(self.maximum,self.limit+1/self.limit)
+				if usual is not None:
+					# so one outlier can't drag the average far
+					latency = min(latency,usual*self.latencyFactor)
+				self._samples[key] = self._samples.get(key,0)+1
+				self.usual[key] = latency if usual is None else usual*0.9+latency*0.1
+			self._publish()
+			self._condition.notify_all()
+
+	def _back_off(self,reason):
+		now = time.monotonic()
+		if now-self._lastDecrease < self.cooldown:
+			return
+		self._lastDecrease = now
+		previous = int(self.limit)
+		self.limit = max(self.minimum,self.limit*self.decrease)
+		if int(self.limit) < previous:
+			print("{} {}: DOWN TO {} AT ONCE".format(self.name.upper(),reason,int(self.limit)))
+
+	def backoff(self,attempt,base=1.0,cap=60.0):
+		'''
+		Sleep before retrying a throttled request: a random time up to
+		base*2**attempt seconds ("full jitter"), so workers that were
+		throttled together don't all come back together.
+		'''
+		wait = random.uniform(0,min(cap,base*2**attempt))
+		time.sleep(wait)
+		return wait
+
+	def _publish(self):
+		recorder = metrics.get_recorder()
+		labels = {'destination':self.name}
+		recorder.set_gauge('rs2ia_destination_concurrency_limit',labels,int(self.limit),
+			"Requests currently allowed in flight to each destination.")
+		recorder.set_gauge('rs2ia_destination_in_flight',labels,self.inFlight,
+			"Requests in flight to each destination.")
+		recorder.set_gauge('rs2ia_destination_throttled_requests',labels,self.throttles,
+			"Requests each destination throttled.")
+
+	def describe(self):
+		return "{}: {} at once (max {}), {} throttled, {} slow".format(
+			self.name,
+			int(self.limit),
+			self.maximum,
+			self.throttles,
+			self.spikes
+			)
+
+class _Slot:
+	def __init__(self,limit,size,operation):
+		self.limit = limit
+		self.size = size
+		self.operation = operation
+		self._throttled = False
+
+	def throttled(self):
+		self._throttled = True
+
+	def __enter__(self):
+		self.limit.acquire()
+		self._start = time.perf_counter()
+		return self
+
+	def __exit__(self,excType,excValue,traceback):
+		# a connection error or timeout counts as being pushed back;
+		# any other exception doesn't count either way
+		throttled = self._throttled or (excType is not None and is_throttle_error(excValue))
+		self.limit.release(
+			time.perf_counter()-self._start,
+			self.size,
+			throttled=throttled,
+			failed=excType is not None and not throttled,
+			operation=self.operation
+			)
+		return False
+
+class _NoSlot:
+	def throttled(self):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		return False
+
+_limits = {}
+
+def configure(name,maximum,**kwargs):
+	_limits[name] = AdaptiveLimit(name,maximum,**kwargs)
+	return _limits[name]
+
+def get(name):
+	return _limits.get(name)
+
+def slot(name,size=None,operation=None):
+	limit = _limits.get(name)
+	if limit is None:
+		return _NoSlot()
+	return limit.slot(size,operation)
+
+def backoff(name,attempt,base=1.0,cap=60.0):
+	limit = _limits.get(name)
+	if limit is None:
+		# nothing configured to adapt, but still don't hammer it
+		wait = random.uniform(0,min(cap,base*2**attempt))
+		time.sleep(wait)
+		return wait
+	return limit.backoff(attempt,base,cap)
+
+def is_throttle(status,text=''):
+	return status in THROTTLE_STATUSES or any(x in (text or '') for x in THROTTLE_REASONS)
+
+def status_of(error):
+	'''
+	The HTTP status behind an exception, if it's an HTTP error: a
+	requests HTTPError (as the internetarchive library raises) or a
+	googleapiclient HttpError. Returns (status, body text) or None.
+	'''
+	if isinstance(error,requests.exceptions.HTTPError):
+		if error.response is not None:
+			return error.response.status_code, error.response.text
+		# re-raised without its response (the internetarchive library
+		# does this for metadata reads), so the status is only in the
+		# message: "503 Server Error: ..."
+		match = re.search(r'\b(\d{3}) (?:Client|Server) Error',str(error))
+		if match is None:
+			return None
+		return int(match.group(1)), str(error)
+	if hasattr(error,'resp') and hasattr(error,'content'):
+		# googleapiclient's HttpError
+		return error.resp.status, error.content.decode('utf-8','replace')
+	return None
+
+def is_throttle_error(error):
+	'''
+	Is this exception a service pushing back: an HTTP error for a
+	throttling status, or a dropped or timed out connection?
+	'''
+	status = status_of(error)
+	if status is not None:
+		return is_throttle(*status)
+	return isinstance(error,(
+		ConnectionError,
+		TimeoutError,
+		requests.exceptions.ConnectionError,
+		# the connection dropped partway through a body
+		requests.exceptions.ChunkedEncodingError,
+		requests.exceptions.Timeout
+		))
+
+def summary():
+	return "\n".join("LIMIT "+x.describe() for x in _limits.values())
@@ -3,18 +3,39 @@
 This script (or maybe scripts eventually?) will be used to transfer
 assets and metadata from our local ResourceSpace to Internet Archive.
 """
+import argparse
+import concurrent.futures
 import csv
+import fingerprints
 from google_drive_downloader import GoogleDriveDownloader # from https://github.com/ndrplz/google-drive-downloader/blob/master/google_drive_downloader/google_drive_downloader.py
 import hashlib
-from internetarchive import upload
+import journal
+import json
+import metrics
+import multipart
 import os.path
+import preflight
+import profiling
+import ratelimit
 import re
 import requests
+import rscache
+import spool
 import subprocess
+import stageretry
 import sys
+import threading
 import time
 import urllib
 
+# defaults for the pooled ResourceSpace connection; override with
+# ResourceSpaceAPI.configure_session()
+RS_POOL_SIZE = 10
+RS_CONNECT_TIMEOUT = 5
+RS_READ_TIMEOUT = 60
+# tries at a query RS throttles (or drops the connection on)
+RS_RETRIES = 4
+
 # # COUNTER IS FOR TESTING PURPOSES
 # counter=1
 
@@ -50,18 +71,23 @@ Please send questions and comments to bampfa@berkeley.edu.
 class User:
 	'''
 	Define a user who will be connecting to
-	ResourceSpace and Internet Archive.
+	ResourceSpace and Internet Archive. Anything not
+	given is asked for.
 	'''
-	def __init__(self):
-		self.define_rs_user()
-		self.define_ia_user()
+	def __init__(self,rsUserName=None,rsAPIkey=None):
+		self.define_rs_user(rsUserName,rsAPIkey)
+		if rsUserName is None:
+			self.define_ia_user()
 
-	def define_rs_user(self):
-		rsUserName = input("enter resourcespace user name:")
+	def define_rs_user(self,rsUserName=None,rsAPIkey=None):
+		if rsUserName is None:
+			rsUserName = input("enter resourcespace user name:")
 		if not rsUserName.isalnum():
 			rsUserName = urllib.parse.quote_plus(rsUserName)
 		self.rsUserName = rsUserName
-		self.rsAPIkey = input("enter your resourcespace API key:")
+		if rsAPIkey is None:
+			rsAPIkey = input("enter your resourcespace API key:")
+		self.rsAPIkey = rsAPIkey
 
 	def define_ia_user(self):
 		'''
@@ -82,17 +108,104 @@ class User:
 		else:
 			pass
 
+def environment_user():
+	'''
+	A User for running headless, from $RS_USER and $RS_API_KEY. The
+	internetarchive library finds archive.org credentials itself, in
+	$IA_ACCESS_KEY_ID and $IA_SECRET_ACCESS_KEY or its ia.ini.
+	'''
+	missing = [x for x in ('RS_USER','RS_API_KEY') if not os.environ.get(x)]
+	if missing:
+		print("SET {} TO RUN WITHOUT ANYONE AT THE KEYBOARD".format(" AND ".join(missing)))
+		sys.exit(1)
+
+	return User(os.environ['RS_USER'],os.environ['RS_API_KEY'])
+
+def is_valid_response(text):
+	'''
+	Whether an RS response is a real answer, and so worth caching,
+	rather than one of the errors RS sends with HTTP 200 ("", false,
+	"Invalid signature"...).
+	'''
+	try:
+		value = json.loads(text)
+	except ValueError:
+		return False
+	if value is None or value is False or value == '':
+		return False
+
+	return not (isinstance(value,dict) and 'error' in value)
+
+class RSUnavailable(Exception):
+	# RS kept throttling us, erroring or dropping the connection; worth
+	# trying again later (see stageretry.py)
+	transient = True
+
 class ResourceSpaceAPI:
 	'''
 	Define location of ResourceSpace assets
 	and how to query the API. Largely based on
 	https://github.com/pixuenan/RS-python-API/blob/master/RSAPI.py
+
+	All instances share one keep-alive requests.Session so that every
+	Asset reuses the same pool of TCP/TLS connections to the RS server
+	instead of doing a fresh handshake per query.
 	'''
+	_session = None
+	_sessionLock = threading.Lock()
+	timeout = (RS_CONNECT_TIMEOUT,RS_READ_TIMEOUT)
+	retries = RS_RETRIES
+	# an rscache.ResponseCache shared by every instance, or None for no caching
+	cache = None
+	# where the RS API lives; point these somewhere else to use a test server
+	scheme = "https"
+	server = "resourcespace.bampfa.berkeley.edu"
+
 	def __init__(self,_user=None):
-		self.edithServer = "resourcespace.bampfa.berkeley.edu"
+		self.edithServer = self.server
 		self._user = _user
+		self.session = self.get_session()
 
-	def query(self, function_to_query, parameters, _user):
+	@classmethod
+	def configure_session(
+		cls,
+		poolSize=RS_POOL_SIZE,
+		connectTimeout=RS_CONNECT_TIMEOUT,
+		readTimeout=RS_READ_TIMEOUT
+		):
+		'''
+		(Re)build the shared session with a given pool size and timeouts.
+		Call this before creating any Assets; existing instances keep
+		whatever session they already grabbed.
+		'''
+		with cls._sessionLock:
+			if cls._session is not None:
+				cls._session.close()
+			cls._session = cls._build_session(poolSize)
+			cls.timeout = (connectTimeout,readTimeout)
+		return cls._session
+
+	@classmethod
+	def get_session(cls):
+		with cls._sessionLock:
+			if cls._session is None:
+				cls._session = cls._build_session(RS_POOL_SIZE)
+		return cls._session
+
+	@staticmethod
+	def _build_session(poolSize):
+		session = requests.Session()
+		# pool_maxsize is the number of connections kept alive to the RS host,
+		# which should be at least the number of threads querying RS at once
+		adapter = requests.adapters.HTTPAdapter(
+			pool_connections=1,
+			pool_maxsize=poolSize
+			)
+		session.mount("https://",adapter)
+		session.mount("http://",adapter)
+		return session
+
+	def query(self, function_to_query, parameters, _user, raw=False, useCache=True, operation=None):
 		'''
 		Construct an RS API query:
 		1. Define the query: combination of username, the ResourceSpace function,
@@ -102,7 +215,38 @@ class ResourceSpaceAPI:
 		3. Combine the hashed query string with the query itself in a query URL
 			(linked to the Edith server)
 		For more detail: https://www.resourcespace.com/knowledge-base/api/
+		Set raw=True to get the response text untouched (e.g. to parse it
+		as JSON) instead of with the quotes and backslashes stripped out.
+		If ResourceSpaceAPI.cache is set, valid responses (see
+		is_valid_response()) are cached there, per RS user, and reused
+		unless useCache=False. operation names the kind of query for the
+		'rs' limit's timings (default: the function), for calls that take
+		much longer than the usual one, like a batched lookup.
+		Returns None if RS answered with an error, and raises RSUnavailable
+		if it couldn't be reached or kept failing in a way that might clear
+		up (throttling, 5xx).
 		'''
+		with metrics.span('rs_query',function=function_to_query) as span:
+			text = None
+			if self.cache is not None and useCache:
+				text = self.cache.get(_user.rsUserName,function_to_query,parameters)
+				if text is not None:
+					span.outcome = metrics.CACHED
+			if text is None:
+				text = self._post(function_to_query,parameters,_user,operation)
+				if text is None:
+					span.outcome = metrics.FAILED
+					return None
+				if self.cache is not None and is_valid_response(text):
+					self.cache.set(_user.rsUserName,function_to_query,parameters,text)
+			span.bytes = len(text)
+
+		if raw:
+			return text
+		else:
+			return text.replace("\\","").replace("\"","")
+
+	def _post(self, function_to_query, parameters, _user, operation=None):
 		query = "user={}&function={}&{}".format(
 			_user.rsUserName,
 			function_to_query,
@@ -110,56 +254,139 @@ class ResourceSpaceAPI:
 			)
 		sign = hashlib.sha256(_user.rsAPIkey.encode()+query.encode())
 		sign = sign.hexdigest()
-		queryURL = "https://{}/api/?{}&sign={}".format(
+		queryURL = "{}://{}/api/?{}&sign={}".format(
+			self.scheme,
 			self.edithServer,
 			query,
 			sign
 			)
 		# get the result of API query, i.e. what is returned by the query URL
 		# print(queryURL)
-		result = requests.post(queryURL)
+		# through the 'rs' limit, backing off and trying again while RS
+		# is throttling us or dropping connections
+		for attempt in range(self.retries):
+			try:
+				with ratelimit.slot('rs',operation=operation or function_to_query) as slot:
+					result = self.session.post(queryURL,timeout=self.timeout)
+					if ratelimit.is_throttle(result.status_code):
+						slot.throttled()
+			except requests.exceptions.RequestException as err:
+				print(err)
+				if not ratelimit.is_throttle_error(err):
+					return None
+				if attempt+1 == self.retries:
+					raise RSUnavailable("{} failed: {}".format(function_to_query,err))
+			else:
+				if not ratelimit.is_throttle(result.status_code) or attempt+1 == self.retries:
+					break
+				print("RS RETURNED HTTP {} FOR {}, BACKING OFF".format(result.status_code,function_to_query))
+			ratelimit.backoff('rs',attempt)
 		# try:
 		# 	# get the result of API query, i.e. what is returned by the query URL
 		# 	result = queryURL
 		# except (IOError, UnicodeDecodeError) as err:
 		# 	print(err)
-		print(result.text)
 		httpStatus = result.status_code
 		if httpStatus == 200:
-			return result.text.replace("\\","").replace("\"","")
+			return result.text
+		elif ratelimit.is_throttle(httpStatus) or httpStatus >= 500:
+			raise RSUnavailable("RS returned HTTP {} for {}".format(httpStatus,function_to_query))
 		else:
+			print("RS RETURNED HTTP {} FOR {}".format(httpStatus,function_to_query))
 			return None
 
-class Asset:
+class PathResolver:
 	'''
-	Define an asset, which could be simple (one file)
-	or complex (a set of files), plus metadata
+	Resolve the filepaths of primary and alternative files in as few
+	RS round trips as possible.
+
+	- Primary paths for a whole batch of resources are asked for in one
+		get_resource_path call with a JSON array of refs, where RS supports
+		that; otherwise they fall back to one call per resource.
+	- get_resource_path only takes a single alternative ref at a time, so
+		if we know where the RS filestore lives (i.e. we are running on the
+		RS host) alternative paths are derived locally from RS's filestore
+		layout and RS is only asked for the ones that aren't found on disk.
 	'''
+	# how many refs to put in one batched get_resource_path call
+	batchSize = 100
+
 	def __init__(
 		self,
-		rsAssetID = None,
-		# localAssetPaths=None,
-		assetMetadata = {},
-		_user = None,
-		mediaType = None
+		_user=None,
+		mediaType=None,
+		filestore=None,
+		scrambleKey=None
 		):
-		self.localAssetPaths = []
-		self.assetMetadata = assetMetadata
-		self.identifier = None
-		self.creator = None
-		self.title = None
-		self.date = None
-		self.subject = None
-		self.description = None
-		self.notes = None
-		self.mediaType = mediaType
-		self.rsAssetID = self.assetMetadata['Resource ID(s)'] # this value will come from a metadata CSV file
-		self.collection = ['stream_only','pacificfilmarchive'] # collection can be an array
-		#self.license = 'https://creativecommons.org/licenses/by-nc-nd/4.0/'
 		self._user = _user
+		self.mediaType = mediaType
+		self.filestore = filestore
+		self.scrambleKey = scrambleKey
 		self.rsAPI = ResourceSpaceAPI(_user)
+		self.primaryPaths = {}
+		self._lock = threading.Lock()
 
-	def get_local_asset_path(self):
+	def prefetch_primary_paths(self,refs):
+		'''
+		Look up the primary path of every ref in refs ahead of time,
+		batchSize refs per query.
+		'''
+		refs = [str(ref) for ref in refs if ref not in (None,'')]
+		for i in range(0,len(refs),self.batchSize):
+			chunk = refs[i:i+self.batchSize]
+			try:
+				if not self._prefetch_chunk(chunk):
+					return
+			except RSUnavailable as e:
+				# each resource gets looked up (and retried) on its own
+				print("COULDN'T LOOK UP PRIMARY PATHS AHEAD OF TIME: {}".format(e))
+				return
+
+	def _prefetch_chunk(self,chunk):
+		# False if this RS can't look up paths in batches
+		with metrics.span('rs_prefetch',refs=len(chunk)) as span:
+			parameters = (
+				"param1={}"
+				"&param2=1"
+				"&param3="
+				"&param4="
+				"&param5={}".format(
+					urllib.parse.quote(json.dumps([int(ref) for ref in chunk if ref.isdigit()])),
+					self.mediaType
+					)
+				)
+			result = self.rsAPI.query(
+				"get_resource_path",
+				parameters,
+				self._user,
+				raw=True,
+				operation="get_resource_path (batch)"
+				)
+			try:
+				paths = json.loads(result)
+			except (TypeError,ValueError):
+				paths = None
+			if not isinstance(paths,dict):
+				# this RS doesn't do batched lookups; resolve_primary_path()
+				# will ask for each ref as it comes
+				print("BATCHED PATH LOOKUP NOT SUPPORTED, FALLING BACK TO ONE QUERY PER RESOURCE")
+				span.outcome = metrics.FAILED
+				return False
+			with self._lock:
+				for ref, path in paths.items():
+					if path:
+						self.primaryPaths[str(ref)] = path
+
+		return True
+
+	def resolve_primary_path(self,ref):
+		with self._lock:
+			if str(ref) in self.primaryPaths:
+				return self.primaryPaths[str(ref)]
+		if self.filestore:
+			path = self.derive_filestore_path(ref,self.mediaType)
+			if os.path.isfile(path):
+				return path
 		# see https://www.resourcespace.com/knowledge-base/api/get_resource_path
 		# construct parameters of API call as a string
 		parameters = (
@@ -168,60 +395,71 @@ class Asset:
 			"&param3="
 			"&param4="
 			"&param5={}".format(
-				self.rsAssetID,
+				ref,
 				self.mediaType
 				)
 			)
-		# query API for filepath of primary asset as hosted on ResourceSpace - COMMENTED OUT FOR TESTING
-		self.primaryAssetPath = self.rsAPI.query(
+		return self.rsAPI.query(
 			"get_resource_path",
 			parameters,
 			self._user
 			)
 
-		### THIS IS FAKE STUFF FOR TESTING. THERE ARE 3 FAKE FILES: 1bampfaTVTV.mp4, 2bampfaTVTV.mp4, 3bampfaTVTV.mp4
-		# global counter
-		# self.primaryAssetPath = os.path.join("/Users/bampfa/Documents/GitHub/rs2ia/fakes/",str(counter)+"bampfaTVTV.mp4")
-		# counter += 1
-		# END FAKE STUFF FOR TESTING
-
-		print("PRIMARY ASSET PATH:")
-		print(self.primaryAssetPath)
-		self.localAssetPaths.append(self.primaryAssetPath)
-
-	def get_local_alternative_asset_paths(self):
-		# get filepaths for alternative files associated with the primary asset.
+	def get_alternatives(self,ref):
+		'''
+		Return the raw get_alternative_files response for a resource and a
+		{alternative ref: file extension} dict parsed from it.
+		'''
 		# see https://www.resourcespace.com/knowledge-base/api/get_alternative_files
 		# construct parameters of API call as a string
-		parameters = "param1={}&param2=&param3=".format(self.rsAssetID)
+		parameters = "param1={}&param2=&param3=".format(ref)
 		# query API; result is a dictionary of information about
 		# the alternative files, but no actual filepaths
 		# also, it's not a valid Python dict, it's maybe a PHP array?
-		self.alternativeAssetDict = self.rsAPI.query(
+		alternativeAssetDict = self.rsAPI.query(
 			"get_alternative_files",
 			parameters,
 			self._user
 			)
-		print("ALT ASSETS FROM RS:")
-		print(self.alternativeAssetDict)
 
-		# get the ref ID for each alternative asset and make a new query with that ID
+		# get the ref ID for each alternative asset
 		# there should be a 1:1 relationship between
 		# the matched ref #'s and file extensions
+		if alternativeAssetDict is None:
+			raise stageretry.StageError(
+				'rs_alternatives',
+				"RS returned nothing for get_alternative_files on resource {}".format(ref)
+				)
 		alts = {}
-		refNumbers = [ref[1] for ref in re.findall(r"({ref\:)([0-9]+)",self.alternativeAssetDict)]
-		extensions = [ext[1] for ext in re.findall(r"(,file_extension:)(\w{0,4})",self.alternativeAssetDict)]
+		refNumbers = [ref[1] for ref in re.findall(r"({ref\:)([0-9]+)",alternativeAssetDict)]
+		extensions = [ext[1] for ext in re.findall(r"(,file_extension:)(\w{0,4})",alternativeAssetDict)]
 		if not len(refNumbers) == len(extensions):
 			print("ALTERNATIVE FILE MISMATCH BTW EXTENSIONS AND NUM OF FILES")
-			sys.exit
-		for ref in refNumbers:
-			alts[ref] = extensions[refNumbers.index(ref)]
-
-		for ref, ext in alts.items():
-			# print("ALT FILE EXTENSION")
-			# print(ext)
-			# print("ALT FILE REFERENCE NUMBER")
-			# print(ref)
+			raise stageretry.StageError(
+				'rs_alternatives',
+				"{} alternative files but {} extensions for resource {}".format(
+					len(refNumbers),
+					len(extensions),
+					ref
+					)
+				)
+		for altRef in refNumbers:
+			alts[altRef] = extensions[refNumbers.index(altRef)]
+
+		return alternativeAssetDict, alts
+
+	def resolve_alternative_paths(self,ref,alts):
+		'''
+		Get a filepath for each {alternative ref: extension} in alts,
+		from the filestore if we can, otherwise from RS.
+		'''
+		paths = []
+		for altRef, ext in alts.items():
+			if self.filestore:
+				path = self.derive_filestore_path(ref,ext,alternative=altRef)
+				if os.path.isfile(path):
+					paths.append(path)
+					continue
 			new_parameters = (
 				"param1={}"
 				"&param2=1"
@@ -231,17 +469,125 @@ class Asset:
 				"&param6="
 				"&param7="
 				"&param8={}".format(
-					self.rsAssetID,
+					ref,
 					ext,
-					ref
+					altRef
 					)
 				)
-			alternativeAssetPath = self.rsAPI.query(
+			path = self.rsAPI.query(
 				"get_resource_path",
 				new_parameters,
 				self._user
 				)
-			self.localAssetPaths.append(alternativeAssetPath)
+			if path in (None,''):
+				raise stageretry.StageError(
+					'rs_alternatives',
+					"RS has no path for alternative {} of resource {}".format(altRef,ref)
+					)
+			paths.append(path)
+
+		return paths
+
+	def derive_filestore_path(self,ref,extension,alternative=None):
+		'''
+		Rebuild a file's path the way ResourceSpace's own get_resource_path()
+		does: one folder per digit of the ref, with the scramble hash tacked
+		onto the last folder and onto the filename if $scramble_key is set.
+		e.g. ref 1234, alt 56 -> filestore/1/2/3/4_<hash>/1234_alt_56_<hash>.mp4
+		'''
+		ref = str(ref)
+		altPart = "_alt_{}".format(alternative) if alternative else ""
+		folders = list(ref)
+		if self.scrambleKey:
+			folders[-1] += "_"+hashlib.md5(
+				(ref+"_resource_path_"+self.scrambleKey).encode()
+				).hexdigest()[:15]
+			filename = "{}{}_{}.{}".format(
+				ref,
+				altPart,
+				hashlib.md5((ref+altPart+self.scrambleKey).encode()).hexdigest()[:15],
+				extension
+				)
+		else:
+			filename = "{}{}.{}".format(ref,altPart,extension)
+
+		return os.path.join(self.filestore,*folders,filename)
+
+class Asset:
+	'''
+	Define an asset, which could be simple (one file)
+	or complex (a set of files), plus metadata
+	'''
+	def __init__(
+		self,
+		rsAssetID = None,
+		# localAssetPaths=None,
+		assetMetadata = {},
+		_user = None,
+		mediaType = None,
+		resolver = None,
+		preflight = None,
+		uploader = None
+		):
+		self.localAssetPaths = []
+		# files confirmed on IA, so a retried upload doesn't send them again
+		self.sent = set()
+		self.assetMetadata = assetMetadata
+		self.failureReason = None
+		self.identifier = None
+		self.creator = None
+		self.title = None
+		self.date = None
+		self.subject = None
+		self.description = None
+		self.notes = None
+		self.mediaType = mediaType
+		self.rsAssetID = self.assetMetadata['Resource ID(s)'] # this value will come from a metadata CSV file
+		self.collection = ['stream_only','pacificfilmarchive'] # collection can be an array
+		#self.license = 'https://creativecommons.org/licenses/by-nc-nd/4.0/'
+		self._user = _user
+		self.rsAPI = ResourceSpaceAPI(_user)
+		if resolver is None:
+			resolver = PathResolver(_user,mediaType)
+		self.resolver = resolver
+		# a preflight.Preflight that knows what's already on IA, if we checked
+		self.preflight = preflight
+		# a multipart.MultipartUploader for files too big for one PUT
+		self.uploader = uploader
+
+	def get_local_asset_path(self):
+		# query API for filepath of primary asset as hosted on ResourceSpace
+		# (or take it from the resolver if it was already looked up in a batch)
+		with metrics.span('rs_primary_path',item=self.rsAssetID) as span:
+			self.primaryAssetPath = self.resolver.resolve_primary_path(self.rsAssetID)
+			if self.primaryAssetPath in (None,''):
+				span.outcome = metrics.FAILED
+				raise stageretry.StageError(
+					'rs_primary_path',
+					"RS has no {} file for resource {}".format(self.mediaType,self.rsAssetID)
+					)
+
+		### THIS IS FAKE STUFF FOR TESTING. THERE ARE 3 FAKE FILES: 1bampfaTVTV.mp4, 2bampfaTVTV.mp4, 3bampfaTVTV.mp4
+		# global counter
+		# self.primaryAssetPath = os.path.join("/Users/bampfa/Documents/GitHub/rs2ia/fakes/",str(counter)+"bampfaTVTV.mp4")
+		# counter += 1
+		# END FAKE STUFF FOR TESTING
+
+		print("PRIMARY ASSET PATH:")
+		print(self.primaryAssetPath)
+		self.localAssetPaths.append(self.primaryAssetPath)
+
+	def get_local_alternative_asset_paths(self):
+		# get filepaths for alternative files associated with the primary asset.
+		with metrics.span('rs_alternatives',item=self.rsAssetID) as span:
+			self.alternativeAssetDict, alts = self.resolver.get_alternatives(self.rsAssetID)
+			print("ALT ASSETS FROM RS:")
+			print(self.alternativeAssetDict)
+
+			self.localAssetPaths.extend(
+				self.resolver.resolve_alternative_paths(self.rsAssetID,alts)
+				)
+			span.labels['files'] = len(alts)
 
 		print("ALL ASSET PATHS:")
 		print(self.localAssetPaths)
@@ -255,6 +601,8 @@ class Asset:
 			ResourceSpace search.
 		For more info: archive.org Python Library: https://archive.org/services/docs/api/internetarchive/quickstart.html#metadata
 			and archive.org metadata schema: https://archive.org/services/docs/api/metadata-schema/index.html
+		Returns True, or raises stageretry.StageError (and sets
+		failureReason) if anything didn't make it.
 		'''
 		self.get_core_metadata(self.assetMetadata)
 
@@ -290,10 +638,10 @@ class Asset:
 			md['frames_per_second'] = self.assetMetadata['Frame rate']
 			# 'video size' column should be split into 'Video height' and 'Video width' numbers manually by operator
 			md['source_pixel_width'] = self.assetMetadata['Video height']
-			md['source_pixel_height'] = self.assetMetadata['Video width'],
+			md['source_pixel_height'] = self.assetMetadata['Video width']
 			# 'PFA full accession number' column should be normalized to 'urn:bampfa_accession_number:XXXX' manually by operator
-			md['external-identifier'] = self.assetMetadata['PFA full accession number'],
-			md['sound'] = self.assetMetadata['PFA item sound characteristics'],
+			md['external-identifier'] = self.assetMetadata['PFA full accession number']
+			md['sound'] = self.assetMetadata['PFA item sound characteristics']
 			md['color'] = self.assetMetadata['Color characteristics']
 		elif self.mediaType == 'mp3':
 			md['mediatype'] = 'audio'
@@ -312,18 +660,71 @@ class Asset:
 		# from the ia package documentation:
 		# r = upload('<identifier>', files=['foo.txt', 'bar.mov'], metadata=md)
 		# archive.org Python Library, 'uploading': https://archive.org/services/docs/api/internetarchive/quickstart.html#uploading
-		result = False
-		uploaded = "Didn't get to upload"
-		try:
-			r = upload(self.identifier, files=self.localAssetPaths, metadata=md)
-			if r[0].status_code == 200:
-				uploaded = "Uploaded"
-				result = True
-		except Exception as e:
-			print(e)
-			uploaded = "Upload failed"
-		print(uploaded)
-		return result
+		with metrics.span('ia_upload',item=self.identifier) as span:
+			filesToSend = self.localAssetPaths
+			if self.preflight is not None:
+				filesToSend = self.preflight.files_to_send(self.identifier,self.localAssetPaths)
+				if filesToSend == []:
+					print("ALL FILES ARE ALREADY ON ARCHIVE.ORG, NOTHING TO UPLOAD")
+					span.outcome = metrics.SKIPPED
+					return True
+				elif len(filesToSend) < len(self.localAssetPaths):
+					print("ONLY UPLOADING NEW/CHANGED FILES:")
+					print(filesToSend)
+			span.bytes = sum(os.path.getsize(x) for x in filesToSend if x and os.path.isfile(x))
+			span.labels['files'] = len(filesToSend)
+			# big files go up in parts that can be retried and resumed
+			# on their own; the rest in one go as before
+			largeFiles = []
+			if self.uploader is not None:
+				largeFiles = [x for x in filesToSend if self.uploader.is_large(x)]
+			smallFiles = [x for x in filesToSend if x not in largeFiles and x not in self.sent]
+			try:
+				if smallFiles:
+					self.send_files(smallFiles,md)
+				for path in largeFiles:
+					if path in self.sent:
+						continue
+					print("UPLOADING {} IN PARTS".format(path))
+					self.uploader.upload(self.identifier,path,metadata=md)
+					self.sent.add(path)
+			except Exception as e:
+				print(e)
+				print("Upload failed")
+				self.failureReason = stageretry.describe(e)
+				span.outcome = metrics.FAILED
+				span.labels['error'] = self.failureReason
+				raise stageretry.StageError(
+					'ia_upload',
+					self.failureReason,
+					stageretry.is_transient(e)
+					) from e
+			print("Uploaded")
+			return True
+
+	def send_files(self,paths,md):
+		'''
+		Upload paths one at a time, hashing each file as it's read for
+		the upload, and check what archive.org got against it. Raises
+		stageretry.StageError for the first one that didn't make it.
+		'''
+		for path, body, response in multipart.put_files(self.identifier,paths,md):
+			if response.status_code != 200:
+				raise stageretry.StageError(
+					'ia_upload',
+					"archive.org returned HTTP {} for {}".format(response.status_code,path),
+					response.status_code >= 500
+					)
+			if body.complete():
+				if not multipart.etag_matches(response,body.digest.md5):
+					# it got mangled on the way; sending it again should do
+					raise stageretry.StageError(
+						'ia_upload',
+						"archive.org got a different md5 for {}".format(path),
+						transient=True
+						)
+				fingerprints.remember(path,body.digest)
+			self.sent.add(path)
 
 	def get_core_metadata(self,assetMetadata):
 		'''
@@ -381,53 +782,244 @@ class Asset:
 		except:
 			self.identifier = self.assetMetadata['Access copy filename']
 
-def parse_resourcespace_csv(csvPath,_user, mediaType):
+def process_row(
+	row,
+	_user,
+	mediaType,
+	rsLimit,
+	iaLimit,
+	resolver=None,
+	_journal=None,
+	_preflight=None,
+	_uploader=None
+	):
+	'''
+	Run one Asset through its whole lifecycle: resolve the primary path,
+	resolve the alternatives, then upload. rsLimit and iaLimit are
+	semaphores that cap how many workers can be talking to RS or
+	uploading to IA at any one time.
+	Each stage is written to _journal (if there is one) as soon as it's
+	done, and paths resolved in an earlier, interrupted run are reused.
+
+	A stage that fails in a transient way (see stageretry.py) is tried
+	again on its own, without the stages before it. Returns True if the
+	asset made it to IA, or raises stageretry.StageError saying which
+	stage failed and why.
+	'''
+	# the Asset class __init__ function defines the asset's rsAssetID, which will be stored in the same CSV row as the rest of the metadata
+	currentAsset = Asset(
+		assetMetadata=row,
+		_user=_user,
+		mediaType=mediaType,
+		resolver=resolver,
+		preflight=_preflight,
+		uploader=_uploader
+		)
+	resolvedPaths = None
+	if _journal is not None:
+		resolvedPaths = _journal.resolved_paths(currentAsset.rsAssetID)
+	try:
+		if resolvedPaths:
+			currentAsset.localAssetPaths = resolvedPaths
+		else:
+			# get_local_asset_path uses the rsAssetID to find the local filepath of the asset
+			stageretry.retry(
+				'rs_primary_path',
+				currentAsset.get_local_asset_path,
+				hold=rsLimit,
+				destination='rs'
+				)
+			stageretry.retry(
+				'rs_alternatives',
+				currentAsset.get_local_alternative_asset_paths,
+				hold=rsLimit,
+				destination='rs'
+				)
+			if _journal is not None:
+				_journal.record(
+					currentAsset.rsAssetID,
+					journal.RESOLVED,
+					paths=currentAsset.localAssetPaths
+					)
+		print(
+			currentAsset.rsAssetID,
+			currentAsset.localAssetPaths
+			)
+		stageretry.retry(
+			'ia_upload',
+			currentAsset.post_to_ia,
+			hold=iaLimit,
+			destination='ia'
+			)
+	except stageretry.StageError as e:
+		if _journal is not None:
+			_journal.record(
+				currentAsset.rsAssetID,
+				journal.FAILED,
+				reason=e.reason,
+				failedStage=e.stage,
+				kind=e.kind
+				)
+		raise
+	if _journal is not None:
+		_journal.record(
+			currentAsset.rsAssetID,
+			journal.UPLOADED,
+			identifier=currentAsset.identifier
+			)
+	rsAssetID = currentAsset.rsAssetID
+	del currentAsset
+	profiling.checkpoint(rsAssetID)
+
+	return True
+
+def parse_resourcespace_csv(
+	csvPath,
+	_user,
+	mediaType,
+	workers=1,
+	rsWorkers=None,
+	iaWorkers=None,
+	filestore=None,
+	scrambleKey=None,
+	_journal=None,
+	_preflight=None,
+	_uploader=None
+	):
 	'''
 	1. Interpret metadata CSV as a 'key:value' dictionary, using the first row
 		as the 'key', using DictReader
 	2. Assign the correct CSV row of metadata 'values' to the current asset
 	3. Post asset with metadata to archive.org (using post_to_ia, defined above)
+
+	With workers > 1 the rows are run through process_row() on a thread
+	pool, so RS lookups for some assets overlap with IA uploads for others.
+	rsWorkers and iaWorkers (default: workers) separately limit how many
+	of those workers can hit RS or IA at once.
+
+	Primary paths for the whole CSV are looked up up front in batches, and
+	if filestore is given alternative paths are worked out locally instead
+	of with one RS query each (see PathResolver).
+
+	Progress goes to _journal as it happens, and rows the journal already
+	has as uploaded (i.e. when resuming) are skipped.
+
+	If a preflight.Preflight is given, every identifier in the CSV is
+	checked against archive.org first and only missing or changed files
+	get uploaded.
+
+	Files at least as big as _uploader's threshold (a
+	multipart.MultipartUploader) are sent in parts; see multipart.py.
+
+	Each stage of each row is retried on its own if it fails in a
+	transient way. Rows that fail anyway are listed, with the stage and
+	the reason, in <csv name>_failures.csv. Returns the path to a CSV of
+	the rows that ran out of retries on a transient failure (worth
+	redoing later), or False; rows that failed permanently need fixing
+	first and aren't in it.
 	'''
 	failed_to_redo = []
+	# [(row, stageretry.StageError), ...]
+	failed = []
 	tempCSVpath = "{}_tempCSV{}".format(
 		os.path.splitext(csvPath)[0],
 		os.path.splitext(csvPath)[1])
+	failuresPath = "{}_failures.csv".format(os.path.splitext(csvPath)[0])
+	rsWorkers = rsWorkers or workers
+	iaWorkers = iaWorkers or workers
+	rsLimit = threading.BoundedSemaphore(rsWorkers)
+	iaLimit = threading.BoundedSemaphore(iaWorkers)
+
 	with open(csvPath) as _file:
-		records = csv.DictReader(_file)
+		records = list(csv.DictReader(_file))
+	if _journal is not None:
+		done = [row for row in records if _journal.is_done(row['Resource ID(s)'])]
+		if done:
+			print("SKIPPING {} OF {} RECORDS ALREADY UPLOADED".format(
+				len(done),
+				len(records)
+				))
+		records = [row for row in records if not _journal.is_done(row['Resource ID(s)'])]
+	if _preflight is not None:
+		identifiers = []
 		for row in records:
-			# the Asset class __init__ function defines the asset's rsAssetID, which will be stored in the same CSV row as the rest of the metadata
-			currentAsset = Asset(
-				assetMetadata=row,
-				_user=_user,
-				mediaType=mediaType
-				)
-			# get_local_asset_path uses the rsAssetID to find the local filepath of the asset
-			currentAsset.get_local_asset_path()
+			_asset = Asset(assetMetadata=row,_user=_user,mediaType=mediaType)
 			try:
-				currentAsset.get_local_alternative_asset_paths()
-			except:
-				pass
-			print(
-				currentAsset.rsAssetID,
-				currentAsset.localAssetPaths
+				_asset.get_core_metadata(row)
+			except KeyError:
+				# leave it to the upload stage to complain about bad rows
+				continue
+			identifiers.append(_asset.identifier)
+		with metrics.span('ia_preflight',items=len(identifiers)):
+			_preflight.check(identifiers)
+	resolver = PathResolver(_user,mediaType,filestore,scrambleKey)
+	resolver.prefetch_primary_paths([
+		row['Resource ID(s)'] for row in records
+		if not (_journal and _journal.resolved_paths(row['Resource ID(s)']))
+		])
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [
+			executor.submit(
+				process_row,
+				row,
+				_user,
+				mediaType,
+				rsLimit,
+				iaLimit,
+				resolver,
+				_journal,
+				_preflight,
+				_uploader
 				)
-			result = currentAsset.post_to_ia()
-			if result:
-				del currentAsset
-			else:
-				failed_to_redo.append(row)
+			for row in records
+			]
+		# walk the futures in CSV order so the redo CSV keeps the original order
+		for row, future in zip(records,futures):
+			try:
+				future.result()
+			except stageretry.StageError as e:
+				failed.append((row,e))
+			except Exception as e:
+				# something process_row didn't see coming
+				print(e)
+				error = stageretry.StageError(
+					'process_row',
+					stageretry.describe(e),
+					stageretry.is_transient(e)
+					)
+				if _journal is not None:
+					_journal.record(
+						row['Resource ID(s)'],
+						journal.FAILED,
+						reason=error.reason,
+						failedStage=error.stage,
+						kind=error.kind
+						)
+				failed.append((row,error))
 
+	if failed:
+		with open(failuresPath,'w') as f:
+			writer = csv.writer(f)
+			writer.writerow(['Resource ID(s)','stage','kind','reason'])
+			for row, error in failed:
+				print("FAILED TO UPLOAD TO ARCHIVE.ORG:")
+				print("{} AT {} ({}): {}".format(row['Resource ID(s)'],error.stage,error.kind,error.reason))
+				writer.writerow([row['Resource ID(s)'],error.stage,error.kind,error.reason])
+		print("{} FAILED ({} PERMANENTLY), SEE {}".format(
+			len(failed),
+			len([x for x in failed if not x[1].transient]),
+			failuresPath
+			))
+		failed_to_redo = [row for row, error in failed if error.transient]
 	if len(failed_to_redo) > 0:
 		with open(tempCSVpath,'w') as f:
 			writer = csv.DictWriter(f,failed_to_redo[0].keys())
 			writer.writeheader()
 			for record in failed_to_redo:
-				print("FAILED TO UPLOAD TO ARCHIVE.ORG:")
-				print(record['Resource ID(s)'])
 				writer.writerow(record)
-		os.remove(csvPath)
-		csvPath = tempCSVpath.replace("_tempCSV",'')
-		result = csvPath
+		# keep the original CSV around; the journal refers back to it
+		# if this run gets resumed
+		result = tempCSVpath
 	else:
 		result = False
 
@@ -469,7 +1061,310 @@ def define_resourcespace_csv():
 
 	return csvPath
 
+def configure_limits(workers,rsWorkers=None,iaWorkers=None,partWorkers=1):
+	'''
+	Adaptive limits (see ratelimit.py) on requests in flight to RS and
+	archive.org, starting from (and never going over) what the worker
+	counts allow.
+	'''
+	ratelimit.configure('rs',rsWorkers or workers)
+	ratelimit.configure('ia',(iaWorkers or workers)*partWorkers)
+
+def set_args(argv=None):
+	parser = argparse.ArgumentParser(
+		description="Publish a ResourceSpace collection CSV to archive.org"
+		)
+	parser.add_argument(
+		'--daemon',
+		default=None,
+		metavar='CONFIG',
+		help="don't ask for anything: keep processing CSVs dropped into the "
+			"spool directory given in CONFIG's [rs2ia] section, with the "
+			"rest of the options from there too; see spool.py"
+		)
+	parser.add_argument(
+		'-w','--workers',
+		type=int,
+		default=1,
+		help="number of assets to process at once (default: 1, one row at a time)"
+		)
+	parser.add_argument(
+		'--rs-workers',
+		type=int,
+		default=None,
+		help="max concurrent ResourceSpace lookups (default: same as --workers)"
+		)
+	parser.add_argument(
+		'--ia-workers',
+		type=int,
+		default=None,
+		help="max concurrent archive.org uploads (default: same as --workers)"
+		)
+	parser.add_argument(
+		'--filestore',
+		default=None,
+		help="path to the RS filestore (e.g. /var/www/resourcespace/filestore); "
+			"if set, alternative file paths are worked out locally instead of "
+			"asking RS for each one"
+		)
+	parser.add_argument(
+		'--scramble-key',
+		default=os.environ.get('RS_SCRAMBLE_KEY'),
+		help="RS $scramble_key from config.php, needed with --filestore if "
+			"your RS scrambles filepaths (default: $RS_SCRAMBLE_KEY)"
+		)
+	parser.add_argument(
+		'--cache',
+		default='rs_cache.sqlite',
+		help="SQLite file to cache RS API responses in (default: rs_cache.sqlite)"
+		)
+	parser.add_argument(
+		'--cache-ttl',
+		type=int,
+		default=7*24*60*60,
+		help="seconds before a cached RS response goes stale (default: one week)"
+		)
+	parser.add_argument(
+		'--cache-size',
+		type=int,
+		default=50000,
+		help="max number of cached RS responses before the least recently "
+			"used ones are dropped (default: 50000)"
+		)
+	parser.add_argument(
+		'--journal',
+		default=None,
+		help="file to record each asset's progress in "
+			"(default: <csv name>_journal.jsonl next to the CSV)"
+		)
+	parser.add_argument(
+		'--resume',
+		action='store_true',
+		help="skip assets the journal says were already uploaded, and reuse "
+			"paths that were already resolved"
+		)
+	parser.add_argument(
+		'--no-preflight',
+		action='store_true',
+		help="don't check archive.org for items/files that are already there, "
+			"just upload everything"
+		)
+	parser.add_argument(
+		'--ia-metadata-url',
+		default=preflight.IA_METADATA_URL,
+		help="IA metadata API URL template used by the preflight check "
+			"(default: {})".format(preflight.IA_METADATA_URL.replace('{}','<identifier>'))
+		)
+	parser.add_argument(
+		'--fingerprints',
+		default='fingerprints.sqlite',
+		help="SQLite file to keep the md5/sha1 of files in, so files that "
+			"haven't changed are never hashed twice (default: fingerprints.sqlite)"
+		)
+	parser.add_argument(
+		'--no-fingerprints',
+		dest='fingerprints',
+		action='store_const',
+		const=None,
+		help="don't keep checksums between runs"
+		)
+	parser.add_argument(
+		'--multipart-threshold',
+		type=int,
+		default=multipart.DEFAULT_THRESHOLD//(1024*1024),
+		help="send files at least this many MB to archive.org in parts, "
+			"which are retried on their own and resumed after an interrupted "
+			"run (default: {})".format(multipart.DEFAULT_THRESHOLD//(1024*1024))
+		)
+	parser.add_argument(
+		'--part-size',
+		type=int,
+		default=multipart.DEFAULT_PART_SIZE//(1024*1024),
+		help="size in MB of each part of a multipart upload "
+			"(default: {})".format(multipart.DEFAULT_PART_SIZE//(1024*1024))
+		)
+	parser.add_argument(
+		'--part-workers',
+		type=int,
+		default=multipart.DEFAULT_WORKERS,
+		help="number of parts of one file to upload at once "
+			"(default: {})".format(multipart.DEFAULT_WORKERS)
+		)
+	parser.add_argument(
+		'--no-multipart',
+		action='store_true',
+		help="upload every file in a single request, however big"
+		)
+	parser.add_argument(
+		'--no-adaptive-limits',
+		action='store_true',
+		help="don't back off when RS or archive.org throttle us, just keep "
+			"up as many requests as the worker counts allow"
+		)
+	parser.add_argument(
+		'--stage-retries',
+		type=int,
+		default=stageretry.DEFAULT_ATTEMPTS,
+		help="how many times to try a stage of an item (an RS lookup, an upload) that "
+			"fails in a way that might clear up, before giving up on the "
+			"item (default: {})".format(stageretry.DEFAULT_ATTEMPTS)
+		)
+	parser.add_argument(
+		'--no-cache',
+		action='store_true',
+		help="always ask RS, don't read or write the response cache"
+		)
+	parser.add_argument(
+		'--spans',
+		default=None,
+		help="JSON lines file to log the timing of every stage to "
+			"(e.g. rs2ia_spans.jsonl)"
+		)
+	parser.add_argument(
+		'--prometheus',
+		default=None,
+		help="Prometheus textfile to write per-stage totals to, e.g. in the "
+			"node exporter's textfile collector directory"
+		)
+	parser.add_argument(
+		'--profile',
+		nargs='?',
+		const='',
+		default=None,
+		metavar='PREFIX',
+		help="profile the upload run with cProfile and save it to PREFIX.prof "
+			"(default PREFIX: rs2ia_<date>-<time>)"
+		)
+	parser.add_argument(
+		'--profile-memory',
+		action='store_true',
+		help="also track memory with tracemalloc, with a checkpoint after "
+			"each asset in PREFIX_memory.jsonl"
+		)
+
+	return parser.parse_args(argv)
+
+def set_up(args):
+	'''
+	Everything a run needs that can be kept from one CSV to the next:
+	metrics, caches, the RS session, limits, the preflight checker and
+	the uploader.
+	Returns the keyword arguments for parse_resourcespace_csv(), less
+	the journal.
+	'''
+	metrics.configure(args.spans,args.prometheus,job='rs2ia')
+	fingerprints.configure(args.fingerprints)
+	stageretry.configure(args.stage_retries)
+	if not args.no_cache:
+		ResourceSpaceAPI.cache = rscache.ResponseCache(
+			args.cache,
+			ttl=args.cache_ttl,
+			maxEntries=args.cache_size
+			)
+	rsWorkers = args.rs_workers or args.workers
+	if rsWorkers > RS_POOL_SIZE:
+		# keep enough live connections around for every RS worker; sized
+		# once here, not per CSV, so a daemon's batches share the pool
+		ResourceSpaceAPI.configure_session(
+			poolSize=rsWorkers,
+			connectTimeout=ResourceSpaceAPI.timeout[0],
+			readTimeout=ResourceSpaceAPI.timeout[1]
+			)
+	poolArgs = {
+		'workers':args.workers,
+		'rsWorkers':args.rs_workers,
+		'iaWorkers':args.ia_workers,
+		'filestore':args.filestore,
+		'scrambleKey':args.scramble_key,
+		'_preflight':None,
+		'_uploader':None
+		}
+	if not args.no_preflight:
+		poolArgs['_preflight'] = preflight.Preflight(
+			args.ia_metadata_url,
+			workers=max(args.workers,8)
+			)
+	if not args.no_multipart:
+		poolArgs['_uploader'] = multipart.MultipartUploader(
+			threshold=args.multipart_threshold*1024*1024,
+			partSize=args.part_size*1024*1024,
+			workers=args.part_workers
+			)
+	if not args.no_adaptive_limits:
+		configure_limits(
+			args.workers,
+			args.rs_workers,
+			args.ia_workers,
+			1 if args.no_multipart else args.part_workers
+			)
+
+	return poolArgs
+
+def tear_down():
+	if ResourceSpaceAPI.cache is not None:
+		print(ResourceSpaceAPI.cache.stats())
+		ResourceSpaceAPI.cache.close()
+	fingerprintIndex = fingerprints.get_index()
+	if fingerprintIndex is not None:
+		print(fingerprintIndex.stats())
+		fingerprintIndex.close()
+	if ratelimit.summary():
+		print(ratelimit.summary())
+	recorder = metrics.get_recorder()
+	print(recorder.summary_table())
+	recorder.close()
+
+def run_daemon(args):
+	'''
+	Process batch CSVs from the spool one after another (see spool.py),
+	with the same RS session, caches, limits and uploader throughout.
+	Rows that fail in a transient way get `redo` more passes (default 1)
+	before the batch is given up on.
+	'''
+	config = spool.load_config(args.daemon)
+	args = set_args(spool.config_args(config,'rs2ia')+sys.argv[1:])
+	section = config['rs2ia'] if config.has_section('rs2ia') else {}
+	if 'spool' not in section:
+		print("{} NEEDS A spool = <directory> IN ITS [rs2ia] SECTION".format(args.daemon))
+		sys.exit(1)
+	_user = environment_user()
+	poolArgs = set_up(args)
+	recorder = metrics.get_recorder()
+
+	def process(batch):
+		recorder.new_batch()
+		mediaType = spool.media_type(batch.option('media-type',section.get('media-type')))
+		redo = int(batch.option('redo',section.get('redo',1)))
+		journalPath = os.path.splitext(batch.csvPath)[0]+"_journal.jsonl"
+		_journal = journal.Journal(journalPath,resume=batch.resumed)
+		try:
+			result = parse_resourcespace_csv(batch.csvPath,_user,mediaType,_journal=_journal,**poolArgs)
+			while result != False and redo > 0:
+				print("REDOING RECORDS THAT FAILED ON WHAT MIGHT BE A PASSING PROBLEM")
+				result = parse_resourcespace_csv(result,_user,mediaType,_journal=_journal,**poolArgs)
+				redo -= 1
+			with open(batch.csvPath) as f:
+				ok = all(_journal.is_done(row['Resource ID(s)']) for row in csv.DictReader(f))
+		finally:
+			_journal.close()
+			recorder.write_prometheus()
+		print(recorder.summary_table(batch=True))
+
+		return ok
+
+	spool.serve(
+		spool.Spool(section['spool'],float(section.get('settle',spool.DEFAULT_SETTLE))),
+		process,
+		poll=float(section.get('poll',spool.DEFAULT_POLL))
+		)
+	tear_down()
+
 def main():
+	args = set_args()
+	if args.daemon:
+		run_daemon(args)
+		return
+	poolArgs = set_up(args)
 	_user = User()
 	print("Hello, "+_user.rsUserName)
 	csvPath = define_resourcespace_csv()
@@ -485,15 +1380,35 @@ def main():
 		print("YOU ENTERED AN INVALID MEDIA TYPE! JUST TYPE a OR v")
 		sys.exit()
 	print(mediaType)
-	result = parse_resourcespace_csv(csvPath,_user,mediaType)
+	journalPath = args.journal
+	if journalPath is None:
+		journalPath = os.path.splitext(csvPath)[0]+"_journal.jsonl"
+	poolArgs['_journal'] = journal.Journal(journalPath,resume=args.resume)
+	print("RECORDING PROGRESS IN "+journalPath)
+	profilePrefix = None
+	if args.profile is not None or args.profile_memory:
+		profilePrefix = args.profile or profiling.default_prefix('rs2ia')
+		profiling.start(
+			profilePrefix,
+			cpu=args.profile is not None,
+			memory=args.profile_memory
+			)
+	result = parse_resourcespace_csv(csvPath,_user,mediaType,**poolArgs)
+	if profilePrefix is not None:
+		# don't count time sitting at the redo prompt
+		for path in profiling.stop():
+			print("PROFILE WRITTEN TO "+path)
 	if result != False:
 		# i.e., if a csv of records to redo gets returned
-		redo = input("Some records failed to load. If you want to redo, "
+		redo = input("Some records failed on what might be a passing problem. "
+			"If you want to redo them, "
 			"type 'r' and enter, otherwise just hit enter and I will quit.")
 		if redo == 'r':
-			parse_resourcespace_csv(result,_user,mediaType)
+			parse_resourcespace_csv(result,_user,mediaType,**poolArgs)
 		else:
 			print("BYE!")
+	poolArgs['_journal'].close()
+	tear_down()
 
 if __name__ == "__main__":
 	main()
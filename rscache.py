@@ -0,0 +1,119 @@
+'''
+On-disk cache for ResourceSpace API responses, so that redo runs and
+repeated dry runs over the same collection don't ask RS the same
+questions over and over.
+
+Entries are keyed by RS user + function + parameters (users can see
+different things) and kept in a small SQLite database. They expire after
+`ttl` seconds, and once there are more than `maxEntries` the least
+recently used ones get evicted. Eviction runs every EVICT_EVERY inserts
+rather than on each one, so the table can run over by that many for a
+while.
+'''
+
+import sqlite3
+import threading
+import time
+
+EVICT_EVERY = 500
+
+class ResponseCache:
+	def __init__(self,path='rs_cache.sqlite',ttl=7*24*60*60,maxEntries=50000):
+		self.path = path
+		self.ttl = ttl
+		self.maxEntries = maxEntries
+		self.hits = 0
+		self.misses = 0
+		self._inserts = 0
+		self._lock = threading.Lock()
+		# one connection shared by all worker threads, guarded by _lock
+		self._db = sqlite3.connect(path,check_same_thread=False)
+		columns = [x[1] for x in self._db.execute("PRAGMA table_info(responses)")]
+		if columns and 'user' not in columns:
+			# from before entries were kept per user; it's only a cache
+			self._db.execute("DROP TABLE responses")
+		self._db.execute(
+			"CREATE TABLE IF NOT EXISTS responses ("
+			"user TEXT, "
+			"function TEXT, "
+			"parameters TEXT, "
+			"response TEXT, "
+			"created REAL, "
+			"last_access REAL, "
+			"PRIMARY KEY (user, function, parameters))"
+			)
+		self._db.execute(
+			"CREATE INDEX IF NOT EXISTS responses_last_access "
+			"ON responses (last_access)"
+			)
+		self._db.execute(
+			"CREATE INDEX IF NOT EXISTS responses_created "
+			"ON responses (created)"
+			)
+		with self._lock:
+			self._evict()
+		self._db.commit()
+
+	def get(self,user,function,parameters):
+		'''
+		Return the cached response, or None if there isn't a fresh one.
+		'''
+		now = time.time()
+		with self._lock:
+			row = self._db.execute(
+				"SELECT response, created FROM responses "
+				"WHERE user=? AND function=? AND parameters=?",
+				(user,function,parameters)
+				).fetchone()
+			if row is None or (self.ttl and now - row[1] > self.ttl):
+				self.misses += 1
+				return None
+			self._db.execute(
+				"UPDATE responses SET last_access=? "
+				"WHERE user=? AND function=? AND parameters=?",
+				(now,user,function,parameters)
+				)
+			self._db.commit()
+			self.hits += 1
+
+		return row[0]
+
+	def set(self,user,function,parameters,response):
+		now = time.time()
+		with self._lock:
+			self._db.execute(
+				"INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?)",
+				(user,function,parameters,response,now,now)
+				)
+			self._inserts += 1
+			if self._inserts % EVICT_EVERY == 0:
+				self._evict()
+			self._db.commit()
+
+	def _evict(self):
+		# drop anything past its TTL, then the least recently used
+		# entries until we're back under maxEntries
+		if self.ttl:
+			self._db.execute(
+				"DELETE FROM responses WHERE created < ?",
+				(time.time()-self.ttl,)
+				)
+		count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+		if self.maxEntries and count > self.maxEntries:
+			self._db.execute(
+				"DELETE FROM responses WHERE rowid IN ("
+				"SELECT rowid FROM responses ORDER BY last_access LIMIT ?)",
+				(count-self.maxEntries,)
+				)
+
+	def clear(self):
+		with self._lock:
+			self._db.execute("DELETE FROM responses")
+			self._db.commit()
+
+	def stats(self):
+		return "RS CACHE: {} hits, {} misses".format(self.hits,self.misses)
+
+	def close(self):
+		with self._lock:
+			self._db.close()
@@ -0,0 +1,257 @@
+'''
+Headless mode for rs2ia and randos2ia: watch a spool directory for
+batch CSVs and process them back to back in one long-lived process, so
+connection pools, caches and API clients stay warm from one batch to
+the next and nobody has to be at the keyboard.
+
+	<spool>/incoming/   drop batch CSVs here (write them somewhere else
+	                    and mv them in, so a half-written file is never
+	                    picked up)
+	<spool>/working/    the batch being processed, in a directory of its
+	                    own along with its journal and failure report
+	<spool>/done/       batches where everything made it
+	<spool>/failed/     batches where something didn't (see the
+	                    _failures.csv inside) or that couldn't be run
+
+A batch can have options of its own in a JSON file with the same name
+as the CSV, e.g. tvtv_1976.csv and tvtv_1976.json containing
+{"media-type": "mp3"}; it has to be in place before the CSV is.
+
+Everything else comes from a config file, one section per script, with
+the script's command line options as keys (without the dashes) plus a
+few that only mean something here (DAEMON_KEYS):
+
+	[rs2ia]
+	spool = /var/spool/rs2ia
+	media-type = mp4
+	workers = 8
+	no-preflight = false
+
+Credentials come from the environment, never the config file.
+
+A batch left in working/ by a run that died is picked up again first
+(rs2ia resumes it from its journal). SIGTERM or SIGINT stops the loop once the
+current batch is done. Under systemd (Type=notify) it says when it's
+ready and what it's working on.
+'''
+
+import configparser
+import datetime
+import json
+import os
+import shutil
+import signal
+import socket
+import threading
+import time
+import traceback
+
+# config keys for the spool loop itself rather than the script's options
+DAEMON_KEYS = ('spool','poll','settle','media-type','folders','redo')
+DEFAULT_POLL = 30
+# seconds a CSV has to sit unchanged in incoming/ before it's picked up
+DEFAULT_SETTLE = 5
+MEDIA_TYPES = {'mp4':'mp4','video':'mp4','v':'mp4','mp3':'mp3','audio':'mp3','a':'mp3'}
+
+class Batch:
+	def __init__(self,directory,csvPath,resumed=False):
+		'''
+		directory: the batch's own directory under working/
+		resumed: it was left half done by an earlier run
+		'''
+		self.directory = directory
+		self.csvPath = csvPath
+		self.resumed = resumed
+		self.name = os.path.basename(directory)
+		self._options = None
+
+	@property
+	def options(self):
+		# read when first needed, so a broken JSON file fails the batch
+		# rather than the loop
+		if self._options is None:
+			self._options = {}
+			optionsPath = os.path.splitext(self.csvPath)[0]+".json"
+			if os.path.isfile(optionsPath):
+				with open(optionsPath) as f:
+					self._options = json.load(f)
+		return self._options
+
+	def option(self,key,default=None):
+		return self.options.get(key,default)
+
+class Spool:
+	def __init__(self,directory,settle=DEFAULT_SETTLE):
+		self.directory = directory
+		self.settle = settle
+		self.incoming = os.path.join(directory,'incoming')
+		self.working = os.path.join(directory,'working')
+		self.done = os.path.join(directory,'done')
+		self.failed = os.path.join(directory,'failed')
+		for path in (self.incoming,self.working,self.done,self.failed):
+			os.makedirs(path,exist_ok=True)
+
+	def interrupted(self):
+		# batches an earlier run was in the middle of
+		batches = []
+		for name in sorted(os.listdir(self.working)):
+			directory = os.path.join(self.working,name)
+			csvPath = os.path.join(directory,name+".csv")
+			if os.path.isfile(csvPath):
+				batches.append(Batch(directory,csvPath,resumed=True))
+
+		return batches
+
+	def pending(self):
+		'''
+		CSVs in incoming/ that have stopped changing, oldest first.
+		'''
+		now = time.time()
+		ready = []
+		for name in os.listdir(self.incoming):
+			path = os.path.join(self.incoming,name)
+			if name.startswith('.') or not name.lower().endswith('.csv'):
+				continue
+			try:
+				mtime = os.path.getmtime(path)
+			except OSError:
+				continue
+			if now-mtime >= self.settle:
+				ready.append((mtime,path))
+
+		return [path for mtime, path in sorted(ready)]
+
+	def claim(self,csvPath):
+		'''
+		Move a CSV (and its options, if any) from incoming/ into a
+		directory of its own under working/.
+		'''
+		name = os.path.splitext(os.path.basename(csvPath))[0]
+		directory = self._free_path(self.working,name)
+		os.makedirs(directory)
+		claimed = os.path.join(directory,os.path.basename(directory)+".csv")
+		os.replace(csvPath,claimed)
+		optionsPath = os.path.splitext(csvPath)[0]+".json"
+		if os.path.isfile(optionsPath):
+			os.replace(optionsPath,os.path.join(directory,os.path.basename(directory)+".json"))
+
+		return Batch(directory,claimed)
+
+	def finish(self,batch,ok):
+		destination = self._free_path(self.done if ok else self.failed,batch.name)
+		shutil.move(batch.directory,destination)
+
+		return destination
+
+	def _free_path(self,parent,name):
+		# the same CSV name can come round more than once
+		path = os.path.join(parent,name)
+		if os.path.exists(path):
+			path += datetime.datetime.now().strftime("_%Y%m%d-%H%M%S")
+		n = 1
+		candidate = path
+		while os.path.exists(candidate):
+			candidate = "{}_{}".format(path,n)
+			n += 1
+
+		return candidate
+
+def load_config(path):
+	config = configparser.ConfigParser()
+	with open(path) as f:
+		config.read_file(f)
+
+	return config
+
+def config_args(config,section):
+	'''
+	Turn a config section into command line arguments for the script's
+	set_args(): "workers = 8" -> ['--workers','8'], "no-cache = true" ->
+	['--no-cache'] ("false" leaves it out). "folders = a b" style values
+	are split on whitespace.
+	'''
+	argv = []
+	if not config.has_section(section):
+		return argv
+	for key, value in config.items(section):
+		if key in DAEMON_KEYS:
+			continue
+		if value.lower() in ('true','yes','on'):
+			argv.append('--'+key)
+		elif value.lower() in ('false','no','off',''):
+			continue
+		else:
+			argv.append('--'+key)
+			argv.extend(value.split())
+
+	return argv
+
+def media_type(value):
+	if value is None or value.lower() not in MEDIA_TYPES:
+		raise ValueError("media type must be mp4/video or mp3/audio, not {!r}".format(value))
+	return MEDIA_TYPES[value.lower()]
+
+def notify(message):
+	'''
+	Tell systemd something (e.g. "READY=1", "STATUS=...") if we're
+	running as a Type=notify service; otherwise do nothing.
+	'''
+	address = os.environ.get('NOTIFY_SOCKET')
+	if not address:
+		return
+	if address.startswith('@'):
+		# abstract namespace
+		address = '\0'+address[1:]
+	try:
+		with socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM) as sock:
+			sock.connect(address)
+			sock.sendall(message.encode())
+	except OSError as e:
+		print("COULDN'T NOTIFY SYSTEMD: {}".format(e))
+
+def serve(spool,process,poll=DEFAULT_POLL,stop=None):
+	'''
+	Run process(batch) on every batch that turns up in the spool, one
+	after another, until stop (a threading.Event) is set or a SIGTERM
+	or SIGINT comes in. process returns True if everything in the batch
+	made it; the batch goes to done/ or failed/ accordingly.
+	'''
+	if stop is None:
+		stop = threading.Event()
+
+	def request_stop(signum,frame):
+		print("STOPPING ONCE THE CURRENT BATCH IS DONE (AGAIN TO STOP NOW)")
+		notify("STOPPING=1")
+		stop.set()
+		signal.signal(signum,signal.SIG_DFL if signum == signal.SIGTERM else signal.default_int_handler)
+
+	for signum in (signal.SIGTERM,signal.SIGINT):
+		signal.signal(signum,request_stop)
+	notify("READY=1")
+	print("WATCHING {} FOR BATCHES".format(spool.incoming))
+	queued = spool.interrupted()
+	while not stop.is_set():
+		if not queued:
+			# one at a time, so what's still waiting can be taken back out
+			queued = [spool.claim(path) for path in spool.pending()[:1]]
+		if not queued:
+			notify("STATUS=Waiting for batches")
+			stop.wait(poll)
+			continue
+		batch = queued.pop(0)
+		print("STARTING BATCH {}{}".format(batch.name," (RESUMING)" if batch.resumed else ""))
+		notify("STATUS=Working on {}".format(batch.name))
+		started = time.monotonic()
+		try:
+			ok = process(batch)
+		except Exception:
+			traceback.print_exc()
+			ok = False
+		destination = spool.finish(batch,ok)
+		print("BATCH {} {} IN {:.0f}s, MOVED TO {}".format(
+			batch.name,
+			"FINISHED" if ok else "HAD FAILURES",
+			time.monotonic()-started,
+			destination
+			))
+	print("BYE!")
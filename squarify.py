@@ -1,38 +1,627 @@
 '''
 Transcode the files... 
 to 720x520 and SAR=1:1
+
+Each file is ffprobe'd first (results cached in probe_cache.json) and
+gets the cheapest treatment that does the job:
+- skip: already 720x540 h264 with square pixels and mp4-friendly audio
+- copy_audio: rescale the video but copy the audio stream as it is
+- full: re-encode everything
 '''
 
+import collections
+import concurrent.futures
+import fingerprints
+import json
+import metrics
 import os
+import shutil
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+# ISO base media (mp4/mov) containers that ffmpeg can only read from a
+# pipe if the moov atom comes before the media data
+ISO_BMFF_EXTENSIONS = ('.mp4','.m4v','.mov','.m4a','.3gp')
+# containers that can always be read front to back
+STREAMABLE_EXTENSIONS = ('.ts','.mts','.m2ts','.mpg','.mpeg','.mkv','.webm','.dv')
+
+TARGET_WIDTH = 720
+TARGET_HEIGHT = 540
+# x264 settings for the video re-encode; these are ffmpeg's own defaults
+PRESET = 'medium'
+CRF = 23
+# audio codecs that can go into the mp4 output untouched
+COPYABLE_AUDIO = ('aac','mp3','ac3','alac')
+# what everything else is re-encoded to
+AUDIO_CODEC = 'aac'
+
+SKIP = 'skip'
+COPY_AUDIO = 'copy_audio'
+FULL = 'full'
+
+# with segmenting on, files longer than SEGMENT_THRESHOLD seconds are
+# cut into SEGMENT_LENGTH second pieces and transcoded in parallel
+SEGMENT_THRESHOLD = 60*60
+SEGMENT_LENGTH = 10*60
+# most probe results kept in probe_cache.json; the oldest go first
+PROBE_CACHE_SIZE = 2000
+
+class ProbeCache:
+	'''
+	ffprobe results kept in a JSON file. Files are keyed by md5 and size
+	when the fingerprint index knows them (e.g. from the download), so a
+	file that's downloaded again is still recognised; otherwise by path,
+	size and mtime, and those entries are dropped once the file is gone.
+	Only the newest maxEntries are kept.
+	'''
+	def __init__(self,path='probe_cache.json',maxEntries=PROBE_CACHE_SIZE):
+		self.path = path
+		self.maxEntries = maxEntries
+		self._lock = threading.Lock()
+		self.entries = {}
+		if os.path.isfile(path):
+			try:
+				with open(path) as f:
+					self.entries = json.load(f)
+			except ValueError:
+				pass
+		self._prune()
+
+	@staticmethod
+	def key(local_filepath):
+		stat = os.stat(local_filepath)
+		known = fingerprints.lookup(local_filepath)
+		if known is not None:
+			return "md5:{}|{}".format(known['md5'],stat.st_size)
+		return "{}|{}|{}".format(
+			os.path.abspath(local_filepath),
+			stat.st_size,
+			stat.st_mtime_ns
+			)
+
+	def get(self,local_filepath):
+		key = self.key(local_filepath)
+		with self._lock:
+			if key in self.entries:
+				return self.entries[key]
+		info = ffprobe(local_filepath)
+		if info is not None:
+			with self._lock:
+				self.entries[key] = info
+				self._save()
+
+		return info
+
+	def _prune(self):
+		# path-keyed entries for files that are gone, then the oldest
+		self.entries = {
+			key: info for key, info in self.entries.items()
+			if key.startswith('md5:') or os.path.exists(key.rsplit('|',2)[0])
+			}
+		for key in list(self.entries)[:max(len(self.entries)-self.maxEntries,0)]:
+			del self.entries[key]
+
+	def _save(self):
+		self._prune()
+		tempPath = self.path+".tmp"
+		with open(tempPath,'w') as f:
+			json.dump(self.entries,f)
+		os.replace(tempPath,self.path)
+
+_probeCache = None
+_probeCacheLock = threading.Lock()
+
+def configure_probe_cache(path='probe_cache.json'):
+	global _probeCache
+	with _probeCacheLock:
+		_probeCache = ProbeCache(path)
+	return _probeCache
+
+def get_probe_cache():
+	global _probeCache
+	with _probeCacheLock:
+		if _probeCache is None:
+			_probeCache = ProbeCache()
+	return _probeCache
+
+def ffprobe(source,data=None):
+	'''
+	Return ffprobe's stream/format info for a file as a dict, or None if
+	ffprobe couldn't make sense of it. With data, source should be
+	'pipe:0' and data the bytes to probe (e.g. the head of a download).
+	'''
+	command = [
+		'ffprobe','-v','error',
+		'-print_format','json',
+		'-show_streams','-show_format',
+		source
+		]
+	output = subprocess.run(
+		command,
+		input=data,
+		stdout=subprocess.PIPE,
+		stderr=subprocess.PIPE)
+	if output.returncode != 0:
+		return None
+	try:
+		return json.loads(output.stdout.decode('utf-8'))
+	except ValueError:
+		return None
+
+def plan(probeInfo):
+	'''
+	Pick SKIP, COPY_AUDIO or FULL from ffprobe info.
+	'''
+	if not probeInfo:
+		return FULL
+	streams = probeInfo.get('streams',[])
+	videos = [
+		x for x in streams
+		if x.get('codec_type') == 'video'
+		and not x.get('disposition',{}).get('attached_pic')
+		]
+	audios = [x for x in streams if x.get('codec_type') == 'audio']
+	audioOK = all(x.get('codec_name') in COPYABLE_AUDIO for x in audios)
+	videoOK = (
+		len(videos) == 1
+		and videos[0].get('codec_name') == 'h264'
+		and videos[0].get('width') == TARGET_WIDTH
+		and videos[0].get('height') == TARGET_HEIGHT
+		and videos[0].get('sample_aspect_ratio','1:1') in ('1:1','0:1','N/A')
+		)
+	isMP4 = 'mp4' in probeInfo.get('format',{}).get('format_name','')
+
+	if videoOK and audioOK and isMP4:
+		return SKIP
+	elif audios and audioOK:
+		return COPY_AUDIO
+	else:
+		return FULL
 
-def transcode(local_filepath):
+def transcode(local_filepath,threads=None,preset=PRESET,crf=CRF):
 	# ffmpeg -i local_filepath -vf scale=720x540,setsar=1:1 local_filepath_sq.mp4
 	# delete original
 	# return temp_vids/transcoded_filepath
+	# (or local_filepath itself if it doesn't need transcoding)
+	action = plan(get_probe_cache().get(local_filepath))
+	print("{}: {}".format(os.path.basename(local_filepath),action.upper()))
+	if action == SKIP:
+		return local_filepath
 	transcoded_filepath = False
-	splitpath = list(os.path.splitext(local_filepath))
-	splitpath.insert(1,"_square-pixel")
-	transcoded_filepath = ''.join(splitpath)
-	command = "ffmpeg -i {} -vf scale=720x540,setsar=1:1 {}".format(local_filepath,transcoded_filepath).split()
-	output = subprocess.run(
-		command, 
-		stdout=subprocess.PIPE, 
-		stderr=subprocess.PIPE)
-	# print(output.stdout.decode('utf-8'))
-	print(output.stderr.decode('utf-8'))
+	transcoded_filepath = square_pixel_path(local_filepath)
+	command = ffmpeg_command(local_filepath,transcoded_filepath,threads,action,preset,crf)
+	returncode = run_ffmpeg(command,os.path.basename(local_filepath))
 
-	if os.path.isfile(transcoded_filepath):
+	if returncode == 0 and os.path.isfile(transcoded_filepath):
 		pass
 	else:
 		transcoded_filepath = False
 
 	return transcoded_filepath
 
-def main(local_filepath):
-	if os.path.isfile(sys.argv[1]:
-		local_filepath
+def ffmpeg_command(
+	source,
+	transcoded_filepath,
+	threads=None,
+	action=FULL,
+	preset=PRESET,
+	crf=CRF,
+	audio=True
+	):
+	'''
+	audio=False leaves the audio out (for segments, whose audio is done
+	separately from the whole source).
+	'''
+	# -y because a leftover output from an earlier failed run should just
+	# get replaced, not make ffmpeg stop and ask
+	command = ['ffmpeg','-y','-nostats','-progress','pipe:1']
+	if threads:
+		command += ['-threads',str(threads)]
+	command += ['-i',source]
+	if action == SKIP:
+		# only happens for streams, which have to be written out anyway
+		command += ['-c','copy']
+	else:
+		command += [
+			'-vf','scale={}x{},setsar=1:1'.format(TARGET_WIDTH,TARGET_HEIGHT),
+			'-c:v','libx264',
+			'-preset',preset,
+			'-crf',str(crf)
+			]
+		if not audio:
+			command += ['-an']
+		elif action == COPY_AUDIO:
+			command += ['-c:a','copy']
+		else:
+			command += ['-c:a',AUDIO_CODEC]
+	if threads:
+		command += ['-threads',str(threads)]
+	command.append(transcoded_filepath)
+
+	return command
+
+def run_ffmpeg(command,label,chunks=None,reportEvery=10):
+	'''
+	Run ffmpeg, printing a progress line for the job every reportEvery
+	seconds from its -progress output instead of dumping all of stderr at
+	the end. stderr is still read as we go (so ffmpeg can't block on it)
+	and its tail is printed if the job fails. If chunks is given, it's an
+	iterable of bytes to pipe into ffmpeg's stdin; if it raises (e.g. the
+	download behind it fails), ffmpeg is killed and its half-written
+	output deleted before the exception is passed on.
+	Returns ffmpeg's exit code.
+	'''
+	with metrics.span('ffmpeg',item=label) as span:
+		process = subprocess.Popen(
+			command,
+			stdin=subprocess.PIPE if chunks is not None else subprocess.DEVNULL,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE)
+		stderrTail = collections.deque(maxlen=40)
+
+		def read_stderr():
+			for line in process.stderr:
+				stderrTail.append(line.decode('utf-8','replace'))
+
+		def read_progress():
+			# -progress writes blocks of key=value lines, each ending in progress=...
+			progress = {}
+			lastReport = 0
+			for line in process.stdout:
+				key, _, value = line.decode('utf-8','replace').strip().partition('=')
+				progress[key] = value
+				if key == 'progress':
+					now = time.time()
+					if now-lastReport >= reportEvery or value == 'end':
+						print("TRANSCODING {}: {} done, speed {}".format(
+							label,
+							progress.get('out_time','?'),
+							progress.get('speed','?')
+							))
+						lastReport = now
+
+		readers = [
+			threading.Thread(target=read_stderr,daemon=True),
+			threading.Thread(target=read_progress,daemon=True)
+			]
+		for reader in readers:
+			reader.start()
+		if chunks is not None:
+			try:
+				for chunk in chunks:
+					process.stdin.write(chunk)
+					span.bytes += len(chunk)
+			except BrokenPipeError:
+				# ffmpeg quit early; its stderr will say why
+				pass
+			except BaseException:
+				# otherwise ffmpeg would see EOF and finish a truncated
+				# file on its own, maybe after it's been cleaned up
+				process.kill()
+				process.wait()
+				for reader in readers:
+					reader.join()
+				# ffmpeg's output always comes last
+				try:
+					os.remove(command[-1])
+				except OSError:
+					pass
+				raise
+			finally:
+				try:
+					process.stdin.close()
+				except BrokenPipeError:
+					pass
+		process.wait()
+		for reader in readers:
+			reader.join()
+		if process.returncode != 0:
+			span.outcome = metrics.FAILED
+			print("FFMPEG FAILED ON {}:".format(label))
+			print(''.join(stderrTail))
+
+	return process.returncode
+
+class TranscodeScheduler:
+	'''
+	Run several ffmpeg jobs at once without oversubscribing the machine:
+	each job gets threadsPerJob threads (passed to ffmpeg as -threads) and
+	only coreBudget // threadsPerJob jobs run at a time. Jobs past that
+	wait their turn.
+
+	scheduler = TranscodeScheduler(coreBudget=32,threadsPerJob=4)
+	future = scheduler.submit('temp_vids/foo.mp4')
+	transcoded_filepath = future.result()
+	'''
+	def __init__(self,coreBudget=None,threadsPerJob=4,preset=PRESET,crf=CRF):
+		self.coreBudget = coreBudget or os.cpu_count() or 1
+		self.preset = preset
+		self.crf = crf
+		self.threadsPerJob = min(threadsPerJob,self.coreBudget)
+		self.jobs = max(self.coreBudget//self.threadsPerJob,1)
+		self._executor = concurrent.futures.ThreadPoolExecutor(
+			max_workers=self.jobs,
+			thread_name_prefix='ffmpeg'
+			)
+
+	def submit(self,local_filepath,chunks=None,head=None):
+		'''
+		Queue a transcode and return a Future for the transcoded filepath
+		(or False). Pass chunks to transcode from a stream instead of from
+		local_filepath, and head to probe it by (see transcode_stream()).
+		'''
+		if chunks is not None:
+			return self._executor.submit(
+				transcode_stream,
+				chunks,
+				local_filepath,
+				self.threadsPerJob,
+				head,
+				self.preset,
+				self.crf
+				)
+		return self._executor.submit(
+			transcode,
+			local_filepath,
+			self.threadsPerJob,
+			self.preset,
+			self.crf
+			)
+
+	def transcode_segmented(self,local_filepath,segmentLength=SEGMENT_LENGTH):
+		'''
+		For long files: cut the source's video at keyframes into
+		segmentLength second pieces (stream copy, so it's quick),
+		transcode the pieces in parallel as separate jobs, then join them
+		back up losslessly with the concat demuxer into the usual
+		_square-pixel output. The audio is encoded (or copied) in one go
+		from the whole source alongside them and muxed in at the join, so
+		there are no encoder gaps at the cuts. The result has to match
+		the source's duration, streams, audio codecs and audio length or
+		it gets thrown out.
+		This blocks while the pieces run, so call it from your own thread,
+		not from a job running on this scheduler.
+		Returns the transcoded filepath (or the original, if it doesn't
+		need transcoding), or False.
+		'''
+		probeInfo = get_probe_cache().get(local_filepath)
+		action = plan(probeInfo)
+		if action == SKIP:
+			print("{}: {}".format(os.path.basename(local_filepath),action.upper()))
+			return local_filepath
+		label = os.path.basename(local_filepath)
+		transcoded_filepath = square_pixel_path(local_filepath)
+		segmentDir = tempfile.mkdtemp(
+			prefix=os.path.splitext(label)[0]+"_segments_",
+			dir=os.path.dirname(local_filepath) or '.'
+			)
+		try:
+			# 1. split
+			returncode = run_ffmpeg(
+				[
+					'ffmpeg','-y','-nostats','-progress','pipe:1',
+					'-i',local_filepath,
+					'-map','0:v',
+					'-c','copy',
+					'-f','segment',
+					'-segment_time',str(segmentLength),
+					'-reset_timestamps','1',
+					os.path.join(segmentDir,'source_%05d.mkv')
+				],
+				label+" (splitting)"
+				)
+			segments = sorted(
+				x for x in os.listdir(segmentDir) if x.startswith('source_')
+				)
+			if returncode != 0 or segments == []:
+				return False
+			print("{}: {} IN {} SEGMENTS".format(label,action.upper(),len(segments)))
+
+			# 2. transcode the pieces, and the audio as a whole
+			def transcode_segment(segment):
+				source = os.path.join(segmentDir,segment)
+				output = source.replace('source_','output_')
+				command = ffmpeg_command(
+					source,
+					output,
+					self.threadsPerJob,
+					action,
+					self.preset,
+					self.crf,
+					audio=False
+					)
+				if run_ffmpeg(command,"{} ({})".format(label,segment)) != 0:
+					return None
+				return output
+
+			def transcode_audio():
+				output = os.path.join(segmentDir,'audio.mka')
+				command = [
+					'ffmpeg','-y','-nostats','-progress','pipe:1',
+					'-i',local_filepath,
+					'-map','0:a','-vn',
+					'-c:a','copy' if action == COPY_AUDIO else AUDIO_CODEC,
+					output
+					]
+				if run_ffmpeg(command,label+" (audio)") != 0:
+					return None
+				return output
+
+			audioFuture = None
+			if audio_streams(probeInfo):
+				audioFuture = self._executor.submit(transcode_audio)
+			outputs = [
+				future.result() for future in
+				[self._executor.submit(transcode_segment,x) for x in segments]
+				]
+			audioOutput = audioFuture.result() if audioFuture is not None else None
+			if None in outputs or (audioFuture is not None and audioOutput is None):
+				return False
+
+			# 3. join
+			listPath = os.path.join(segmentDir,'segments.txt')
+			with open(listPath,'w') as f:
+				for output in outputs:
+					f.write("file '{}'\n".format(os.path.abspath(output).replace("'","'\\''")))
+			command = [
+				'ffmpeg','-y','-nostats','-progress','pipe:1',
+				'-f','concat','-safe','0',
+				'-i',listPath
+				]
+			if audioOutput is not None:
+				command += ['-i',audioOutput,'-map','0:v','-map','1:a']
+			command += ['-c','copy',transcoded_filepath]
+			returncode = run_ffmpeg(command,label+" (joining)")
+			if returncode != 0 or not os.path.isfile(transcoded_filepath):
+				return False
+
+			# 4. check it
+			if not matches_source(probeInfo,ffprobe(transcoded_filepath),action):
+				print("{}: JOINED OUTPUT DOESN'T MATCH THE SOURCE, DISCARDING IT".format(label))
+				os.remove(transcoded_filepath)
+				return False
+		finally:
+			shutil.rmtree(segmentDir,ignore_errors=True)
+
+		return transcoded_filepath
+
+	def shutdown(self,wait=True):
+		self._executor.shutdown(wait=wait)
+
+def duration_of(probeInfo):
+	try:
+		return float(probeInfo['format']['duration'])
+	except (KeyError,TypeError,ValueError):
+		return None
+
+def audio_streams(info):
+	return [x for x in (info or {}).get('streams',[]) if x.get('codec_type') == 'audio']
+
+def audio_samples(stream,info):
+	'''
+	How many samples an audio stream holds, from its own duration_ts if
+	it counts in samples, else from its (or the file's) duration.
+	'''
+	try:
+		rate = int(stream['sample_rate'])
+	except (KeyError,TypeError,ValueError):
+		return None
+	if stream.get('time_base') == "1/{}".format(rate) and stream.get('duration_ts') is not None:
+		return int(stream['duration_ts'])
+	try:
+		return int(float(stream.get('duration') or info['format']['duration'])*rate)
+	except (KeyError,TypeError,ValueError):
+		return None
+
+def matches_source(sourceInfo,outputInfo,action=FULL,tolerance=1.0,audioTolerance=0.1):
+	'''
+	Check a transcode has the same number of video/audio streams as its
+	source and a duration within `tolerance` seconds (or 0.1%, whichever
+	is bigger) of it, and that each audio stream has the codec `action`
+	calls for and lasts as many samples as the source's, give or take
+	`audioTolerance` seconds' worth (encoder priming and padding).
+	'''
+	if not sourceInfo or not outputInfo:
+		return False
+
+	def stream_counts(info):
+		types = [
+			x.get('codec_type') for x in info.get('streams',[])
+			if not x.get('disposition',{}).get('attached_pic')
+			]
+		return (types.count('video'),types.count('audio'))
+
+	if stream_counts(sourceInfo) != stream_counts(outputInfo):
+		return False
+	sourceDuration = duration_of(sourceInfo)
+	outputDuration = duration_of(outputInfo)
+	if sourceDuration is None or outputDuration is None:
+		return False
+
+	if abs(sourceDuration-outputDuration) > max(tolerance,sourceDuration*0.001):
+		return False
+	for source, output in zip(audio_streams(sourceInfo),audio_streams(outputInfo)):
+		codec = source.get('codec_name') if action == COPY_AUDIO else AUDIO_CODEC
+		if output.get('codec_name') != codec:
+			return False
+		sourceSamples = audio_samples(source,sourceInfo)
+		outputSamples = audio_samples(output,outputInfo)
+		if sourceSamples is None or outputSamples is None:
+			return False
+		# compare in seconds, in case the sample rate changed
+		sourceSeconds = sourceSamples/int(source['sample_rate'])
+		outputSeconds = outputSamples/int(output['sample_rate'])
+		if abs(sourceSeconds-outputSeconds) > audioTolerance:
+			return False
+
+	return True
+
+def square_pixel_path(local_filepath):
+	splitpath = list(os.path.splitext(local_filepath))
+	splitpath.insert(1,"_square-pixel")
+	return ''.join(splitpath)
+
+def is_streamable(local_filepath,head):
+	'''
+	Decide from a file's name and its first few KB whether ffmpeg can read
+	it straight off a pipe. mp4/mov files only can if the moov atom comes
+	before mdat (i.e. they were written "faststart"); if we can't tell,
+	say no and let the file get staged to disk.
+	'''
+	extension = os.path.splitext(local_filepath)[1].lower()
+	if extension in STREAMABLE_EXTENSIONS:
+		return True
+	if extension not in ISO_BMFF_EXTENSIONS:
+		return False
+	# walk the top-level atoms: 4-byte size + 4-byte type each
+	offset = 0
+	while offset+8 <= len(head):
+		size, atomType = struct.unpack('>I4s',head[offset:offset+8])
+		if atomType == b'moov':
+			return True
+		if atomType == b'mdat':
+			return False
+		if size == 1:
+			# 64-bit size follows the type
+			if offset+16 > len(head):
+				return False
+			size = struct.unpack('>Q',head[offset+8:offset+16])[0]
+		elif size == 0:
+			# atom runs to the end of the file
+			return False
+		offset += size
+
+	return False
+
+def transcode_stream(chunks,local_filepath,threads=None,head=None,preset=PRESET,crf=CRF):
+	'''
+	Same as transcode(), but the source is an iterable of bytes (e.g. a
+	download in progress) piped into ffmpeg's stdin, so only the
+	transcoded file ever lands on disk. local_filepath is just used to
+	name the output. If we have the first few KB of the stream in head,
+	they're probed to pick the cheapest action; a stream that needs no
+	transcoding still gets stream-copied to disk.
+	'''
+	action = FULL
+	if head:
+		action = plan(ffprobe('pipe:0',head))
+	print("{}: {}".format(os.path.basename(local_filepath),action.upper()))
+	transcoded_filepath = square_pixel_path(local_filepath)
+	command = ffmpeg_command('pipe:0',transcoded_filepath,threads,action,preset,crf)
+	returncode = run_ffmpeg(command,os.path.basename(local_filepath),chunks)
+
+	if returncode == 0 and os.path.isfile(transcoded_filepath):
+		return transcoded_filepath
+	else:
+		return False
+
+def main(local_filepath=None):
+	if local_filepath is None:
+		local_filepath = sys.argv[1]
 	transcoded_filepath = transcode(local_filepath)
 
 	return transcoded_filepath
@@ -0,0 +1,92 @@
+'''
+Retry the one stage of an asset's lifecycle that failed (an RS path
+lookup, a Drive download, an IA upload...), instead of sending the
+whole asset round again in a redo pass.
+
+Every failure is sorted into one of two kinds:
+- transient: worth trying again in a moment. Dropped connections and
+	timeouts, throttling, 5xx responses, a checksum that didn't match
+	after a transfer, and anything raised with transient=True.
+- permanent: trying again won't help. RS has no file for the resource,
+	a malformed RS response, a bad CSV row, a 4xx from archive.org,
+	ffmpeg refusing a file.
+
+	path = stageretry.retry('rs_primary_path',resolve,destination='rs')
+
+A transient failure is retried after a jittered backoff, up to
+attempts times in all; a permanent one (or a transient one that's run
+out of tries) is raised as a StageError that says which stage it was,
+what kind of failure and why, for the end-of-run report.
+'''
+
+import ratelimit
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+DEFAULT_ATTEMPTS = 3
+
+class StageError(Exception):
+	def __init__(self,stage,reason,transient=False):
+		Exception.__init__(self,"{} failed ({}): {}".format(
+			stage,
+			TRANSIENT if transient else PERMANENT,
+			reason
+			))
+		self.stage = stage
+		self.reason = reason
+		self.transient = transient
+
+	@property
+	def kind(self):
+		return TRANSIENT if self.transient else PERMANENT
+
+def is_transient(error):
+	# exceptions can say for themselves (StageError,
+	# multipart.MultipartError, rangedownload.ChecksumMismatch...)
+	transient = getattr(error,'transient',None)
+	if transient is not None:
+		return transient
+	if ratelimit.is_throttle_error(error):
+		return True
+	status = ratelimit.status_of(error)
+	return status is not None and (status[0] >= 500 or status[0] == 408)
+
+def describe(error):
+	if isinstance(error,StageError):
+		return error.reason
+	# KeyError('Title') would otherwise just say 'Title'
+	return "{}: {}".format(type(error).__name__,error)
+
+_attempts = DEFAULT_ATTEMPTS
+
+def configure(attempts=DEFAULT_ATTEMPTS):
+	global _attempts
+	_attempts = max(attempts,1)
+
+def retry(stage,call,hold=None,destination=None,attempts=None):
+	'''
+	Return call(), trying it again as long as it fails in a transient
+	way. hold is a lock or semaphore to hold for each try (but not
+	while waiting to try again); destination is the ratelimit limit to
+	back off on. Raises StageError when it gives up.
+	'''
+	attempts = attempts or _attempts
+	for attempt in range(attempts):
+		try:
+			if hold is None:
+				return call()
+			with hold:
+				return call()
+		except Exception as e:
+			transient = is_transient(e)
+			if not transient or attempt+1 == attempts:
+				if isinstance(e,StageError):
+					raise
+				raise StageError(stage,describe(e),transient) from e
+			print("{} FAILED, TRYING AGAIN ({} OF {}): {}".format(
+				stage.upper(),
+				attempt+2,
+				attempts,
+				describe(e)
+				))
+		ratelimit.backoff(destination,attempt)
@@ -0,0 +1,145 @@
+'''
+Keep randos2ia from filling up the disk temp_vids is on.
+
+Every file takes up room twice while it's being worked on: the download
+(unless it's streamed) and the _square-pixel copy, plus the pieces of
+both while a long file is transcoded in segments. Before a file is
+downloaded, its job reserves what it's going to need, worked out from
+Drive's size for it and outputRatio (how big a transcode comes out next
+to its source), and waits until that fits in the space that was free
+when the run started, less a safety reserve. The reservation is let go
+when the job's files are cleaned up, whether it made it or not.
+
+So as many files are in flight as there's room for, and a batch never
+runs out of space halfway through. This assumes nothing else is filling
+the same disk at the same time; the reserve covers some slack.
+
+reclaim() clears out what earlier runs left behind (partial downloads,
+transcodes of files that failed, segment directories) before a run.
+'''
+
+import os
+import shutil
+import threading
+
+DEFAULT_RESERVE = 1024*1024*1024
+DEFAULT_OUTPUT_RATIO = 1.0
+
+class NotEnoughSpace(Exception):
+	pass
+
+class StagingBudget:
+	def __init__(self,directory='temp_vids',reserve=DEFAULT_RESERVE,outputRatio=DEFAULT_OUTPUT_RATIO):
+		'''
+		directory: where files are staged
+		reserve: bytes to always leave free on its disk
+		outputRatio: transcode output size as a fraction of its source
+		'''
+		self.directory = directory
+		self.reserve = reserve
+		self.outputRatio = outputRatio
+		self.capacity = None
+		self.reserved = 0
+		self.peak = 0
+		# {job key: bytes}
+		self._reservations = {}
+		self._condition = threading.Condition()
+
+	def start(self):
+		'''
+		Take stock of the free space; call it after reclaim() and before
+		the first admit().
+		'''
+		os.makedirs(self.directory,exist_ok=True)
+		self.capacity = shutil.disk_usage(self.directory).free - self.reserve
+		print("{:.1f} GB FREE FOR STAGING IN {}".format(
+			max(self.capacity,0)/1024**3,
+			self.directory
+			))
+
+	def estimate(self,size,downloaded=False,stream=False,segment=False):
+		'''
+		Bytes a job will need in the staging directory at its peak.
+		downloaded: the source is already there (e.g. from an earlier run)
+		stream: the source is piped into ffmpeg and never written
+		segment: it may be transcoded in pieces, which doubles both sides
+		'''
+		size = int(size or 0)
+		source = 0 if (downloaded or stream) else size
+		output = int(size*self.outputRatio)
+		if segment and not stream:
+			# the cut-up source and transcoded pieces, alongside the
+			# source and the joined output
+			source += size
+			output *= 2
+
+		return source+output
+
+	def admit(self,key,need):
+		'''
+		Wait until need bytes fit, then hold them for key. Raises
+		NotEnoughSpace if they never could.
+		'''
+		with self._condition:
+			if need > self.capacity:
+				raise NotEnoughSpace("{} needs {:.1f} GB of staging space, only {:.1f} GB is free".format(
+					key,
+					need/1024**3,
+					max(self.capacity,0)/1024**3
+					))
+			waited = False
+			while self.reserved+need > self.capacity:
+				if not waited:
+					print("WAITING FOR STAGING SPACE FOR {}".format(key))
+					waited = True
+				self._condition.wait()
+			self._reservations[key] = need
+			self.reserved += need
+			self.peak = max(self.peak,self.reserved)
+
+	def release(self,key):
+		with self._condition:
+			self.reserved -= self._reservations.pop(key,0)
+			self._condition.notify_all()
+
+	def reclaim(self,keep=None):
+		'''
+		Delete everything in the staging directory except files keep(path)
+		says to hold on to, looking inside the per-file directories
+		downloads go in. Returns how many bytes were freed.
+		'''
+		if not os.path.isdir(self.directory):
+			return 0
+		freed = 0
+		for name in os.listdir(self.directory):
+			path = os.path.join(self.directory,name)
+			if name.startswith('.'):
+				# .gitkeep and the like
+				continue
+			if os.path.isdir(path):
+				for root, dirs, files in os.walk(path,topdown=False):
+					for x in files:
+						freed += self._remove(os.path.join(root,x),keep)
+					try:
+						# only goes if nothing in it was kept
+						os.rmdir(root)
+					except OSError:
+						pass
+			else:
+				freed += self._remove(path,keep)
+		if freed:
+			print("RECLAIMED {:.1f} MB LEFT IN {} BY EARLIER RUNS".format(freed/1024/1024,self.directory))
+
+		return freed
+
+	@staticmethod
+	def _remove(path,keep):
+		if keep is not None and keep(path):
+			return 0
+		try:
+			size = os.path.getsize(path)
+			os.remove(path)
+		except OSError as e:
+			print("COULDN'T CLEAR OUT {}: {}".format(path,e))
+			return 0
+		return size